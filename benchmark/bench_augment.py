@@ -0,0 +1,83 @@
+"""
+  Parity and timing of the vectorized augmentation transforms (utils/augment.py) against the
+  per-row reference path of utils.utils (point_transform and rotate_label).
+
+  Usage (from the repository root):
+    python -m benchmark.bench_augment --n_points 20000 --n_boxes 20
+"""
+import argparse
+import timeit
+import numpy as np
+
+from utils.utils import point_transform, rotate_label, angle_to_quat
+from utils.augment import global_transform, compose_transforms, transform_points, transform_labels
+
+
+def synthetic_frame(rng, n_points, n_boxes):
+  points = np.concatenate([rng.uniform([0, -40, -3], [70, 40, 1], (n_points, 3)), rng.uniform(0, 50, (n_points, 1))], axis=1)
+  label = np.zeros((n_boxes, 11))
+  label[:, 0:3] = rng.uniform([5, -30, -2], [60, 30, 0], (n_boxes, 3))
+  label[:, 3:6] = rng.uniform([3.5, 1.5, 1.4], [4.5, 2., 1.7], (n_boxes, 3))
+  label[:, 6:10] = [angle_to_quat(0., 0., yaw) for yaw in rng.uniform(-np.pi, np.pi, n_boxes)]
+  label[:, 10] = 1
+  return points.astype(np.float32), label
+
+
+def reference_rotation(points, label, angle):
+  points = points.copy()
+  points[:, 0:3] = point_transform(points[:, 0:3], 0, 0, 0, rz=angle)
+  return points, rotate_label(label.copy(), rz=angle)
+
+
+def reference_scaling(points, label, factor):
+  # the intended scaling : centers and dimensions of every box (columns 0:6)
+  points = points.copy()
+  points[:, 0:3] = points[:, 0:3] * factor
+  label = label.copy()
+  label[:, 0:6] = label[:, 0:6] * factor
+  return points, label
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--n_points", default=20000, type=int)
+  parser.add_argument("--n_boxes", default=20, type=int)
+  parser.add_argument("--n_trials", default=50, type=int)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  for _ in range(args.n_trials):
+    points, label = synthetic_frame(rng, args.n_points, args.n_boxes)
+    angle, factor = rng.uniform(-np.pi / 4, np.pi / 4), rng.uniform(0.95, 1.05)
+
+    ref_points, ref_label = reference_rotation(points, label, angle)
+    mat = global_transform(rz=angle)
+    np.testing.assert_allclose(transform_points(points, mat), ref_points, rtol=0, atol=1e-4)
+    np.testing.assert_allclose(transform_labels(label, mat), ref_label, rtol=0, atol=1e-9)
+
+    ref_points, ref_label = reference_scaling(points, label, factor)
+    mat = global_transform(scale=factor)
+    np.testing.assert_allclose(transform_points(points, mat), ref_points, rtol=0, atol=1e-4)
+    np.testing.assert_allclose(transform_labels(label, mat), ref_label, rtol=0, atol=1e-9)
+
+    # a composed transform equals the transforms applied one after the other
+    mats = [global_transform(rz=angle), global_transform(scale=factor), global_transform(translation=(1., -2., .5))]
+    step_points, step_label = points, label
+    for mat in mats:
+      step_points, step_label = transform_points(step_points, mat), transform_labels(step_label, mat)
+    np.testing.assert_allclose(transform_points(points, compose_transforms(*mats)), step_points, rtol=0, atol=1e-4)
+    np.testing.assert_allclose(transform_labels(label, compose_transforms(*mats)), step_label, rtol=0, atol=1e-9)
+  print("parity: {} frames, rotation / scaling / composition match the reference".format(args.n_trials))
+
+  points, label = synthetic_frame(rng, args.n_points, args.n_boxes)
+  angle = 0.3
+  n = 200
+  t_ref = timeit.timeit(lambda: reference_rotation(points, label, angle), number=n) / n
+  t_vec = timeit.timeit(lambda: (transform_points(points, global_transform(rz=angle)),
+                                 transform_labels(label, global_transform(rz=angle))), number=n) / n
+  print("rotation, {} points {} boxes: reference {:.3f} ms, vectorized {:.3f} ms ({:.1f}x)".format(
+      args.n_points, args.n_boxes, t_ref * 1e3, t_vec * 1e3, t_ref / t_vec))
+
+
+if __name__ == "__main__":
+  main()
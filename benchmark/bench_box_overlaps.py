@@ -0,0 +1,105 @@
+"""
+  Box overlap kernels of utils/box_overlaps.pyx : checks bbox_overlaps, bbox_overlaps_frames,
+  bbox_intersections and box_vote against NumPy versions of the same float / double arithmetic, and
+  times them for several numbers of OpenMP threads, on the anchors of the feature map and synthetic
+  boxes.
+
+  Usage (from the repository root, after python setup.py build_ext --inplace):
+    python -m benchmark.bench_box_overlaps --num_threads 1 2 4 8 --num_boxes 50 --num_frames 8
+"""
+import argparse
+import os
+import time
+import numpy as np
+
+from config import cfg
+from utils.utils import cal_anchors, anchor_to_standup_box2d
+from utils.box_overlaps import bbox_overlaps, bbox_overlaps_frames, bbox_intersections, box_vote
+
+
+def reference_overlaps(boxes, query_boxes, intersections=False):
+  # the +1 sides in float64 rounded to float32, the union summed in float64, float32 ratios
+  def plus_one(x):
+    return x.astype(np.float64) + 1
+  b, q = boxes[:, np.newaxis, :], query_boxes[np.newaxis, :, :]
+  iw = plus_one(np.minimum(b[..., 2], q[..., 2]) - np.maximum(b[..., 0], q[..., 0])).astype(np.float32)
+  ih = plus_one(np.minimum(b[..., 3], q[..., 3]) - np.maximum(b[..., 1], q[..., 1])).astype(np.float32)
+  query_area = (plus_one(q[..., 2] - q[..., 0]) * plus_one(q[..., 3] - q[..., 1])).astype(np.float32)
+  if intersections:
+    ratio = iw * ih / query_area
+  else:
+    area = plus_one(b[..., 2] - b[..., 0]) * plus_one(b[..., 3] - b[..., 1])
+    ratio = iw * ih / (area + query_area - (iw * ih).astype(np.float64)).astype(np.float32)
+  return np.where((iw > 0) & (ih > 0), ratio, np.float32(0))
+
+
+def reference_vote(dets_nms, dets_all):
+  voted = np.zeros_like(dets_nms)
+  for i, det in enumerate(dets_nms):
+    ov = reference_overlaps(det[np.newaxis, 0:4], dets_all[:, 0:4])[0]
+    keep = ov >= 0.5
+    acc_box, acc_score = np.zeros((4), dtype=np.float32), np.float32(0)
+    for m in np.flatnonzero(keep):
+      acc_box += dets_all[m, 4] * dets_all[m, 0:4]
+      acc_score += dets_all[m, 4]
+    voted[i, 0:4] = acc_box / acc_score
+    voted[i, 4] = det[4]
+  return voted
+
+
+def synthetic_boxes(rng, n, max_size):
+  xy = rng.uniform([cfg.X_MIN, cfg.Y_MIN], [cfg.X_MAX, cfg.Y_MAX], (n, 2))
+  return np.concatenate([xy, xy + rng.uniform(0.5, max_size, (n, 2))], axis=1).astype(np.float32)
+
+
+def timed(fn, repeats):
+  fn()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    fn()
+  return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--num_threads", default=[1, 2, 4, os.cpu_count()], nargs="*", type=int)
+  parser.add_argument("--num_boxes", default=50, type=int)
+  parser.add_argument("--num_frames", default=8, type=int)
+  parser.add_argument("--repeats", default=5, type=int)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  anchors = cal_anchors(cfg).reshape(-1, 7)
+  anchors_standup = np.ascontiguousarray(anchor_to_standup_box2d(anchors[:, [0, 1, 4, 5]])).astype(np.float32)
+  frames = [synthetic_boxes(rng, args.num_boxes, 6.) for _ in range(args.num_frames)]
+  dets_all = np.concatenate([np.repeat(frames[0], 40, axis=0) + rng.uniform(-0.3, 0.3, (40 * args.num_boxes, 4)).astype(np.float32),
+                             rng.uniform(0.1, 1., (40 * args.num_boxes, 1)).astype(np.float32)], axis=1)
+  dets_nms = np.ascontiguousarray(dets_all[::40])
+
+  # parity
+  for threads in sorted(set(args.num_threads)):
+    assert np.array_equal(bbox_overlaps(anchors_standup, frames[0], threads), reference_overlaps(anchors_standup, frames[0]))
+    assert np.array_equal(bbox_intersections(anchors_standup, frames[0], threads), reference_overlaps(anchors_standup, frames[0], True))
+    for out, query_boxes in zip(bbox_overlaps_frames(anchors_standup, frames, threads), frames):
+      assert np.array_equal(out, reference_overlaps(anchors_standup, query_boxes))
+    assert np.array_equal(box_vote(dets_nms, dets_all, threads), reference_vote(dets_nms, dets_all))
+  print("parity: {} anchors x {} boxes, {} detections voted, same values as the NumPy references".format(
+      len(anchors_standup), args.num_boxes, len(dets_nms)))
+
+  # scaling
+  print("{} anchors, {} frames x {} boxes, {} cores".format(len(anchors_standup), args.num_frames, args.num_boxes, os.cpu_count()))
+  base = None
+  for threads in sorted(set(args.num_threads)):
+    timings = {
+        "bbox_overlaps per frame": timed(lambda: [bbox_overlaps(anchors_standup, boxes, threads) for boxes in frames], args.repeats),
+        "bbox_overlaps_frames": timed(lambda: bbox_overlaps_frames(anchors_standup, frames, threads), args.repeats),
+        "bbox_intersections per frame": timed(lambda: [bbox_intersections(anchors_standup, boxes, threads) for boxes in frames], args.repeats),
+        "box_vote": timed(lambda: box_vote(dets_nms, dets_all, threads), args.repeats),
+    }
+    base = base or timings
+    print("  {} threads: {}".format(threads, ", ".join("{} {:.2f} ms ({:.1f}x)".format(name, value, base[name] / value)
+                                                      for name, value in timings.items())))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,72 @@
+"""
+  Padding ratio of the voxel batches (share of the [B, K, T, 7] feature_buffer which is padding)
+  with plain padded_batch, with voxel count bucketing (--bucket_boundaries) and with a hard cap
+  on the voxels per frame (--max_voxels).
+
+  Usage (from the repository root):
+    python -m benchmark.bench_bucketing --data_root_dir /path/to/astyx --bucket_boundaries 1000 2000 4000 --max_voxels 6000
+  A synthetic dataset is written to a temporary directory when --data_root_dir is empty.
+  Without --bucket_boundaries, the boundaries are the quartiles of the voxel counts of the split.
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+
+from config import cfg
+from data import Data_helper
+from benchmark.synthetic_dataset import make_dataset
+
+
+def padding_ratio(helper, n_batches):
+  # padded voxels / total voxels of the batches, and the mean batch K
+  n_real, n_total, ks = 0, 0, []
+  t0 = time.perf_counter()
+  for _ in range(n_batches):
+    batch = next(helper)
+    number_buffer = batch["number_buffer"].numpy()
+    n_real += np.count_nonzero(number_buffer)
+    n_total += number_buffer.size
+    ks.append(number_buffer.shape[1])
+  return 1. - n_real / n_total, np.mean(ks), n_batches / (time.perf_counter() - t0)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--data_root_dir", default="", type=str)
+  parser.add_argument("--mode", default="eval", type=str)
+  parser.add_argument("--batch_size", default=4, type=int)
+  parser.add_argument("--n_batches", default=20, type=int)
+  parser.add_argument("--bucket_boundaries", default=[], nargs="*", type=int)
+  parser.add_argument("--max_voxels", default=0, type=int)
+  parser.add_argument("--voxel_drop_policy", default="dense", type=str)
+  args = parser.parse_args()
+
+  if not args.data_root_dir:
+    args.data_root_dir = tempfile.mkdtemp(prefix="astyx_synth_")
+    make_dataset(args.data_root_dir, args.batch_size*args.n_batches, splits=["training", "validation"])
+  cfg.DATA_DIR = args.data_root_dir
+
+  base = {"batch_size": args.batch_size}
+  if not args.bucket_boundaries:
+    helper = Data_helper(cfg, dict(base, batch_size=1), 1, "eval", is_aug_data=False)
+    counts = [int(batch["number_buffer"].shape[1]) for batch in helper.batcher]
+    args.bucket_boundaries = sorted(set(int(q) for q in np.percentile(counts, [25, 50, 75])))
+    print("voxels per frame: min {} median {} max {}, boundaries {}".format(
+        min(counts), int(np.median(counts)), max(counts), args.bucket_boundaries))
+
+  runs = [("padded_batch", {}),
+          ("bucketing", {"bucket_boundaries": args.bucket_boundaries})]
+  if args.max_voxels:
+    runs += [("max_voxels", {"max_voxels": args.max_voxels, "voxel_drop_policy": args.voxel_drop_policy}),
+             ("bucketing + max_voxels", {"bucket_boundaries": args.bucket_boundaries, "max_voxels": args.max_voxels,
+                                         "voxel_drop_policy": args.voxel_drop_policy})]
+  for name, params in runs:
+    # sample_test repeats, so every run sees n_batches batches whatever the bucketing
+    helper = Data_helper(cfg, dict(base, **params), 4, "sample_test" if args.mode == "eval" else args.mode, is_aug_data=False)
+    ratio, mean_k, batches_per_s = padding_ratio(helper, args.n_batches)
+    print("{:24s} padding ratio: {:5.1%}  mean K: {:8.1f}  batches/s: {:6.2f}".format(name, ratio, mean_k, batches_per_s))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,80 @@
+"""
+  Benchmark of the on-device box decoding and nms of the predict step (Model.detect) against the former
+  host path (the maps copied with .numpy(), delta_to_boxes3d and the nms frame by frame), on random
+  probability and regression maps, with the bytes copied to the host per batch. The rotated nms of detect
+  runs with the Cython kernel on the host (cfg.RPN_NMS_HOST) and in the graph, the standup nms is batched.
+
+  Usage (from the repository root):
+    python -m benchmark.bench_detect --batch_size 2 --score_thresh 0.96 0.99
+"""
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from config import cfg
+from model import Model
+from utils.utils import delta_to_boxes3d, cal_anchors, center_to_corner_box2d, corner_to_standup_box2d
+from utils.rotated_iou import rotated_nms
+
+
+def host_detect(p_map, r_map, anchors):
+  probs, deltas = p_map.numpy(), r_map.numpy()
+  batch_boxes3d = delta_to_boxes3d(deltas, anchors, coordinate='lidar')
+  batch_probs = probs.reshape((len(probs), -1))
+  ret = []
+  for batch_id in range(len(probs)):
+    if cfg.RPN_NMS_ROTATED:
+      ind = rotated_nms(batch_boxes3d[batch_id][:, [0, 1, 4, 5, 6]], batch_probs[batch_id], cfg.RPN_NMS_THRESH, cfg.RPN_NMS_POST_TOPK,
+                        score_threshold=cfg.RPN_SCORE_THRESH, pre_topk=cfg.RPN_NMS_PRE_TOPK)
+    else:
+      ind = np.flatnonzero(batch_probs[batch_id] >= cfg.RPN_SCORE_THRESH)
+      ind = ind[np.argsort(-batch_probs[batch_id, ind], kind='stable')][:cfg.RPN_NMS_PRE_TOPK]
+      standup = corner_to_standup_box2d(center_to_corner_box2d(batch_boxes3d[batch_id, ind][:, [0, 1, 4, 5, 6]], coordinate='lidar'))
+      ind = ind[tf.image.non_max_suppression(standup.astype(np.float32), batch_probs[batch_id, ind], cfg.RPN_NMS_POST_TOPK,
+                                             iou_threshold=cfg.RPN_NMS_THRESH).numpy()]
+    ret.append((batch_boxes3d[batch_id, ind], batch_probs[batch_id, ind]))
+  return ret, probs.nbytes + deltas.nbytes
+
+
+def timeit(fn, repeats):
+  start = time.perf_counter()
+  for _ in range(repeats):
+    fn()
+  return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--batch_size", default=2, type=int)
+  parser.add_argument("--score_thresh", default=[cfg.RPN_SCORE_THRESH, 0.99], nargs="*", type=float)
+  parser.add_argument("--repeats", default=5, type=int)
+  args = parser.parse_args()
+
+  params = {"batch_size": args.batch_size, "mode": "eval"}
+  model = Model(cfg, params, tf.distribute.get_strategy())
+  anchors = cal_anchors(cfg)
+  shape = [args.batch_size, cfg.FEATURE_HEIGHT, cfg.FEATURE_WIDTH]
+  p_map = tf.random.uniform(shape + [2], seed=1)
+  r_map = tf.random.normal(shape + [14], stddev=0.3, seed=2)
+
+  nms_paths = [("rotated, host kernel", True, True), ("rotated, in-graph", True, False), ("standup", False, False)]
+  for score_thresh in args.score_thresh:
+    for name, rotated, host in nms_paths:
+      # the settings of cfg are read when tracing
+      cfg.RPN_SCORE_THRESH, cfg.RPN_NMS_ROTATED, cfg.RPN_NMS_HOST = score_thresh, rotated, host
+      detect = tf.function(model.detect)
+      ref, host_bytes = host_detect(p_map, r_map, anchors)
+      boxes3d, scores, num_boxes = [x.numpy() for x in detect(p_map, r_map)]
+      for i, (ref_boxes3d, ref_scores) in enumerate(ref):
+        assert num_boxes[i] == len(ref_scores) and np.array_equal(scores[i, :num_boxes[i]], ref_scores), "{} nms differs".format(name)
+        assert np.allclose(boxes3d[i, :num_boxes[i]], ref_boxes3d, atol=1e-4)
+
+      host_time = timeit(lambda: host_detect(p_map, r_map, anchors), args.repeats)
+      device_time = timeit(lambda: [x.numpy() for x in detect(p_map, r_map)], args.repeats)
+      out = detect(p_map, r_map)
+      print("score threshold {}, {} nms ({} boxes kept): host decode and nms {:.1f} ms ({:.1f} MB copied), detect {:.1f} ms ({:.2f} KB copied), same boxes".format(
+          score_thresh, name, num_boxes.tolist(), host_time, host_bytes / 2**20, device_time, sum(x.numpy().nbytes for x in out) / 2**10))
+
+if __name__ == "__main__":
+  main()
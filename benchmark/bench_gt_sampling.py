@@ -0,0 +1,114 @@
+"""
+  Ground truth object sampling (utils/gt_database.py). Checks the vectorized bird view overlap test
+  against an edge by edge polygon intersection, times it against the pairwise cal_iou2d
+  collision checks of the disabled perturbation branch of aug_data, and times GTSampler.sample per frame.
+
+  Usage (from the repository root):
+    python -m benchmark.bench_gt_sampling --data_root_dir /path/to/astyx --split training
+  A synthetic dataset is written to a temporary directory when --data_root_dir is empty.
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+
+from utils.utils import cal_iou2d, load_label, angle_to_quat
+from utils.gt_database import GTDatabase, GTSampler, label_corners_bev, bev_overlaps, parse_sample_groups
+from benchmark.synthetic_dataset import make_dataset
+
+
+def segments_intersect(p1, p2, q1, q2):
+  def cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+  d1, d2, d3, d4 = cross(q1, q2, p1), cross(q1, q2, p2), cross(p1, p2, q1), cross(p1, p2, q2)
+  return d1 * d2 < 0 and d3 * d4 < 0
+
+
+def inside(point, poly):
+  signs = [np.sign((poly[(i + 1) % 4][0] - poly[i][0]) * (point[1] - poly[i][1]) - (poly[(i + 1) % 4][1] - poly[i][1]) * (point[0] - poly[i][0])) for i in range(4)]
+  return all(s > 0 for s in signs) or all(s < 0 for s in signs)
+
+
+def reference_overlap(a, b):
+  # convex quadrilaterals intersect if two edges cross or one contains a corner of the other
+  for i in range(4):
+    for j in range(4):
+      if segments_intersect(a[i], a[(i + 1) % 4], b[j], b[(j + 1) % 4]):
+        return True
+  return inside(a.mean(0), b) or inside(b.mean(0), a) or any(inside(p, b) for p in a) or any(inside(p, a) for p in b)
+
+
+def random_labels(rng, n):
+  label = np.zeros((n, 11))
+  label[:, 0:2] = rng.uniform([0, -8], [16, 8], (n, 2))
+  label[:, 3:6] = rng.uniform([0.5, 0.5, 1.], [5., 2.5, 2.], (n, 3))
+  label[:, 6:10] = [angle_to_quat(0., 0., yaw) for yaw in rng.uniform(-np.pi, np.pi, n)]
+  label[:, 10] = 1
+  return label
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--data_root_dir", default="", type=str)
+  parser.add_argument("--split", default="training", type=str)
+  parser.add_argument("--gt_database_dir", default="", type=str)
+  parser.add_argument("--num_frames", default=128, type=int)
+  parser.add_argument("--sample_groups", default=["Car:10"], nargs="*", type=str)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  # overlap parity
+  a, b = random_labels(rng, 300), random_labels(rng, 300)
+  overlaps = bev_overlaps(label_corners_bev(a), label_corners_bev(b))
+  ca, cb = label_corners_bev(a), label_corners_bev(b)
+  reference = np.array([[reference_overlap(ca[i], cb[j]) for j in range(len(b))] for i in range(len(a))])
+  assert np.array_equal(overlaps, reference), "bev_overlaps differs from the reference on {} pairs".format(np.sum(overlaps != reference))
+  print("parity: {} box pairs, {} overlapping, bev_overlaps matches the polygon intersection".format(overlaps.size, overlaps.sum()))
+
+  # collision checks of 20 candidates against 10 boxes
+  candidates, boxes = random_labels(rng, 20), random_labels(rng, 10)
+  start = time.perf_counter()
+  for i in range(len(candidates)):
+    for j in range(len(boxes)):
+      cal_iou2d(candidates[i, [0, 1, 3, 4, 6]].astype(np.float32), boxes[j, [0, 1, 3, 4, 6]].astype(np.float32))
+  pairwise = time.perf_counter() - start
+  repeats = 100
+  start = time.perf_counter()
+  for _ in range(repeats):
+    bev_overlaps(label_corners_bev(candidates), label_corners_bev(boxes))
+  vectorized = (time.perf_counter() - start) / repeats
+  print("collision checks, 20 candidates x 10 boxes: pairwise cal_iou2d {:.2f} ms, bev_overlaps {:.3f} ms ({:.0f}x)".format(
+      pairwise * 1e3, vectorized * 1e3, pairwise / vectorized))
+
+  # database and sampler
+  if not args.data_root_dir:
+    args.data_root_dir = tempfile.mkdtemp(prefix="astyx_synth_")
+    make_dataset(args.data_root_dir, args.num_frames, splits=[args.split])
+  args.gt_database_dir = args.gt_database_dir or tempfile.mkdtemp(prefix="gt_database_")
+  split_dir = os.path.join(args.data_root_dir, args.split)
+  tags = sorted(a.split(".")[0] for a in os.listdir(os.path.join(split_dir, "groundtruth_obj3d")) if a.endswith(".json"))
+  database = GTDatabase(args.gt_database_dir, split_dir)
+  start = time.perf_counter()
+  database.build(tags)
+  print("database: {} objects, {} points, built in {:.2f} s".format(len(database), len(database.points), time.perf_counter() - start))
+
+  sampler = GTSampler(database, parse_sample_groups(args.sample_groups))
+  frames = [(load_label(os.path.join(split_dir, "groundtruth_obj3d", tag + ".json")),
+             np.fromfile(os.path.join(split_dir, "radar_6455", tag + ".bin"), dtype=np.float32).reshape(-1, 4)) for tag in tags]
+  start = time.perf_counter()
+  sampled = [sampler.sample(label, lidar, rng) for label, lidar in frames]
+  elapsed = time.perf_counter() - start
+  pasted = 0
+  for (label, _), (new_label, _) in zip(frames, sampled):
+    pasted += len(new_label) - len(label)
+    # a pasted object overlaps nothing but itself
+    collisions = bev_overlaps(label_corners_bev(new_label[len(label):]), label_corners_bev(new_label))
+    collisions[np.arange(len(collisions)), len(label) + np.arange(len(collisions))] = False
+    assert not collisions.any()
+  print("sampling {}: {:.2f} ms per frame, {:.1f} objects pasted per frame".format(
+      " ".join(args.sample_groups), elapsed / len(frames) * 1e3, pasted / len(frames)))
+
+
+if __name__ == "__main__":
+  main()
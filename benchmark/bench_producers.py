@@ -0,0 +1,79 @@
+"""
+  Throughput of the single generator path against the multi-process sample producers of
+  Data_helper (--num_workers) and the native tf.data backend (--input_backend tfdata).
+  Both the unbatched tf.data source of the examples (Data_helper.example_dataset) and the batched
+  iterator are timed, after their first element (the start-up of the workers or of the pipeline is left
+  out). The ratios are to the first row.
+
+  Usage (from the repository root):
+    python -m benchmark.bench_producers --data_root_dir /path/to/astyx --workers 0 2 4 8
+    python -m benchmark.bench_producers --data_root_dir /path/to/astyx --input_backend generator tfdata
+  The sample producers (--workers > 0) always ship sparse rpn targets, --sparse_rpn_targets 1 gives them to
+  the other rows too. A synthetic dataset is written to a temporary directory when --data_root_dir is empty.
+"""
+import argparse
+import tempfile
+import time
+
+from config import cfg
+from data import Data_helper
+from benchmark.synthetic_dataset import make_dataset
+
+
+def time_examples(helper, mode, is_aug_data, n_examples):
+  # the batch iterator started by Data_helper would keep filling its buffers during the timing
+  helper.batch_iter = None
+  examples = helper.example_dataset(cfg, mode, is_aug_data)
+  examples = iter(examples)
+  next(examples) # exclude the start-up
+  t0 = time.perf_counter()
+  n = 0
+  for _ in examples:
+    n += 1
+    if n >= n_examples:
+      break
+  return n / (time.perf_counter() - t0)
+
+
+def time_batches(helper, n_batches):
+  next(helper) # exclude the pipeline start-up
+  t0 = time.perf_counter()
+  for _ in range(n_batches):
+    next(helper)
+  return n_batches / (time.perf_counter() - t0)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--data_root_dir", default="", type=str)
+  parser.add_argument("--mode", default="train", type=str)
+  parser.add_argument("--aug", default=1, type=int)
+  parser.add_argument("--sparse_rpn_targets", default=0, type=int)
+  parser.add_argument("--input_backend", default=["generator"], nargs="+", type=str)
+  parser.add_argument("--workers", default=[0, 2, 4], nargs="+", type=int)
+  parser.add_argument("--batch_size", default=2, type=int)
+  parser.add_argument("--n_examples", default=64, type=int)
+  parser.add_argument("--n_batches", default=20, type=int)
+  args = parser.parse_args()
+
+  if not args.data_root_dir:
+    args.data_root_dir = tempfile.mkdtemp(prefix="astyx_synth_")
+    make_dataset(args.data_root_dir, args.n_examples)
+  cfg.DATA_DIR = args.data_root_dir
+
+  baseline = None
+  for input_backend in args.input_backend:
+    for n_workers in (args.workers if input_backend == "generator" else [0]):
+      params = {"batch_size": args.batch_size, "num_workers": n_workers, "input_backend": input_backend,
+                "sparse_rpn_targets": bool(args.sparse_rpn_targets)}
+      helper = Data_helper(cfg, params, 4, args.mode, is_aug_data=bool(args.aug))
+      examples_per_s = time_examples(helper, args.mode, bool(args.aug), args.n_examples)
+      helper.reset()
+      batches_per_s = time_batches(helper, args.n_batches)
+      baseline = baseline or (examples_per_s, batches_per_s)
+      print("{:9s} workers: {:2d}  examples/s: {:8.2f} ({:4.2f}x)  batches/s: {:8.2f} ({:4.2f}x)".format(
+          input_backend, n_workers, examples_per_s, examples_per_s / baseline[0], batches_per_s, batches_per_s / baseline[1]))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,62 @@
+"""
+  Per-file np.fromfile reads of the radar frames against the memory-mapped shards of utils/radar_pack.py.
+  Checks that every packed frame equals its file, then times a full pass over the split with each
+  reader (the first pass of each reader runs on whatever page cache state the previous one left).
+
+  Usage (from the repository root):
+    python -m benchmark.bench_radar_pack --data_root_dir /path/to/astyx --split training
+  A synthetic dataset is written to a temporary directory when --data_root_dir is empty.
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+
+from utils.radar_pack import RadarPack
+from benchmark.synthetic_dataset import make_dataset
+
+
+def read_file(pc_dir, tag):
+  return np.fromfile("%s/%s.bin" % (pc_dir, tag), dtype=np.float32).reshape(-1, 4)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--data_root_dir", default="", type=str)
+  parser.add_argument("--split", default="training", type=str)
+  parser.add_argument("--pack_dir", default="", type=str)
+  parser.add_argument("--num_frames", default=256, type=int)
+  parser.add_argument("--repeats", default=3, type=int)
+  args = parser.parse_args()
+
+  if not args.data_root_dir:
+    args.data_root_dir = tempfile.mkdtemp(prefix="astyx_synth_")
+    make_dataset(args.data_root_dir, args.num_frames, splits=[args.split])
+  args.pack_dir = args.pack_dir or tempfile.mkdtemp(prefix="radar_pack_")
+  split_dir = os.path.join(args.data_root_dir, args.split)
+  pc_dir = os.path.join(split_dir, "radar_6455")
+  tags = sorted(a.split(".")[0] for a in os.listdir(pc_dir) if a.endswith(".bin"))
+
+  radar_pack = RadarPack(args.pack_dir, split_dir)
+  t0 = time.perf_counter()
+  radar_pack.pack(tags, shard_bytes=64 << 20)
+  print("packed {} frames in {:.2f}s".format(len(tags), time.perf_counter() - t0))
+
+  for tag in tags:
+    assert np.array_equal(radar_pack.get(tag), read_file(pc_dir, tag)), tag
+  print("parity: {} frames identical to the per-file reads".format(len(tags)))
+
+  for name, read in [("per-file np.fromfile", lambda tag: read_file(pc_dir, tag).sum()),
+                     ("mmap radar pack", lambda tag: np.asarray(radar_pack.get(tag)).sum())]:
+    best = float("inf")
+    for _ in range(args.repeats):
+      t0 = time.perf_counter()
+      for tag in tags:
+        read(tag)
+      best = min(best, time.perf_counter() - t0)
+    print("{:22s} {:8.1f} us/frame".format(name, best / len(tags) * 1e6))
+
+
+if __name__ == "__main__":
+  main()
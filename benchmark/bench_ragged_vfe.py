@@ -0,0 +1,156 @@
+"""
+  Parity check and benchmark of RaggedVFE_Block (flat point lists of the voxels, --ragged_vfe) against
+  VFE_Block (padded [B, K, T, 7] feature buffer), with the same weights, on synthetic radar-like frames
+  (sparse clusters, a few points per voxel) voxelized by process_pointcloud and flattened by flatten_voxels.
+  The voxel features of both blocks are compared at inference, and in training, with the moving statistics
+  of the batch normalizations after the step, to a float64 NumPy version of the training VFE_Block (the
+  float32 fused batch normalization of VFE_Block sums its 35 rows per voxel less exactly), then the memory of the input buffers and of the
+  largest activation, the multiply-adds of the dense layers and the times of the compiled blocks are
+  reported.
+
+  Usage (from the repository root):
+    python -m benchmark.bench_ragged_vfe --num_points 500 2000 --batch_size 2
+"""
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from config import cfg
+from model import VFE_Block, RaggedVFE_Block
+from utils.utils import process_pointcloud, flatten_voxels
+
+
+def radar_frame(rng, n_points):
+  # clusters of a few returns around random centers, the intensity in the 4th column
+  centers = rng.uniform([cfg.X_MIN, cfg.Y_MIN, cfg.Z_MIN], [cfg.X_MAX, cfg.Y_MAX, cfg.Z_MAX], (n_points//3, 3))
+  points = centers[rng.randint(len(centers), size=n_points)] + rng.normal(0., 0.1, (n_points, 3))
+  return np.concatenate([points, rng.uniform(0, 50, (n_points, 1))], axis=1).astype(np.float32)
+
+
+def batches(voxels):
+  # the two batch layouts of Data_helper, the voxel k of a frame scattered to the cell k+1 of a flat grid
+  # (the padding voxels of the batch go to the cell 0, like the origin of the frame for the real grid)
+  B, K = len(voxels), max(len(v["number_buffer"]) for v in voxels)
+  T = cfg.MAX_POINT_NUMBER
+  flats = [flatten_voxels(v) for v in voxels]
+  P = max(len(f["point_voxel"]) for f in flats)
+  feature_buffer = np.zeros((B, K, T, 7), dtype=np.float32)
+  point_features, point_voxel = np.zeros((B, P, 7), dtype=np.float32), -np.ones((B, P), dtype=np.int32)
+  coordinate_buffer = np.zeros((B, K, 4), dtype=np.int32)
+  for b, (v, f) in enumerate(zip(voxels, flats)):
+    k, p = len(v["number_buffer"]), len(f["point_voxel"])
+    feature_buffer[b, :k] = v["feature_buffer"]
+    point_features[b, :p], point_voxel[b, :p] = f["point_features"], f["point_voxel"]
+    coordinate_buffer[b, :, 0] = b
+    coordinate_buffer[b, :k, 3] = np.arange(1, k + 1)
+  return feature_buffer, (point_features, point_voxel), coordinate_buffer, [B, 1, 1, K + 1, cfg.VFE_FINAl_OUT_DIM]
+
+
+def reference_training(block, feature_buffer):
+  # float64 training forward of VFE_Block : the voxel features [B, K, final_dim] and the moving statistics
+  # of the batch normalizations after the step
+  x = feature_buffer.astype(np.float64)
+  mask = x.max(axis=-1, keepdims=True) != 0
+  moving = []
+  for vfe in block.VFEs:
+    kernel, bias = [weight.numpy().astype(np.float64) for weight in vfe.fcn.weights]
+    fcn_out = np.maximum(x @ kernel + bias, 0)
+    mean, variance, n = fcn_out.mean(axis=(0, 1, 2)), fcn_out.var(axis=(0, 1, 2)), fcn_out[..., 0].size
+    fcn_out = (fcn_out - mean) / np.sqrt(variance + vfe.bn.epsilon) * vfe.bn.gamma.numpy() + vfe.bn.beta.numpy()
+    x = np.concatenate([fcn_out, np.broadcast_to(fcn_out.max(axis=2, keepdims=True), fcn_out.shape)], axis=-1) * mask
+    moving += [vfe.bn.moving_mean.numpy() * vfe.bn.momentum + mean * (1 - vfe.bn.momentum),
+               vfe.bn.moving_variance.numpy() * vfe.bn.momentum + variance * n / (n - 1) * (1 - vfe.bn.momentum)]
+  kernel, bias = [weight.numpy().astype(np.float64) for weight in block.final_fcn.weights]
+  return np.maximum(x @ kernel + bias, 0).max(axis=2), moving
+
+
+def voxel_features(output):
+  # [B, K, final_dim] features in the cells 1 to K of the output of the blocks, the voxels of the frames
+  return output[:, :, 0, 0, 1:].transpose(0, 2, 1)
+
+
+def moving_statistics(block):
+  return [weight for vfe in block.VFEs for weight in (vfe.bn.moving_mean.numpy(), vfe.bn.moving_variance.numpy())]
+
+
+def relative_error(expected, value):
+  return np.abs(expected - value).max() / max(np.abs(expected).max(), 1e-12)
+
+
+def dense_macs(rows):
+  # multiply-adds of the dense layers of the block on rows rows
+  dims, macs = [7] + list(cfg.VFE_OUT_DIMS), 0
+  for c_in, c_out in zip(dims[:-1], dims[1:]):
+    macs += c_in * c_out // 2
+  return rows * (macs + dims[-1] * cfg.VFE_FINAl_OUT_DIM)
+
+
+def timeit(fn, repeats):
+  fn()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    fn().numpy()
+  return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--num_points", default=[500, 2000], nargs="*", type=int)
+  parser.add_argument("--batch_size", default=2, type=int)
+  parser.add_argument("--repeats", default=5, type=int)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  dense = VFE_Block(cfg.VFE_OUT_DIMS, cfg.VFE_FINAl_OUT_DIM, cfg.GRID_SIZE)
+  ragged = RaggedVFE_Block(cfg.VFE_OUT_DIMS, cfg.VFE_FINAl_OUT_DIM, cfg.GRID_SIZE, cfg.MAX_POINT_NUMBER)
+  for n_points in args.num_points:
+    voxels = [process_pointcloud(radar_frame(rng, n_points), cfg) for _ in range(args.batch_size)]
+    feature_buffer, points, coordinate_buffer, shape = batches(voxels)
+    feature_buffer, coordinate_buffer = tf.constant(feature_buffer), tf.constant(coordinate_buffer)
+    points = tuple(tf.constant(value) for value in points)
+
+    if not dense.built:
+      dense(feature_buffer, coordinate_buffer, shape)
+      ragged(points, coordinate_buffer, shape)
+      # random weights and moving statistics, the same in both blocks
+      for weight in dense.weights:
+        low = 0.5 if "moving_variance" in weight.name else -1.
+        weight.assign(rng.uniform(low, 1., weight.shape))
+    # the training runs below update the moving statistics
+    ragged.set_weights(dense.get_weights())
+
+    run_dense = tf.function(lambda training: dense(feature_buffer, coordinate_buffer, shape, training=training))
+    run_ragged = tf.function(lambda training: ragged(points, coordinate_buffer, shape, training=training))
+    out_dense, out_ragged = run_dense(False).numpy(), run_ragged(False).numpy()
+    error = relative_error(out_dense, out_ragged)
+    # training : the batch statistics, then the moving statistics updated by the step
+    expected, expected_moving = reference_training(dense, feature_buffer.numpy())
+    for b, v in enumerate(voxels):
+      # the voxels padding the batch count in the statistics but are scattered to the cell 0
+      expected[b, len(v["number_buffer"]):] = 0
+    train_errors = [relative_error(expected, voxel_features(run(True).numpy())) for run in (run_dense, run_ragged)]
+    moving_errors = [max(relative_error(a, b) for a, b in zip(expected_moving, moving_statistics(block))) for block in (dense, ragged)]
+
+    B, K, T = feature_buffer.shape[:3]
+    rows = int(np.count_nonzero(points[1].numpy() >= 0))
+    n_real = sum(int(v["number_buffer"].sum()) for v in voxels)
+    print("{} frames x {} points: {} voxels, {:.2f} points per voxel, {} rows ({} points)".format(
+        B, n_points, sum(len(v["number_buffer"]) for v in voxels), n_real / sum(len(v["number_buffer"]) for v in voxels), rows, n_real))
+    print("  max relative difference {:.1e} at inference ; in training, to the float64 reference, {:.1e} dense, {:.1e} flat, moving statistics {:.1e} dense, {:.1e} flat".format(
+        error, *train_errors, *moving_errors))
+    assert error < 1e-5, "ragged vfe differs from the dense vfe"
+    assert train_errors[1] < 1e-4 and moving_errors[1] < 1e-4, "ragged vfe differs from the dense vfe in training"
+
+    widest = max(list(cfg.VFE_OUT_DIMS) + [cfg.VFE_FINAl_OUT_DIM])
+    print("  input buffer {:.2f} MB dense, {:.2f} MB flat ; largest activation {:.2f} MB dense, {:.2f} MB flat".format(
+        feature_buffer.numpy().nbytes / 2**20, sum(value.numpy().nbytes for value in points) / 2**20,
+        B*K*T*widest*4 / 2**20, rows*widest*4 / 2**20))
+    print("  dense layers {:.1f} MMAC dense, {:.1f} MMAC flat ({:.0f}x)".format(
+        dense_macs(B*K*T) / 1e6, dense_macs(rows) / 1e6, B*K*T / rows))
+    print("  inference {:.1f} ms dense, {:.1f} ms flat ; training forward {:.1f} ms dense, {:.1f} ms flat".format(
+        timeit(lambda: run_dense(False), args.repeats), timeit(lambda: run_ragged(False), args.repeats),
+        timeit(lambda: run_dense(True), args.repeats), timeit(lambda: run_ragged(True), args.repeats)))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,103 @@
+"""
+  Rotated box iou (utils/rotated_iou.py). Checks the polygon clipping iou against known values and
+  against a fine rasterization (5 mm pixels), reports the error of the former rasterization of cal_iou2d
+  at the resolution of the input map (with its degenerate corners), and times cal_box3d_iou (bird view and 3d) against the former
+  pairwise rasterized loops.
+
+  Usage (from the repository root):
+    python -m benchmark.bench_rotated_iou --num_boxes 10 100 --num_pairs 200
+"""
+import argparse
+import time
+import numpy as np
+import cv2
+
+from config import cfg
+from utils.utils import cal_box3d_iou, center_to_corner_box2d, batch_lidar_to_bird_view
+from utils.rotated_iou import iou_bev, iou_3d, box2d_corners
+
+
+def rasterized_iou2d(box1, box2, resolution=None):
+  # former cal_iou2d : both boxes filled on a map of the input size, at the voxel resolution by default.
+  # Its corners come from center_to_corner_box2d, which reads w l r as h w l : the boxes were filled as
+  # segments of length w
+  if resolution is None:
+    tmp = center_to_corner_box2d(np.array([box1, box2]), coordinate='lidar')
+    masks = [cv2.fillConvexPoly(np.zeros((cfg.INPUT_HEIGHT, cfg.INPUT_WIDTH, 3)), batch_lidar_to_bird_view(c).astype(np.int32), color=(1, 1, 1))[..., 0]
+             for c in tmp]
+    indiv = np.sum(np.absolute(masks[0] - masks[1]))
+    share = np.sum((masks[0] + masks[1]) == 2)
+    return 0.0 if indiv == 0 else share / (indiv + share)
+  # fine rasterization on a local window, with sub-pixel vertices
+  corners = box2d_corners(np.array([box1, box2]))
+  low, high = corners.reshape(-1, 2).min(0) - 1, corners.reshape(-1, 2).max(0) + 1
+  w, h = ((high - low) / resolution).astype(int) + 1
+  masks = [cv2.fillPoly(np.zeros((h, w), np.uint8), [np.round((c - low) / resolution * 16).astype(np.int32)], 1, shift=4) for c in corners]
+  share = np.sum(masks[0] & masks[1])
+  return share / (masks[0].sum() + masks[1].sum() - share)
+
+
+def former_box3d_iou(boxes3d, gt_boxes3d):
+  output = np.zeros((len(boxes3d), len(gt_boxes3d)), dtype=np.float32)
+  for idx in range(len(boxes3d)):
+    for idy in range(len(gt_boxes3d)):
+      output[idx, idy] = rasterized_iou2d(boxes3d[idx, [0, 1, 4, 5, 6]], gt_boxes3d[idy, [0, 1, 4, 5, 6]])
+  return output
+
+
+def random_boxes3d(rng, n, center_range=20.):
+  boxes = np.zeros((n, 7))
+  boxes[:, 0:2] = rng.uniform([cfg.X_MIN + 10, -center_range / 2], [cfg.X_MIN + 10 + center_range, center_range / 2], (n, 2))
+  boxes[:, 2] = rng.uniform(-1.5, -0.5, n)
+  boxes[:, 3:6] = rng.uniform([1.4, 1.5, 3.5], [2., 2.5, 5.5], (n, 3))
+  boxes[:, 6] = rng.uniform(-np.pi, np.pi, n)
+  return boxes
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--num_boxes", default=[10, 100], nargs="*", type=int)
+  parser.add_argument("--num_pairs", default=200, type=int)
+  args = parser.parse_args()
+  rng = np.random.RandomState(0)
+
+  # known values : same box, same box turned by 90 degrees with swapped sides, half overlap, square and
+  # the same square turned by 45 degrees, disjoint boxes, flat box
+  box = np.array([[0, 0, 2, 4, 0]])
+  expected = [1., 1., 1. / 3, np.sqrt(2) / 2, 0., 0.]
+  values = np.concatenate([iou_bev(box, [[0, 0, 2, 4, 0], [0, 0, 4, 2, np.pi / 2], [1, 0, 2, 4, 0]]),
+                           iou_bev([[0, 0, 2, 2, 0]], [[0, 0, 2, 2, np.pi / 4]]),
+                           iou_bev(box, [[5, 5, 1, 1, 0], [0, 0, 0, 4, 0]])], axis=1)[0]
+  assert np.allclose(values, expected), values
+  box3d = np.array([[0, 0, 0, 2, 2, 4, 0]])
+  assert np.allclose(iou_3d(box3d, [[0, 0, 1, 2, 2, 4, 0], [0, 0, 0, 1, 2, 4, 0]]), [[1. / 3, 0.5]])
+
+  # accuracy on overlapping pairs
+  errors, former_errors = [], []
+  for _ in range(args.num_pairs):
+    a, b = random_boxes3d(rng, 2, 3.)[:, [0, 1, 4, 5, 6]]
+    exact = iou_bev(a, b)[0, 0]
+    errors.append(abs(exact - rasterized_iou2d(a, b, resolution=0.005)))
+    former_errors.append(abs(exact - rasterized_iou2d(a, b)))
+  print("accuracy on {} pairs: max |iou - 5 mm rasterization| {:.4f}, max |iou - former cal_iou2d ({} m pixels)| {:.4f}".format(
+      args.num_pairs, max(errors), cfg.VOXEL_X_SIZE, max(former_errors)))
+
+  for n in args.num_boxes:
+    boxes, gt_boxes = random_boxes3d(rng, n), random_boxes3d(rng, n)
+    start = time.perf_counter()
+    bev = cal_box3d_iou(boxes, gt_boxes)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    cal_box3d_iou(boxes, gt_boxes, cal_3d=1)
+    elapsed_3d = time.perf_counter() - start
+    # the former loops take ~10 ms per pair, timed on 10 x 10 boxes at most
+    m = min(n, 10)
+    start = time.perf_counter()
+    former_box3d_iou(boxes[:m], gt_boxes[:m])
+    former_per_pair = (time.perf_counter() - start) / (m * m)
+    print("{} x {} boxes, {} overlapping pairs: cal_box3d_iou bev {:.2f} ms, 3d {:.2f} ms, former rasterized loops {:.0f} ms ({:.0f}x)".format(
+        n, n, np.sum(bev > 0), elapsed * 1e3, elapsed_3d * 1e3, former_per_pair * n * n * 1e3, former_per_pair * n * n / elapsed))
+
+
+if __name__ == "__main__":
+  main()
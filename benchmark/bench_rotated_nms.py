@@ -0,0 +1,95 @@
+"""
+  Parity check and benchmark of the rotated nms (utils/rotated_iou.py) : the Cython kernel (rotated_nms)
+  and the TF variant (rotated_nms_tf, compiled with tf.function) against a NumPy greedy loop on the full
+  rotated iou matrix, with the standup nms of tf.image.non_max_suppression for reference, on clusters of
+  jittered candidates around synthetic objects (as the rpn outputs around every object).
+
+  Usage (from the repository root):
+    python -m benchmark.bench_rotated_nms --num_candidates 100 500 1000 2000 --num_objects 20
+"""
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from config import cfg
+from utils.utils import center_to_corner_box2d, corner_to_standup_box2d
+from utils.rotated_iou import iou_bev, rotated_nms, rotated_nms_tf
+
+
+def synthetic_candidates(rng, n_candidates, n_objects):
+  centers = rng.uniform([cfg.X_MIN, cfg.Y_MIN], [cfg.X_MAX, cfg.Y_MAX], (n_objects, 2))
+  yaws = rng.uniform(-np.pi, np.pi, n_objects)
+  objects = rng.randint(0, n_objects, n_candidates)
+  boxes2d = np.zeros((n_candidates, 5))
+  boxes2d[:, 0:2] = centers[objects] + rng.normal(0, 0.4, (n_candidates, 2))
+  boxes2d[:, 2] = rng.uniform(1.5, 2.0, n_candidates)
+  boxes2d[:, 3] = rng.uniform(3.5, 4.5, n_candidates)
+  boxes2d[:, 4] = yaws[objects] + rng.normal(0, 0.15, n_candidates)
+  return boxes2d, rng.uniform(size=n_candidates)
+
+
+def reference_nms(boxes2d, scores, iou_threshold, max_output_size, score_threshold, pre_topk):
+  candidates = np.flatnonzero(scores >= score_threshold)
+  order = candidates[np.argsort(-scores[candidates], kind='stable')]
+  if pre_topk:
+    order = order[:pre_topk]
+  overlaps = iou_bev(boxes2d[order], boxes2d[order]) > iou_threshold
+  suppressed = np.zeros((len(order)), dtype=bool)
+  keep = []
+  for i in range(len(order)):
+    if len(keep) >= max_output_size:
+      break
+    if suppressed[i]:
+      continue
+    keep.append(i)
+    suppressed |= overlaps[i]
+  return order[keep]
+
+
+def timeit(fn, repeats):
+  # one warm up call (tf.function tracing)
+  fn()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    fn()
+  return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--num_candidates", default=[100, 500, 1000, 2000], nargs="*", type=int)
+  parser.add_argument("--num_objects", default=20, type=int)
+  parser.add_argument("--threads", default=[1, 0], nargs="*", type=int, help="0 is the OpenMP default")
+  parser.add_argument("--repeats", default=5, type=int)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  settings = [(cfg.RPN_NMS_THRESH, cfg.RPN_NMS_POST_TOPK, 0., 0), (0.5, 100, 0.3, 0), (cfg.RPN_NMS_THRESH, cfg.RPN_NMS_POST_TOPK, 0., 500)]
+  nms_tf = tf.function(rotated_nms_tf, reduce_retracing=True)
+
+  for n_candidates in args.num_candidates:
+    boxes2d, scores = synthetic_candidates(rng, n_candidates, args.num_objects)
+    boxes2d_tf, scores_tf = tf.constant(boxes2d.astype(np.float32)), tf.constant(scores.astype(np.float32))
+    for iou_threshold, max_output_size, score_threshold, pre_topk in settings:
+      ref = reference_nms(boxes2d, scores, iou_threshold, max_output_size, score_threshold, pre_topk)
+      out = rotated_nms(boxes2d, scores, iou_threshold, max_output_size, score_threshold=score_threshold, pre_topk=pre_topk)
+      assert np.array_equal(ref, out), "rotated_nms differs with {} candidates".format(n_candidates)
+      out = nms_tf(boxes2d_tf, scores_tf, iou_threshold, max_output_size, score_threshold=score_threshold, pre_topk=pre_topk)
+      assert np.array_equal(ref, out.numpy()), "rotated_nms_tf differs with {} candidates".format(n_candidates)
+
+    args_nms = (cfg.RPN_NMS_THRESH, cfg.RPN_NMS_POST_TOPK)
+    timings = ["numpy iou matrix {:.1f} ms".format(timeit(lambda: reference_nms(boxes2d, scores, *args_nms, 0., 0), args.repeats))]
+    for threads in args.threads:
+      timings.append("rotated_nms ({} threads) {:.2f} ms".format(threads or "default", timeit(
+          lambda: rotated_nms(boxes2d, scores, *args_nms, num_threads=threads), args.repeats)))
+    timings.append("rotated_nms_tf {:.1f} ms".format(timeit(lambda: nms_tf(boxes2d_tf, scores_tf, *args_nms).numpy(), args.repeats)))
+    standup = corner_to_standup_box2d(center_to_corner_box2d(boxes2d, coordinate='lidar')).astype(np.float32)
+    timings.append("standup tf.image nms {:.2f} ms".format(timeit(
+        lambda: tf.image.non_max_suppression(standup, scores_tf, cfg.RPN_NMS_POST_TOPK, cfg.RPN_NMS_THRESH).numpy(), args.repeats)))
+    kept = len(rotated_nms(boxes2d, scores, *args_nms))
+    print("{} candidates around {} objects ({} kept): {}, identical selections".format(
+        n_candidates, args.num_objects, kept, ", ".join(timings)))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,91 @@
+"""
+  Parity check and benchmark of the batched RpnTargetAssigner (utils/target_assigner.py), with its dense
+  and grid window matchers, against cal_rpn_target called frame by frame, on synthetic frames with many
+  objects (some of them across or beyond the borders of the map). The in-graph assignment (assign_tf,
+  compiled with tf.function) is checked against the same maps, with the bytes of a batch it saves.
+
+  Usage (from the repository root):
+    python -m benchmark.bench_rpn_target --num_objects 5 20 50 --num_frames 16
+"""
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from config import cfg
+from utils.utils import cal_anchors, cal_rpn_target, angle_to_quat, get_class_id
+from utils.target_assigner import RpnTargetAssigner
+
+
+def synthetic_labels(rng, n_objects):
+  label = np.zeros((n_objects, 11))
+  label[:, 0:3] = rng.uniform([cfg.X_MIN - 5, cfg.Y_MIN - 5, -2], [cfg.X_MAX + 5, cfg.Y_MAX + 5, 0], (n_objects, 3))
+  label[:, 3:6] = rng.uniform([3.5, 1.5, 1.4], [12., 3., 3.5], (n_objects, 3))
+  label[:, 6:10] = np.array([angle_to_quat(0., 0., yaw) for yaw in rng.uniform(-np.pi, np.pi, n_objects)]).reshape(-1, 4)
+  # mostly objects of the detected class
+  label[:, 10] = np.where(rng.uniform(size=n_objects) < 0.8, get_class_id(cfg.DETECT_OBJECT), get_class_id("Truck"))
+  return label
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--num_objects", default=[5, 20, 50], nargs="*", type=int)
+  parser.add_argument("--num_frames", default=16, type=int)
+  parser.add_argument("--repeats", default=3, type=int)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  anchors = cal_anchors(cfg)
+  start = time.perf_counter()
+  assigners = {matcher: RpnTargetAssigner(cfg, anchors, matcher=matcher) for matcher in ["dense", "grid"]}
+  print("assigner setup (anchor standup boxes and diagonals): {:.1f} ms, once per Data_helper".format((time.perf_counter() - start) * 1e3 / 2))
+  assert assigners["grid"].matcher == "grid"
+
+  for n_objects in args.num_objects:
+    labels = [synthetic_labels(rng, n_objects) for _ in range(args.num_frames)]
+
+    reference = [cal_rpn_target(label[np.newaxis, ...], cfg.MAP_SHAPE, anchors, cfg.DETECT_OBJECT, 'lidar') for label in labels]
+    for matcher, assigner in assigners.items():
+      batched = assigner.dense(labels)
+      for i in range(len(labels)):
+        for ref, out in zip(reference[i], batched):
+          assert np.array_equal(ref[0], out[i]), "{} rpn targets differ on frame {} with {} objects".format(matcher, i, n_objects)
+
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+      for label in labels:
+        cal_rpn_target(label[np.newaxis, ...], cfg.MAP_SHAPE, anchors, cfg.DETECT_OBJECT, 'lidar')
+    timings = ["cal_rpn_target {:.1f} ms".format((time.perf_counter() - start) / args.repeats * 1e3)]
+    for matcher, assigner in assigners.items():
+      start = time.perf_counter()
+      for _ in range(args.repeats):
+        assigner.assign(labels)
+      batch = (time.perf_counter() - start) / args.repeats
+      start = time.perf_counter()
+      for _ in range(args.repeats):
+        assigner.dense(labels)
+      timings.append("{} assign {:.1f} ms (dense maps {:.1f} ms)".format(matcher, batch * 1e3, (time.perf_counter() - start) / args.repeats * 1e3))
+
+    # in-graph assignment on the padded boxes of the batch
+    assigner = assigners["dense"]
+    boxes = [assigner.gt_boxes(label) for label in labels]
+    gt_boxes = np.zeros((len(boxes), max([1] + [len(b) for b in boxes]), 7))
+    for i, b in enumerate(boxes):
+      gt_boxes[i, :len(b)] = b
+    gt_boxes, num_gt_boxes = tf.constant(gt_boxes), tf.constant([len(b) for b in boxes], dtype=tf.int32)
+    assign_tf = tf.function(assigner.assign_tf)
+    maps = assign_tf(gt_boxes, num_gt_boxes)
+    for key, ref in zip(["pos_equal_one", "neg_equal_one", "targets"], assigner.dense(labels)):
+      assert np.array_equal(maps[key].numpy(), ref), "in-graph {} differs with {} objects".format(key, n_objects)
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+      maps = assign_tf(gt_boxes, num_gt_boxes)
+      maps["targets"].numpy()
+    timings.append("in-graph assign_tf {:.1f} ms".format((time.perf_counter() - start) / args.repeats * 1e3))
+    shipped = sum(int(np.prod(maps[key].shape)) * 4 for key in maps)
+    print("{} frames x {} objects: {}, identical maps".format(args.num_frames, n_objects, ", ".join(timings)))
+    print("  batch target fields: {:.1f} MB of dense maps, {:.1f} KB of padded gt boxes".format(
+        shipped / 2**20, (gt_boxes.numpy().nbytes + num_gt_boxes.numpy().nbytes) / 2**10))
+
+if __name__ == "__main__":
+  main()
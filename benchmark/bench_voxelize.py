@@ -0,0 +1,96 @@
+"""
+  Parity check and benchmark of the vectorized process_pointcloud against the
+  original per-point loop on large synthetic clouds.
+
+  Usage (from the repository root):
+    python -m benchmark.bench_voxelize --num_points 20000 100000 500000
+"""
+import argparse
+import time
+import numpy as np
+
+from config import cfg
+from utils.utils import process_pointcloud
+
+
+def process_pointcloud_loop(point_cloud, cfg):
+  # reference implementation: the original dict + per-point loop voxelizer
+  voxel_size = np.array(cfg.VOXEL_SIZE, dtype=np.float32)
+  grid_size = np.array(cfg.GRID_SIZE, dtype=np.int64)
+  lidar_coord = np.array(cfg.LIDAR_COORD, dtype=np.float32)
+  T = cfg.MAX_POINT_NUMBER
+
+  shifted_coord = point_cloud[:, :3] + lidar_coord
+  voxel_index = np.floor(shifted_coord[:, ::-1] / voxel_size).astype(np.int64)
+  bound_box = np.all((voxel_index >= 0) & (voxel_index < grid_size), axis=1)
+  point_cloud = point_cloud[bound_box]
+  voxel_index = voxel_index[bound_box]
+
+  coordinate_buffer = np.unique(voxel_index, axis=0)
+  K = len(coordinate_buffer)
+  number_buffer = np.zeros(shape=(K), dtype=np.int64)
+  feature_buffer = np.zeros(shape=(K, T, 7), dtype=np.float32)
+  index_buffer = {}
+  for i in range(K):
+    index_buffer[tuple(coordinate_buffer[i])] = i
+  for voxel, point in zip(voxel_index, point_cloud):
+    index = index_buffer[tuple(voxel)]
+    number = number_buffer[index]
+    if number < T:
+      feature_buffer[index, number, :4] = point
+      number_buffer[index] += 1
+  feature_buffer[:, :, -3:] = feature_buffer[:, :, :3] - \
+      feature_buffer[:, :, :3].sum(axis=1, keepdims=True)/number_buffer.reshape(K, 1, 1)
+  return {'feature_buffer': feature_buffer,
+          'coordinate_buffer': coordinate_buffer,
+          'number_buffer': number_buffer}
+
+
+def synthetic_cloud(num_points, rng):
+  # half of the points are spread over the scene, the other half is packed in a few
+  # dense clusters so that the per-voxel T cap is exercised
+  n_uniform = num_points // 2
+  low = np.array([cfg.X_MIN - 2, cfg.Y_MIN - 2, cfg.Z_MIN - 0.5])
+  high = np.array([cfg.X_MAX + 2, cfg.Y_MAX + 2, cfg.Z_MAX + 0.5])
+  uniform = rng.uniform(low, high, size=(n_uniform, 3))
+  centers = rng.uniform(low + 5, high - 5, size=(16, 3))
+  clustered = centers[rng.randint(0, 16, num_points - n_uniform)] + rng.normal(scale=0.15, size=(num_points - n_uniform, 3))
+  xyz = np.concatenate([uniform, clustered], axis=0)
+  intensity = rng.uniform(0, 1, size=(num_points, 1))
+  return np.concatenate([xyz, intensity], axis=1).astype(np.float32)
+
+
+def check_parity(a, b):
+  assert np.array_equal(a["coordinate_buffer"], b["coordinate_buffer"]), "coordinate_buffer mismatch"
+  assert np.array_equal(a["number_buffer"], b["number_buffer"]), "number_buffer mismatch"
+  assert np.array_equal(a["feature_buffer"], b["feature_buffer"]), "feature_buffer mismatch"
+
+
+def timeit(fn, repeat):
+  best = float("inf")
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    fn()
+    best = min(best, time.perf_counter() - t0)
+  return best
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--num_points", default=[20000, 100000, 500000], nargs="+", type=int)
+  parser.add_argument("--repeat", default=3, type=int)
+  parser.add_argument("--seed", default=0, type=int)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(args.seed)
+  for n in args.num_points:
+    pc = synthetic_cloud(n, rng)
+    check_parity(process_pointcloud(pc.copy(), cfg), process_pointcloud_loop(pc.copy(), cfg))
+    t_loop = timeit(lambda: process_pointcloud_loop(pc, cfg), args.repeat)
+    t_vec = timeit(lambda: process_pointcloud(pc, cfg), args.repeat)
+    print("N={:>8d}  loop: {:8.2f} ms  vectorized: {:8.2f} ms  speedup: {:6.1f}x  (parity ok)".format(
+        n, 1e3 * t_loop, 1e3 * t_vec, t_loop / t_vec))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,70 @@
+"""
+  Writes a small synthetic dataset with the Astyx layout (radar_6455, groundtruth_obj3d,
+  calibration, camera_front) so the input pipeline benchmarks can run without the real data.
+
+  Usage (from the repository root):
+    python -m benchmark.synthetic_dataset --data_root_dir /tmp/astyx_synth --num_frames 64
+"""
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+
+from config import cfg
+
+SPLITS = ["training", "validation", "testing"]
+CLASSES = ["Car", "Car", "Car", "Truck", "Person"]
+
+
+def write_frame(split_dir, tag, rng, max_objects=8, img=None):
+  n_points = rng.randint(500, 3000)
+  low, high = [cfg.X_MIN, cfg.Y_MIN, cfg.Z_MIN], [cfg.X_MAX, cfg.Y_MAX, cfg.Z_MAX]
+  clouds = [np.concatenate([rng.uniform(low, high, (n_points, 3)), rng.uniform(0, 50, (n_points, 1))], axis=1)]
+  objects = []
+  for _ in range(rng.randint(1, max_objects)):
+    yaw = rng.uniform(-np.pi, np.pi)
+    center = [rng.uniform(5, cfg.X_MAX - 10), rng.uniform(cfg.Y_MIN + 10, cfg.Y_MAX - 10), rng.uniform(-2, 0)]
+    objects.append({"center3d": center,
+                    "dimension3d": [rng.uniform(3.5, 4.5), rng.uniform(1.5, 2.), rng.uniform(1.4, 1.7)],
+                    "orientation_quat": [np.cos(yaw/2), 0., 0., np.sin(yaw/2)],
+                    "classname": CLASSES[rng.randint(len(CLASSES))]})
+    # radar returns on the object
+    clouds.append(np.concatenate([center + rng.normal(scale=0.5, size=(30, 3)), rng.uniform(0, 50, (30, 1))], axis=1))
+  np.concatenate(clouds, axis=0).astype(np.float32).tofile(os.path.join(split_dir, "radar_6455", tag + ".bin"))
+
+  with open(os.path.join(split_dir, "groundtruth_obj3d", tag + ".json"), "w") as f:
+    json.dump({"objects": objects}, f)
+  eye = np.eye(4).tolist()
+  K = [[1000., 0., cfg.IMG_WIDTH/2], [0., 1000., cfg.IMG_HEIGHT/2], [0., 0., 1.]]
+  with open(os.path.join(split_dir, "calibration", tag + ".json"), "w") as f:
+    json.dump({"sensors": [{"calib_data": {"T_to_ref_COS": eye}},
+                           {"calib_data": {"T_to_ref_COS": eye}},
+                           {"calib_data": {"T_to_ref_COS": eye, "K": K}}]}, f)
+  if img is not None:
+    cv2.imwrite(os.path.join(split_dir, "camera_front", tag + ".jpg"), img)
+
+
+def make_dataset(data_root_dir, num_frames, seed=0, splits=SPLITS):
+  rng = np.random.RandomState(seed)
+  img = rng.randint(0, 255, (cfg.IMG_HEIGHT, cfg.IMG_WIDTH, cfg.IMG_CHANNEL)).astype(np.uint8)
+  for split in splits:
+    split_dir = os.path.join(data_root_dir, split)
+    for d in ["radar_6455", "groundtruth_obj3d", "calibration", "camera_front"]:
+      os.makedirs(os.path.join(split_dir, d), exist_ok=True)
+    for i in range(num_frames):
+      write_frame(split_dir, "%06d" % i, rng, img=img)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--data_root_dir", required=True, type=str)
+  parser.add_argument("--num_frames", default=64, type=int)
+  parser.add_argument("--seed", default=0, type=int)
+  args = parser.parse_args()
+  make_dataset(args.data_root_dir, args.num_frames, args.seed)
+  print("synthetic dataset written to {}".format(args.data_root_dir))
+
+
+if __name__ == "__main__":
+  main()
@@ -127,6 +127,13 @@ if __cfg__.DETECT_OBJECT == 'Cyclist':
 __cfg__.RPN_NMS_POST_TOPK = 20
 __cfg__.RPN_NMS_THRESH = 0.1
 __cfg__.RPN_SCORE_THRESH = 0.96
+# nms on the rotated bird view boxes (utils/rotated_iou.rotated_nms), or on their standup boxes
+__cfg__.RPN_NMS_ROTATED = True
+# rotated nms of the predict step on the host with the Cython kernel (utils/rotated_iou.rotated_nms_frames,
+# through tf.numpy_function), or in the graph (rotated_nms_sorted_tf), slower on CPU
+__cfg__.RPN_NMS_HOST = True
+# max number of candidates of the nms, by decreasing score (all of them if 0)
+__cfg__.RPN_NMS_PRE_TOPK = 1000
 
 
 __cfg__.CORNER2CENTER_AVG = True  # average version or max version
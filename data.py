@@ -1,14 +1,24 @@
-from utils.utils import cal_anchors, process_pointcloud, cal_rpn_target, load_calib, load_label
+from utils.utils import cal_anchors, process_pointcloud, cap_voxels, flatten_voxels, sparse_to_dense_rpn_target, load_calib, load_label
 import tensorflow as tf
 import glob
 import random
 import numpy as np
 import time
-from queue import Queue
-from threading import Thread
+import queue
+import multiprocessing
+import traceback
+import itertools
 import threading
 import os
 from utils.aug_data import aug_data
+from utils.voxel_cache import VoxelCache
+from utils.label_index import LabelIndex
+from utils.manifest import SplitManifest
+from utils.radar_pack import RadarPack
+from utils.gt_database import GTDatabase, GTSampler, parse_sample_groups
+from utils.example_memo import ExampleMemo
+from utils.target_store import RpnTargetStore, sparse_to_dense_rpn_target_tf
+from utils.target_assigner import RpnTargetAssigner
 
 class thread_safe_generator(object):
   def __init__(self, gen):
@@ -26,10 +36,16 @@ class Data_helper:
     self.params = params
     self.mode = mode
     data_d = "training" if mode == "train" else "testing" if mode =="test" else "validation"
-    if mode != "test":
-      label_tags = [os.path.basename(a).split(".")[0] for a in glob.glob(os.path.join(cfg.DATA_DIR, data_d, "groundtruth_obj3d/*.json"))]
-    img_tags = [os.path.basename(a).split(".")[0] for a in glob.glob(os.path.join(cfg.DATA_DIR, data_d, "camera_front/*.jpg"))]
-    lidar_tags = [os.path.basename(a).split(".")[0] for a in glob.glob(os.path.join(cfg.DATA_DIR, data_d, "radar_6455/*.bin"))]
+    # the cached manifest of the split replaces the directory listings, see utils/manifest.py
+    self.manifest = None
+    if params.get("manifest_dir"):
+      self.manifest = SplitManifest(params["manifest_dir"], os.path.join(cfg.DATA_DIR, data_d))
+      label_tags, img_tags, lidar_tags = [self.manifest.tags(d) for d in ["groundtruth_obj3d", "camera_front", "radar_6455"]]
+    else:
+      if mode != "test":
+        label_tags = [os.path.basename(a).split(".")[0] for a in glob.glob(os.path.join(cfg.DATA_DIR, data_d, "groundtruth_obj3d/*.json"))]
+      img_tags = [os.path.basename(a).split(".")[0] for a in glob.glob(os.path.join(cfg.DATA_DIR, data_d, "camera_front/*.jpg"))]
+      lidar_tags = [os.path.basename(a).split(".")[0] for a in glob.glob(os.path.join(cfg.DATA_DIR, data_d, "radar_6455/*.bin"))]
 
     if mode != "test":
       assert label_tags and img_tags and lidar_tags, "One of the three (label, camera, lidar) folders is empty, Data folder must not be empty"
@@ -42,216 +58,482 @@ class Data_helper:
     
     self.tags = lidar_tags
     self.num_examples = len(lidar_tags)
+    # tag -> number of radar points of the frame, None without a manifest
+    self.num_points = self.manifest.num_points() if self.manifest else None
     if create_anchors:
       pass
     self.anchors = cal_anchors(cfg)
+    # rpn target assignment with the anchor standup boxes and diagonals computed once
+    self.target_assigner = RpnTargetAssigner(cfg, self.anchors)
+
+    # opt-in on-disk voxel cache, only used for the frames which are not augmented (the raw frames of the
+    # identity draws of aug_data for the augmented datasets, see example_memo)
+    self.voxel_cache = None
+    if params.get("voxel_cache_dir") and (not is_aug_data or params.get("aug_memo_size")):
+      self.voxel_cache = VoxelCache(params["voxel_cache_dir"], os.path.join(cfg.DATA_DIR, data_d), cfg)
+      n_built = self.voxel_cache.build(self.tags)
+      print("Voxel cache for {} at {}: {} frames built, {} reused.".format(mode, self.voxel_cache.cache_dir, n_built, self.num_examples - n_built))
+
+    # opt-in packed radar shards, see load_lidar. Frames missing from the pack or changed since it was
+    # packed are read from their own file. The examples of the tfdata backend read the frame files.
+    self.radar_pack = None
+    if params.get("radar_pack_dir"):
+      self.radar_pack = RadarPack(params["radar_pack_dir"], os.path.join(cfg.DATA_DIR, data_d))
+      self.radar_pack_stale = set(self.radar_pack.stale_tags(self.tags))
+      print("Radar pack for {} at {}: {} frames packed, {} stale or missing.".format(
+          mode, self.radar_pack.pack_dir, self.num_examples - len(self.radar_pack_stale), len(self.radar_pack_stale)))
+
+    # opt-in columnar label and calibration index, see load_label and load_calib
+    self.split_dir = os.path.join(cfg.DATA_DIR, data_d)
+    self.label_index = None
+    if params.get("label_index_dir"):
+      self.label_index = LabelIndex(params["label_index_dir"], self.split_dir)
+      print("Label index for {} at {} ({}).".format(mode, self.label_index.index_path, "built" if self.label_index.built else "up to date"))
+
+    # opt-in ground truth object sampling of the augmented frames, see utils/gt_database.py. The database
+    # is extracted from the split on first use.
+    self.gt_sampler = None
+    if params.get("gt_database_dir") and is_aug_data:
+      gt_database = GTDatabase(params["gt_database_dir"], self.split_dir)
+      if not len(gt_database):
+        gt_database.build(label_tags)
+      sample_groups = params.get("gt_sample_groups") or [cfg.DETECT_OBJECT + ":10"]
+      self.gt_sampler = GTSampler(gt_database, parse_sample_groups(sample_groups))
+      print("GT database for {} at {}: {} objects, sampling {}.".format(mode, gt_database.db_dir, len(gt_database), " ".join(sample_groups)))
+
+    # opt-in in-graph rpn targets, the batches only carry the padded gt boxes and the targets are assigned
+    # by the train step (RpnTargetAssigner.assign_tf)
+    self.in_graph_rpn_targets = bool(params.get("in_graph_rpn_targets")) and mode in ["train", "eval", "sample_test"]
+
+    # "generator" (from_generator over fill_examples_queue / parallel_examples) or "tfdata" (tfdata_examples)
+    self.input_backend = params.get("input_backend") or "generator"
+    assert self.input_backend in ["generator", "tfdata"], "Unknown input backend {}".format(self.input_backend)
+
+    # multi-process sample producers, see parallel_examples
+    self.num_workers = params.get("num_workers", 0)
+    self.worker_queue_size = params.get("worker_queue_size", 0) or 4
+
+    # opt-in sparse rpn targets, the dense maps are only rebuilt at batch time. Always on with the sample
+    # producers, whose examples are pickled through their queues : the dense maps are most of an example
+    sparse_rpn_targets = params.get("sparse_rpn_targets") or (self.num_workers > 0 and self.input_backend == "generator")
+    self.target_store = None
+    if sparse_rpn_targets and mode in ["train", "eval", "sample_test"] and not self.in_graph_rpn_targets:
+      self.target_store = RpnTargetStore(cfg, self.anchors, os.path.join(cfg.DATA_DIR, data_d, "groundtruth_obj3d"), params.get("rpn_target_cache_dir"))
+
+    # opt-in reuse of the voxels and rpn targets of the frames left unchanged by aug_data, the voxels being
+    # memoized in memory (aug_memo_size frames) or read from the voxel cache if any, see utils/example_memo.py
+    self.example_memo = None
+    if is_aug_data and params.get("aug_memo_size"):
+      self.example_memo = ExampleMemo(cfg, params.get("aug_memo_size", 0), self.voxel_cache)
+      if not self.target_store and not self.in_graph_rpn_targets:
+        self.identity_targets = RpnTargetStore(cfg, self.anchors, os.path.join(cfg.DATA_DIR, data_d, "groundtruth_obj3d"))
 
     #self.tag_gen = thread_safe_generator(self.tag_generator(params["n_epochs"]))
 
-    """self.ex_queue = Queue(params["ex_buffer_size"])
-    self.launch_fillers(params["num_threads"], mode, is_aug_data)
-    while self.ex_queue.qsize()<params["ex_buffer_size"]:
-      time.sleep(2)"""
+    # iterator state, saved with the training checkpoint (see iterator_state and example_stream) : the seed
+    # of the epoch orders and of the augmentations, and the number of batches consumed through __next__
+    self.batch_size = params["batch_size"]
+    self.iter_seed = tf.Variable(random.randrange(2**31), dtype=tf.int64, trainable=False, name="iter_seed")
+    self.iter_consumed = tf.Variable(0, dtype=tf.int64, trainable=False, name="iter_consumed")
+    self.iterator_state = tf.train.Checkpoint(seed=self.iter_seed, consumed=self.iter_consumed)
+    # [seed, start position] of the stream at the last reset, for the in-graph stream of tfdata_stream
+    self.stream_state = tf.Variable([0, 0], dtype=tf.int64, trainable=False, name="stream_state")
+
+    # optional hard cap on the voxels of a frame and bucketing of the frames by voxel count, see batch_dataset
+    self.max_voxels = params.get("max_voxels", 0)
+    self.voxel_drop_policy = params.get("voxel_drop_policy") or "dense"
+    assert self.voxel_drop_policy in ["dense", "random"], "Unknown voxel drop policy {}".format(self.voxel_drop_policy)
+    self.bucket_boundaries = sorted(params.get("bucket_boundaries") or [])
+
+    # opt-in flat point lists of the voxels instead of the padded feature buffer (see flatten_voxels), the
+    # input of RaggedVFE_Block
+    self.ragged_vfe = bool(params.get("ragged_vfe"))
 
     self.batcher = self.batch_dataset( params["batch_size"], mode,is_aug_data, buffer_size, cfg, strategy)
+    self.reset()
+    # full batches only, built on first use (see full_batches)
+    self.full_batcher = None
+    self.full_batcher_args = (params["batch_size"], mode, is_aug_data, buffer_size, cfg, strategy)
+
+  def reset(self):
+    # restarts the batch iterator from the current iterator state, to be called after a checkpoint restore
+    self.stream_seed = int(self.iter_seed.numpy())
+    self.stream_start = int(self.iter_consumed.numpy()) * self.batch_size
+    self.stream_state.assign([self.stream_seed, self.stream_start])
     self.batch_iter = iter(self.batcher)
-    
+
   """def tag_generator(self):
     random.shuffle(self.tags)
     for ind in self.tags:
       yield ind"""
 
 
+  def example_stream(self, mode):
+    # (tag, sample seed) of the examples to produce, from the position of the iterator state at the last reset. train and sample_test go through the epochs endlessly, the epoch e
+    # following the permutation RandomState(seed + e) of the sorted tags ; the other modes go once through
+    # the sorted tags. The stream only depends on the seed, so a restored iterator state resumes it exactly.
+    tags = sorted(self.tags)
+    seed = self.stream_seed
+    if mode not in ["train", "sample_test"]:
+      for position, tag in enumerate(tags):
+        yield tag, self.sample_seed(seed, position)
+      return
+    position = self.stream_start
+    while True:
+      epoch, offset = divmod(position, len(tags))
+      order = np.random.RandomState((seed + epoch) % 2**32).permutation(len(tags))
+      for i in order[offset:]:
+        yield tags[i], self.sample_seed(seed, position)
+        position += 1
+
+
+  @staticmethod
+  def sample_seed(seed, position):
+    # seed of the random augmentation of the example at a position of the stream
+    return int(np.random.SeedSequence([seed, position]).generate_state(1)[0])
+
+
   def fill_examples_queue(self, cfg, mode, is_aug_data=False):
+    for index, sample_seed in self.example_stream(mode):
+      #print(f'begin fill examples queue: index:{index}.',end = '')
+      yield self.load_example(index, cfg, mode, is_aug_data, sample_seed=sample_seed)
+
+
+  def decode_image(self, path, cfg):
+    # tensorflow ops only, so it also runs inside a tf.data map
+    img = tf.io.read_file(path)
+    img = tf.image.decode_jpeg(img, channels=cfg.IMG_CHANNEL)
+    img = tf.image.convert_image_dtype(img, tf.float32)
+    return tf.image.resize(img, [cfg.IMG_HEIGHT, cfg.IMG_WIDTH])
+
+
+  def load_image(self, index, cfg, mode):
     data_d = "training" if mode == "train" else "testing" if mode =="test" else "validation"
     img_dir = "{}/{}/camera_front".format(cfg.DATA_DIR, data_d)
+    return self.decode_image("%s/%06d.jpg" % (img_dir, int(index)), cfg)
+
+
+  def load_lidar(self, index):
+    # (N, 4) float32 point cloud of a frame, read-only view of the radar pack if any
+    if self.radar_pack is not None and index not in self.radar_pack_stale and index in self.radar_pack:
+      return self.radar_pack.get(index)
+    return np.fromfile("%s/radar_6455/%06d.bin" % (self.split_dir, int(index)), dtype=np.float32).reshape(-1,4)
+
+
+  def load_label(self, index):
+    # (N', 11) labels of a frame, read-only view of the label index if any
+    if self.label_index is not None and index in self.label_index:
+      return self.label_index.label(index)
+    return load_label("%s/groundtruth_obj3d/%06d.json" % (self.split_dir, int(index)))
+
+
+  def load_calib(self, index):
+    # T_toLidar, T_toCamera, K of a frame
+    if self.label_index is not None and index in self.label_index:
+      return self.label_index.calib(index)
+    return load_calib("%s/calibration/%06d.json" % (self.split_dir, int(index)))
+
+
+  def load_example(self, index, cfg, mode, is_aug_data=False, pc=None, sample_seed=None):
+    # builds the example dict of one frame (the fields of batch_schema), pc is the already read point cloud,
+    # sample_seed seeds the random augmentation and voxel drop of the example (fresh entropy if None).
+    # The image and the raw point cloud are not part of the examples, the visualizations fetch them by tag
+    # with load_image and load_lidar.
+    data_d = "training" if mode == "train" else "testing" if mode =="test" else "validation"
     labels_dir = "{}/{}/groundtruth_obj3d".format(cfg.DATA_DIR, data_d)
-    pc_dir = "{}/{}/radar_6455".format(cfg.DATA_DIR, data_d)
     calib_dir = "{}/{}/calibration".format(cfg.DATA_DIR, data_d)
-    
-    if mode in ["train", "sample_test"]:
-      random.shuffle(self.tags)
+    dic = {}
+    identity = False
+    rng = np.random.RandomState(sample_seed)
+    if is_aug_data:
+      dic = aug_data(index, os.path.join(cfg.DATA_DIR, data_d), label=self.load_label(index),
+                     lidar=self.load_lidar(index) if pc is None else pc, rng=rng,
+                     gt_sampler=self.gt_sampler, memo=self.example_memo)
+      # raw frame of an identity draw, its voxels came from the memo and its targets are memoized by tag
+      identity = not dic.pop("augmented") and self.example_memo is not None
+      #print('finish data augumentation.', end = '')
     else:
-      print("sort data")
-      sorted(self.tags)
-    for index in self.tags:
-      #index = next(self.tag_gen)
-      #print(f'begin fill examples queue: index:{index}.',end = '')
-      dic = {}
-      if is_aug_data:
-        dic = aug_data(index, os.path.join(cfg.DATA_DIR, data_d))
-        #print('finish data augumentation.', end = '')
-      else:
-        pc = np.fromfile("%s/%06d.bin" % (pc_dir, int(index)), dtype=np.float32).reshape(-1,4) 
-        if mode == "test":
-          dic["lidar"] = pc
-          dic["labels"] = []
-        elif mode == "sample_test" or mode== "eval":
-          dic["lidar"] = pc
-          #dic["labels"] = np.array([line.strip() for line in open("%s/%06d.txt" % (labels_dir, int(index)) , 'r').readlines()])
-          dic["labels"] = load_label("%s/%06d.json" % (labels_dir,int(index)))
-        else:
-          dic["lidar"] = 0
-          #dic["labels"] = np.array([line.strip() for line in open("%s/%06d.txt" % (labels_dir, int(index)) , 'r').readlines()])
-          dic["labels"] = load_label("%s/%06d.json" % (labels_dir,int(index)))
-        dic["num_points"] = len(pc)
-
-        if mode == "train":
-          dic["img"] = 0
-        else:
-          img = tf.io.read_file("%s/%06d.jpg" % (img_dir, int(index)))
-          img = tf.image.decode_jpeg(img, channels=cfg.IMG_CHANNEL)
-          img = tf.image.convert_image_dtype(img, tf.float32)
-          dic["img"] = tf.image.resize(img, [cfg.IMG_HEIGHT, cfg.IMG_WIDTH])
-
-        dic["tag"] = "%06d" % int(index)
-    
-        
-        dic.update(process_pointcloud(pc, cfg))
-
-      if mode in ["train", "eval", "sample_test"]:
-        # _, Tr, _ = load_calib("%s/%06d.json" % (calib_dir,int(index)))
-        # print(f'Tr:{Tr.shape}')
-        dic["pos_equal_one"], dic["neg_equal_one"], dic["targets"]= cal_rpn_target(dic["labels"][np.newaxis, ...],
-                                                                                      cfg.MAP_SHAPE , 
-                                                                                      self.anchors, 
-                                                                                      cfg.DETECT_OBJECT, 
-                                                                                      'lidar')
-        #print('finish rpn calculation.', end = '')
-
-        dic["pos_equal_one_reg"] = np.concatenate(
-                [np.tile( dic["pos_equal_one"][..., [0]], 7), np.tile( dic["pos_equal_one"][..., [1]], 7)], axis=-1)[0] #we index to 0 because we added a batch dimension
-        dic["pos_equal_one_sum"] = np.clip(np.sum(dic["pos_equal_one"], axis=(
-                1, 2, 3)).reshape(-1, 1, 1, 1), a_min=1, a_max=None)[0]
-        dic["neg_equal_one_sum"] = np.clip(np.sum(dic["neg_equal_one"], axis=(
-                1, 2, 3)).reshape(-1, 1, 1, 1), a_min=1, a_max=None)[0]
-
-        dic["pos_equal_one"], dic["neg_equal_one"], dic["targets"] = dic["pos_equal_one"][0], dic["neg_equal_one"][0], dic["targets"][0]
+      if pc is None:
+        pc = self.load_lidar(index)
+      if mode == "test":
+        dic["labels"] = np.zeros((0, 11))
       else:
-        dic["pos_equal_one"], dic["neg_equal_one"], dic["targets"] = 0,0,0
-        dic["pos_equal_one_reg"], dic["pos_equal_one_sum"], dic["neg_equal_one_sum"] = 0,0,0
-
-      #print('finish one time fill queqe. yielded dic.')
-      # print(f'labels: {dic["labels"].shape}')
-      # print(f'tag: {dic["tag"]}')
-      # print(f'feature_buffer: {dic["feature_buffer"].shape}')
-      # print(f'coordinate_buffer: {dic["coordinate_buffer"].shape}')
-      # print(f'number_buffer: {dic["number_buffer"].shape}')
-      # print(f'num_points: {dic["num_points"]}')
-      # print(f'pos_equal_one: {dic["pos_equal_one"].shape}')
-      # print(f'neg_equal_one: {dic["neg_equal_one"].shape}')
-      # print(f'targets: {dic["targets"].shape}')
-      # print(f'pos_equal_one_reg: {dic["pos_equal_one_reg"].shape}')
-      # print(f'pos_equal_one_sum: {dic["pos_equal_one_sum"].shape}')
-      # print(f'neg_equal_one_sum: {dic["neg_equal_one_sum"].shape}\n')
-      yield dic
-      #self.ex_queue.put(dic)
-
-  """
-  def launch_fillers(self, num_threads, mode, is_aug_data):
-    self.elements_queue_threads = []
-    for i in range(num_threads):
-      self.elements_queue_threads.append(Thread(target=self.fill_examples_queue, args=(self.cfg, mode,is_aug_data,)))
-      self.elements_queue_threads[-1].setDaemon(True)
-      self.elements_queue_threads[-1].start()
+        #dic["labels"] = np.array([line.strip() for line in open("%s/%06d.txt" % (labels_dir, int(index)) , 'r').readlines()])
+        dic["labels"] = self.load_label(index)
+      dic["num_points"] = len(pc)
 
+      dic["tag"] = "%06d" % int(index)
   
-  def example_generator(self):
-    once_empty = False
-    while True:
-      if self.ex_queue.qsize() == 0 and not once_empty:
-        time.sleep(10)
-        once_empty = True
-        continue
-      elif self.ex_queue.qsize() != 0:
-        once_empty=False
-        ex = self.ex_queue.get()
-        yield ex
+      
+      dic.update(self.voxel_cache.get(index, pc) if self.voxel_cache else process_pointcloud(pc, cfg))
+    if self.max_voxels:
+      dic.update(cap_voxels({key: dic[key] for key in ["feature_buffer", "coordinate_buffer", "number_buffer"]},
+                            self.max_voxels, self.voxel_drop_policy, rng=rng))
+    if self.ragged_vfe:
+      dic.update(flatten_voxels({key: dic.pop(key) for key in ["feature_buffer", "coordinate_buffer", "number_buffer"]}))
+
+    if self.in_graph_rpn_targets:
+      dic["gt_boxes"] = self.target_assigner.gt_boxes(dic["labels"])
+      dic["num_gt_boxes"] = len(dic["gt_boxes"])
+    elif mode in ["train", "eval", "sample_test"] and self.target_store:
+      # augmented labels are not deterministic, they bypass the store
+      dic.update(self.target_store.compute(dic["labels"]) if is_aug_data and not identity else self.target_store.get(index, dic["labels"]))
+    elif mode in ["train", "eval", "sample_test"]:
+      # _, Tr, _ = load_calib("%s/%06d.json" % (calib_dir,int(index)))
+      # print(f'Tr:{Tr.shape}')
+      if identity:
+        sparse = self.identity_targets.get(index, dic["labels"])
+        is_neg = np.ones((self.identity_targets.n_anchors), dtype=bool)
+        is_neg[sparse["non_neg_index"]] = False
+        dic["pos_equal_one"], dic["neg_equal_one"], dic["targets"] = [target[np.newaxis] for target in sparse_to_dense_rpn_target(
+            sparse["pos_index"], sparse["pos_targets"], np.where(is_neg)[0], cfg.MAP_SHAPE)]
       else:
-        break
-  """
-
-
-  def batch_dataset(self, batch_size, mode , is_aug_data, buffer_size, cfg, strategy):
-
-    dataset = tf.data.Dataset.from_generator(lambda: self.fill_examples_queue(self.cfg, mode,is_aug_data), 
-                                            output_types={
-                                                "img" : tf.float32,
-                                                "labels" : tf.float32,
-                                                "tag" : tf.string,
-                                                "feature_buffer" : tf.float32,
-                                                "coordinate_buffer" : tf.int32,
-                                                "number_buffer" : tf.int32,
-                                                "lidar" : tf.float32,
-                                                "num_points" : tf.int32,
-                                                "pos_equal_one": tf.float32,
-                                                "neg_equal_one" : tf.float32,
-                                                "targets" : tf.float32,
-                                                "pos_equal_one_reg" : tf.float32,
-                                                "pos_equal_one_sum" : tf.float32,
-                                                "neg_equal_one_sum" : tf.float32
-                                            },
-                                            output_shapes={
-                                                "img" : [cfg.IMG_HEIGHT, cfg.IMG_WIDTH, cfg.IMG_CHANNEL] if mode!="train" else [],
-                                                "labels" : [None, 11],
-                                                "tag" : [],
-                                                "feature_buffer" : [None, cfg.MAX_POINT_NUMBER, 7],
-                                                "coordinate_buffer" : [None, 3],
-                                                "number_buffer" : [None],
-                                                "lidar" : [None, 4] if "test" in mode or mode == "eval" else [],
-                                                "num_points" : [],
-                                                "pos_equal_one": [*cfg.MAP_SHAPE, cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [] ,
-                                                "neg_equal_one" : [*cfg.MAP_SHAPE, cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [],
-                                                "targets" : [*cfg.MAP_SHAPE, 7*cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [],
-                                                "pos_equal_one_reg" : [*cfg.MAP_SHAPE, 7*cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [],
-                                                "pos_equal_one_sum" : [1,1,1] if mode in ["train", "eval", "sample_test"] else [],
-                                                "neg_equal_one_sum" : [1,1,1] if mode in ["train", "eval", "sample_test"] else []
-                                            })
-    
-    dataset = dataset.padded_batch(batch_size, 
-                                  padded_shapes = {
-                                      "img" : [cfg.IMG_HEIGHT,cfg.IMG_WIDTH, cfg.IMG_CHANNEL] if mode!="train" else [],
-                                      "labels" : [None, 11],
-                                      "tag" : [],
-                                      "feature_buffer" : [None, cfg.MAX_POINT_NUMBER, 7],
-                                      "coordinate_buffer" : [None, 3],
-                                      "number_buffer" : [None],
-                                      "lidar" : [None, 4] if "test" in mode or mode == "eval" else [],
-                                      "num_points": [],
-                                      "pos_equal_one": [*cfg.MAP_SHAPE, cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [] ,
-                                      "neg_equal_one" : [*cfg.MAP_SHAPE, cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [],
-                                      "targets" : [*cfg.MAP_SHAPE, 7*cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [],
-                                      "pos_equal_one_reg" : [*cfg.MAP_SHAPE, 7*cfg.NUM_ANCHORS_PER_CELL] if mode in ["train", "eval", "sample_test"] else [],
-                                      "pos_equal_one_sum" : [1,1,1] if mode in ["train", "eval", "sample_test"] else [],
-                                      "neg_equal_one_sum" : [1,1,1] if mode in ["train", "eval", "sample_test"] else []
-                                  }, padding_values = {
-                                      'img' : 0.0,
-                                      'labels' : 0.0,
-                                      'tag' : b"",
-                                      "feature_buffer" : 0.0,
-                                      "coordinate_buffer" : 0,
-                                      "number_buffer" : 0,
-                                      "lidar":0.,
-                                      "num_points":0,
-                                      "pos_equal_one": 0. ,
-                                      "neg_equal_one" : 0.,
-                                      "targets" : 0.,
-                                      "pos_equal_one_reg" : 0.,
-                                      "pos_equal_one_sum" : 0.,
-                                      "neg_equal_one_sum" : 0.
-                                  })
+        dic["pos_equal_one"], dic["neg_equal_one"], dic["targets"] = self.target_assigner.dense([dic["labels"]])
+      #print('finish rpn calculation.', end = '')
+
+      dic["pos_equal_one_reg"] = np.concatenate(
+              [np.tile( dic["pos_equal_one"][..., [0]], 7), np.tile( dic["pos_equal_one"][..., [1]], 7)], axis=-1)[0] #we index to 0 because we added a batch dimension
+      dic["pos_equal_one_sum"] = np.clip(np.sum(dic["pos_equal_one"], axis=(
+              1, 2, 3)).reshape(-1, 1, 1, 1), a_min=1, a_max=None)[0]
+      dic["neg_equal_one_sum"] = np.clip(np.sum(dic["neg_equal_one"], axis=(
+              1, 2, 3)).reshape(-1, 1, 1, 1), a_min=1, a_max=None)[0]
+
+      dic["pos_equal_one"], dic["neg_equal_one"], dic["targets"] = dic["pos_equal_one"][0], dic["neg_equal_one"][0], dic["targets"][0]
+
+    #print('finish one time fill queqe. yielded dic.')
+    # print(f'labels: {dic["labels"].shape}')
+    # print(f'tag: {dic["tag"]}')
+    # print(f'feature_buffer: {dic["feature_buffer"].shape}')
+    # print(f'coordinate_buffer: {dic["coordinate_buffer"].shape}')
+    # print(f'number_buffer: {dic["number_buffer"].shape}')
+    # print(f'num_points: {dic["num_points"]}')
+    # print(f'pos_equal_one: {dic["pos_equal_one"].shape}')
+    # print(f'neg_equal_one: {dic["neg_equal_one"].shape}')
+    # print(f'targets: {dic["targets"].shape}')
+    # print(f'pos_equal_one_reg: {dic["pos_equal_one_reg"].shape}')
+    # print(f'pos_equal_one_sum: {dic["pos_equal_one_sum"].shape}')
+    # print(f'neg_equal_one_sum: {dic["neg_equal_one_sum"].shape}\n')
+    return dic
+
+  def parallel_examples(self, cfg, mode, is_aug_data=False):
+    # same examples as fill_examples_queue, produced by self.num_workers processes. The worker w builds the
+    # examples w, w + num_workers, ... of example_stream and hands them back through its own bounded queue,
+    # the queues are read in turn so the examples come out in the order of the stream.
+    ctx = multiprocessing.get_context("fork")
+    queues = [ctx.Queue(self.worker_queue_size) for _ in range(self.num_workers)]
+    workers = []
+    for worker_id in range(self.num_workers):
+      workers.append(ctx.Process(target=self.produce_examples,
+                                 args=(worker_id, queues[worker_id], cfg, mode, is_aug_data),
+                                 daemon=True))
+      workers[-1].start()
+
+    try:
+      worker_id = 0
+      while True:
+        try:
+          dic = queues[worker_id].get(timeout=10)
+        except queue.Empty:
+          assert workers[worker_id].exitcode in [None, 0], "A sample producer died, exit code : {}".format(workers[worker_id].exitcode)
+          continue
+        if dic is None:
+          # end of the stream (the workers hold consecutive examples, so the next ones are done too)
+          return
+        if isinstance(dic, str):
+          raise RuntimeError("A sample producer failed :\n{}".format(dic))
+        yield dic
+        worker_id = (worker_id + 1) % self.num_workers
+    finally:
+      for w in workers:
+        if w.is_alive():
+          w.terminate()
+        w.join()
+
+
+  def produce_examples(self, worker_id, ex_queue, cfg, mode, is_aug_data):
+    # body of a producer process of parallel_examples, the None sentinel marks the end of the stream
+    np.random.seed((self.stream_seed + worker_id) % 2**32)
+    try:
+      stream = itertools.islice(self.example_stream(mode), worker_id, None, self.num_workers)
+      for index, sample_seed in stream:
+        ex_queue.put(self.load_example(index, cfg, mode, is_aug_data, sample_seed=sample_seed))
+    except Exception:
+      ex_queue.put(traceback.format_exc())
+    ex_queue.put(None)
+
+
+  def tfdata_examples(self, cfg, mode, is_aug_data=False):
+    # native tf.data source : the radar frames are read with tf ops (the radar pack is not used), the
+    # augmentation, the voxelization and the target assignment run through tf.numpy_function inside a
+    # parallel map (tf.data thread pool)
+    output_types, output_shapes, _ = self.batch_schema(mode, cfg)
+    numpy_keys = list(output_types)
+    data_d = "training" if mode == "train" else "testing" if mode =="test" else "validation"
+    split_dir = os.path.join(cfg.DATA_DIR, data_d)
+
+    def numpy_example(tag, sample_seed, pc):
+      dic = self.load_example(tag.decode(), cfg, mode, is_aug_data, pc=pc, sample_seed=sample_seed)
+      dic["labels"] = np.reshape(dic["labels"], (-1, 11))
+      dic["tag"] = dic["tag"].encode()
+      return [np.asarray(dic[key], dtype=output_types[key].as_numpy_dtype) for key in numpy_keys]
+
+    def map_example(tag, sample_seed):
+      # every frame is read in the graph, the augmentation and the voxelization get the decoded points
+      pc = tf.io.read_file(tf.strings.join([split_dir, "/radar_6455/", tag, ".bin"]))
+      pc = tf.reshape(tf.io.decode_raw(pc, tf.float32), [-1, 4])
+      values = tf.numpy_function(numpy_example, [tag, sample_seed, pc], [output_types[key] for key in numpy_keys])
+      example = {}
+      for key, value in zip(numpy_keys, values):
+        value.set_shape(output_shapes[key])
+        example[key] = value
+      return example
+
+    # the parallel map keeps the order of the stream, so the iterator state stays exact
+    return self.tfdata_stream(mode).map(map_example, num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=True)
+
+
+  def tfdata_stream(self, mode):
+    # (tag, sample seed) of the examples to produce, the in-graph counterpart of example_stream : the same
+    # epochs over the sorted tags from the position of the iterator state at the last reset (stream_state,
+    # read when an iterator is created), the epoch e of train and sample_test following the permutation
+    # index_shuffle keyed on (seed, e) and the sample seeds being stateless draws keyed on (seed, position).
+    # The orders and the seeds differ from example_stream, they only depend on the iterator state too.
+    tags = tf.constant(sorted(self.tags))
+    n_tags = tf.constant(len(self.tags), dtype=tf.int64)
+    endless = mode in ["train", "sample_test"]
+
+    def examples(state):
+      seed, start = state[0], state[1]
+      positions = tf.data.Dataset.range(start, np.iinfo(np.int64).max) if endless else tf.data.Dataset.range(n_tags)
+
+      def example_at(position):
+        index = position % n_tags
+        if endless:
+          index = tf.random.experimental.index_shuffle(index, tf.stack([seed, position // n_tags]), n_tags - 1)
+        sample_seed = tf.random.stateless_uniform([], tf.stack([seed, position]), minval=0, maxval=2**32, dtype=tf.int64)
+        return tags[index], sample_seed
+
+      return positions.map(example_at)
+
+    return tf.data.Dataset.from_tensors(0).flat_map(lambda _: examples(self.stream_state.read_value()))
+
+
+  def batch_schema(self, mode, cfg):
+    # only the fields read by the consumers of the batches : the rpn targets are left out in test mode,
+    # the camera image and the raw point cloud are never batched (see load_image and load_lidar)
+    with_targets = mode in ["train", "eval", "sample_test"]
+    output_types = {
+        "labels" : tf.float32,
+        "tag" : tf.string,
+        "feature_buffer" : tf.float32,
+        "coordinate_buffer" : tf.int32,
+        "number_buffer" : tf.int32,
+        "num_points" : tf.int32
+    }
+    output_shapes = {
+        "labels" : [None, 11],
+        "tag" : [],
+        "feature_buffer" : [None, cfg.MAX_POINT_NUMBER, 7],
+        "coordinate_buffer" : [None, 3],
+        "number_buffer" : [None],
+        "num_points" : []
+    }
+    padding_values = {
+        'labels' : 0.0,
+        'tag' : b"",
+        "feature_buffer" : 0.0,
+        "coordinate_buffer" : 0,
+        "number_buffer" : 0,
+        "num_points":0
+    }
+    if self.ragged_vfe:
+      # rows padding the batch in the voxel -1
+      for schema in [output_types, output_shapes, padding_values]:
+        del schema["feature_buffer"]
+      output_types.update({"point_features" : tf.float32, "point_voxel" : tf.int32})
+      output_shapes.update({"point_features" : [None, 7], "point_voxel" : [None]})
+      padding_values.update({"point_features" : 0.0, "point_voxel" : -1})
+    if self.in_graph_rpn_targets:
+      # padded gt boxes (float64 like the host assignment), the targets are assigned in the train step
+      output_types.update({"gt_boxes" : tf.float64, "num_gt_boxes" : tf.int32})
+      output_shapes.update({"gt_boxes" : [None, 7], "num_gt_boxes" : []})
+      padding_values.update({"gt_boxes" : np.float64(0.), "num_gt_boxes" : 0})
+    elif with_targets and not self.target_store:
+      output_types.update({
+          "pos_equal_one": tf.float32,
+          "neg_equal_one" : tf.float32,
+          "targets" : tf.float32,
+          "pos_equal_one_reg" : tf.float32,
+          "pos_equal_one_sum" : tf.float32,
+          "neg_equal_one_sum" : tf.float32
+      })
+      output_shapes.update({
+          "pos_equal_one": [*cfg.MAP_SHAPE, cfg.NUM_ANCHORS_PER_CELL],
+          "neg_equal_one" : [*cfg.MAP_SHAPE, cfg.NUM_ANCHORS_PER_CELL],
+          "targets" : [*cfg.MAP_SHAPE, 7*cfg.NUM_ANCHORS_PER_CELL],
+          "pos_equal_one_reg" : [*cfg.MAP_SHAPE, 7*cfg.NUM_ANCHORS_PER_CELL],
+          "pos_equal_one_sum" : [1,1,1],
+          "neg_equal_one_sum" : [1,1,1]
+      })
+      padding_values.update({
+          "pos_equal_one": 0. ,
+          "neg_equal_one" : 0.,
+          "targets" : 0.,
+          "pos_equal_one_reg" : 0.,
+          "pos_equal_one_sum" : 0.,
+          "neg_equal_one_sum" : 0.
+      })
+    elif with_targets and self.target_store:
+      # sparse targets, densified after batching by sparse_to_dense_rpn_target_tf
+      output_types.update({"pos_index" : tf.int32, "pos_targets" : tf.float32, "non_neg_index" : tf.int32})
+      output_shapes.update({"pos_index" : [None], "pos_targets" : [None, 7], "non_neg_index" : [None]})
+      padding_values.update({"pos_index" : -1, "pos_targets" : 0., "non_neg_index" : -1})
+    return output_types, output_shapes, padding_values
+
+
+  def example_dataset(self, cfg, mode, is_aug_data):
+    # unbatched tf.data source of the examples of the input backend
+    if self.input_backend == "tfdata":
+      return self.tfdata_examples(cfg, mode, is_aug_data)
+    output_types, output_shapes, _ = self.batch_schema(mode, cfg)
+    examples = self.parallel_examples if self.num_workers > 0 else self.fill_examples_queue
+    return tf.data.Dataset.from_generator(lambda: examples(self.cfg, mode,is_aug_data), 
+                                          output_types=output_types,
+                                          output_shapes=output_shapes)
+
+
+  def batch_dataset(self, batch_size, mode , is_aug_data, buffer_size, cfg, strategy, drop_remainder=False):
+
+    output_types, output_shapes, padding_values = self.batch_schema(mode, cfg)
+    dataset = self.example_dataset(cfg, mode, is_aug_data)
+
+    if self.bucket_boundaries:
+      # frames with close voxel counts are batched together, so a dense frame does not inflate the
+      # padding of the whole batch. The examples of the training datasets do not stop at the end of an epoch
+      # (see example_stream), so every batch is full.
+      dataset = dataset.bucket_by_sequence_length(lambda example: tf.shape(example["number_buffer"])[0],
+                                                  bucket_boundaries=self.bucket_boundaries,
+                                                  bucket_batch_sizes=[batch_size]*(len(self.bucket_boundaries)+1),
+                                                  padded_shapes=output_shapes,
+                                                  padding_values=padding_values,
+                                                  drop_remainder=drop_remainder)
+    else:
+      dataset = dataset.padded_batch(batch_size, 
+                                    padded_shapes=output_shapes,
+                                    padding_values=padding_values,
+                                    drop_remainder=drop_remainder)
     
     def update_dataset(batch):
       batch_idx = tf.range(0, tf.shape(batch["coordinate_buffer"])[0], 1)
       batch_idx = tf.expand_dims(tf.expand_dims(batch_idx, axis=-1), axis=-1)
       batch_idx = tf.tile(batch_idx, [1, tf.shape(batch["coordinate_buffer"])[1], 1])
       batch["coordinate_buffer"] = tf.concat([batch_idx, batch["coordinate_buffer"]], axis=-1)
+      if "pos_index" in batch:
+        batch = sparse_to_dense_rpn_target_tf(batch, cfg.MAP_SHAPE)
       return batch
 
     dataset = dataset.map(update_dataset)
-    if mode in ["train", "sample_test"]:
-      dataset = dataset.repeat()
-    dataset = dataset.prefetch(buffer_size)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE if self.input_backend == "tfdata" else buffer_size)
     if type(strategy) != type(None):
       print(f"Create distributed dataset for {mode}.")
       dataset = strategy.experimental_distribute_dataset(dataset)
@@ -259,8 +541,18 @@ class Data_helper:
     return dataset
 
 
+  def full_batches(self):
+    # the batches of the split without the partial ones (the last one, or the last one of every bucket),
+    # for the graphs built with the static batch size of the model, like the losses of the validation
+    if self.full_batcher is None:
+      self.full_batcher = self.batch_dataset(*self.full_batcher_args, drop_remainder=True)
+    return self.full_batcher
+
   def __iter__(self):
     return self.batch_iter
   def __next__(self):
-    return next(self.batch_iter)
+    # also runs inside the tf.function of the train step, where the counter update is part of the graph
+    batch = next(self.batch_iter)
+    self.iter_consumed.assign_add(1)
+    return batch
       
\ No newline at end of file
@@ -1,10 +1,13 @@
 import tensorflow as tf
 import numpy as np
 import os
+import time
 from model_helper.loss_optimizer_helper import Loss, Optimizer
-from utils.utils import delta_to_boxes3d, corner_to_standup_box2d, center_to_corner_box2d, load_calib, draw_lidar_box3d_on_image
-from utils.utils import lidar_to_bird_view_img, draw_lidar_box3d_on_birdview, label_to_gt_box3d
+from utils.utils import load_calib, draw_lidar_box3d_on_image
+from utils.utils import lidar_to_bird_view_img, draw_lidar_box3d_on_birdview, label_to_gt_box3d, cal_anchors
 from utils.colorize import colorize
+from utils.target_assigner import RpnTargetAssigner
+from utils.rotated_iou import rotated_nms_frames, rotated_nms_sorted_tf
 
 class VFE_Layer(tf.keras.layers.Layer):
   """
@@ -35,6 +38,48 @@ class VFE_Layer(tf.keras.layers.Layer):
     mask = tf.tile(mask, [1,1,1, 2*self.units])
     return tf.multiply(output, tf.cast(mask, tf.float32))
 
+  def call_points(self, input, mask, segment_ids, num_segments, weights, training=False):
+    """
+      Call method on flat point lists (see RaggedVFE_Block)
+      Args:
+        input : 2D tensor, [num_rows, out_dim], the rows of all the voxels of the batch
+        mask : 2D tensor, boolean, [num_rows, 1]
+        segment_ids : 1D tensor, int32, [num_rows], voxel of every row
+        num_segments : int32, number of voxels
+        weights : 1D tensor, float32, [num_rows], number of rows of the padded feature buffer behind every row,
+          the weights of the rows in the batch statistics of the batch normalization
+      Returns:
+        output : Tensor with the same shape as input, except the last dim which is c_out
+    """
+    fcn_out = self.fcn(input)
+    if training:
+      fcn_out = self.weighted_batch_norm(fcn_out, weights)
+    else:
+      fcn_out = self.bn(fcn_out, training=False)
+    max_pool = tf.math.unsorted_segment_max(fcn_out, segment_ids, num_segments) # [num_segments, out_dim//2]
+    output = tf.concat([fcn_out, tf.gather(max_pool, segment_ids)], axis=-1) # [num_rows, out_dim]
+    return tf.multiply(output, tf.cast(mask, tf.float32))
+
+  def weighted_batch_norm(self, input, weights):
+    """
+      Training batch normalization of self.bn with the statistics of the weighted rows : the normalization
+      and the moving statistics updates of the fused batch normalization of call (biased variance for the
+      normalization, unbiased variance for the moving variance), with every row counted weights times
+      Args:
+        input : 2D tensor, [num_rows, units]
+        weights : 1D tensor, float32, [num_rows]
+      Returns:
+        output : Tensor with the same shape as input
+    """
+    if not self.bn.built:
+      self.bn(input[:0], training=False)
+    mean, variance = tf.nn.weighted_moments(input, axes=[0], frequency_weights=weights[:, tf.newaxis])
+    count = tf.reduce_sum(weights)
+    decay = 1. - self.bn.momentum
+    self.bn.moving_mean.assign_sub((self.bn.moving_mean - mean) * decay)
+    self.bn.moving_variance.assign_sub((self.bn.moving_variance - variance * count / tf.maximum(count - 1., 1.)) * decay)
+    return tf.nn.batch_normalization(input, mean, variance, self.bn.beta, self.bn.gamma, self.bn.epsilon)
+
 
 class VFE_Block(tf.keras.layers.Layer):
   """
@@ -84,6 +129,78 @@ class VFE_Block(tf.keras.layers.Layer):
 
     return tf.transpose(output, perm=[0,4,1,2,3]) #[batch_size, channels, Depth, Height, Width]
 
+
+class RaggedVFE_Block(VFE_Block):
+  """
+    VFE_Block on the flat point lists of the voxels (--ragged_vfe, see flatten_voxels) : the layers run on the
+    rows of the voxels only and the max poolings are per voxel segments (tf.math.unsorted_segment_max), instead
+    of the [batch_size, K, T, 7] padded feature buffer. The padding rows of a voxel are all equal, the lists keep
+    one of them per voxel with less than T points, which gives the outputs of VFE_Block (the max pooling
+    ignores the duplicates). In training, the kept padding row of a voxel weighs T - number in the batch
+    statistics of the batch normalizations, and an extra zero row weighs the T rows of every voxel padding the
+    batch, so the statistics are the ones of VFE_Block.
+    Same arguments and variables as VFE_Block (the checkpoints of both blocks are interchangeable), plus:
+      max_num_pts : int32, T, number of rows of a voxel in the padded feature buffer
+  """
+  def __init__(self, vfe_out_dims, final_dim, sparse_shape, max_num_pts):
+    super(RaggedVFE_Block, self).__init__(vfe_out_dims, final_dim, sparse_shape)
+    self.max_num_pts = max_num_pts
+
+  def call(self, input, voxel_coor_buffer, shape, training=False):
+    """
+      call Method
+      Args:
+        input : (point_features, point_voxel), 3D tensor, float32, [batch_size, P, 7] and 2D tensor, int32,
+          [batch_size, P], voxel of every row in its frame (-1 for the padding of the batch)
+        voxel_coor_buffer : 3D tensor , int32 of dimension [batch_size, K, 4]
+        training : (optional), boolean 
+      Returns:
+        output : 5-D tensor, [batch_size, channels, Depth, Height, Width]
+    """
+    point_features, point_voxel = input
+    batch_size, K = tf.shape(voxel_coor_buffer)[0], tf.shape(voxel_coor_buffer)[1]
+    num_segments = batch_size * K
+
+    # rows of the batch, with the voxel indices of the whole batch
+    real = tf.greater_equal(point_voxel, 0)
+    vfe_out = tf.boolean_mask(point_features, real) # [num_rows, 7]
+    segment_ids = tf.boolean_mask(point_voxel + tf.range(batch_size)[:, tf.newaxis] * K, real) # [num_rows]
+
+    # same mask as VFE_Block
+    mask = tf.not_equal(tf.reduce_max(vfe_out, axis=-1, keepdims=True), 0) # [num_rows, 1]
+
+    # rows of the padded feature buffer behind every row : a voxel with less than T rows has number + 1 rows,
+    # its last one stands for its T - number padding rows, the other rows for one row
+    row = tf.range(tf.shape(segment_ids)[0])
+    num_rows = tf.gather(tf.math.unsorted_segment_sum(tf.ones_like(segment_ids), segment_ids, num_segments), segment_ids)
+    last_row = tf.gather(tf.math.unsorted_segment_max(row, segment_ids, num_segments), segment_ids)
+    padding = tf.logical_and(tf.equal(row, last_row), tf.less(num_rows, self.max_num_pts))
+    weights = tf.where(padding, self.max_num_pts - num_rows + 1, 1)
+
+    # the voxels padding the batch have no rows, their rows in VFE_Block are zero rows : one zero row in an
+    # extra segment, for the rest of the batch_size * K * T rows
+    vfe_out = tf.concat([vfe_out, tf.zeros([1, 7])], axis=0)
+    mask = tf.concat([mask, [[False]]], axis=0)
+    segment_ids = tf.concat([segment_ids, [num_segments]], axis=0)
+    weights = tf.concat([weights, [num_segments * self.max_num_pts - tf.reduce_sum(weights)]], axis=0)
+    weights = tf.cast(weights, tf.float32)
+
+    for i, vfe in enumerate(self.VFEs):
+      vfe_out = vfe.call_points(vfe_out, mask, segment_ids, num_segments + 1, weights, training=training) # [num_rows + 1, vfe_out_dims[i]]
+
+    output = self.final_fcn(vfe_out) # [num_rows + 1, final_dim]
+    output = tf.math.unsorted_segment_max(output, segment_ids, num_segments + 1) # [num_segments + 1, final_dim]
+
+    # the voxels padding the batch get the features of the extra segment
+    has_rows = tf.math.unsorted_segment_max(tf.ones_like(segment_ids), segment_ids, num_segments + 1)[:num_segments] > 0
+    output = tf.where(has_rows[:, tf.newaxis], output[:num_segments], output[num_segments])
+    output = tf.reshape(output, [batch_size, K, self.final_dim])
+
+    # Voxels Sparse representation [batch_size, Depth, Height, Width, channels]
+    output = tf.scatter_nd(indices=voxel_coor_buffer, updates=output, shape=shape)
+
+    return tf.transpose(output, perm=[0,4,1,2,3]) #[batch_size, channels, Depth, Height, Width]
+
     
 
 class ConvMiddleLayer(tf.keras.layers.Layer):
@@ -231,9 +348,18 @@ class Model(tf.keras.Model):
     n_replicas = self.strategy.num_replicas_in_sync
     self.params = params
     self.cfg = cfg
-    self.vfe_block = VFE_Block(cfg.VFE_OUT_DIMS, cfg.VFE_FINAl_OUT_DIM, cfg.GRID_SIZE )
+    # flat point lists of the voxels instead of the padded feature buffer (--ragged_vfe)
+    if params.get("ragged_vfe"):
+      self.vfe_block = RaggedVFE_Block(cfg.VFE_OUT_DIMS, cfg.VFE_FINAl_OUT_DIM, cfg.GRID_SIZE, cfg.MAX_POINT_NUMBER)
+    else:
+      self.vfe_block = VFE_Block(cfg.VFE_OUT_DIMS, cfg.VFE_FINAl_OUT_DIM, cfg.GRID_SIZE )
     self.convMiddle = ConvMiddleLayer((params["batch_size"]//n_replicas, -1, *cfg.GRID_SIZE[1:]))
     self.rpn = RPN(cfg.NUM_ANCHORS_PER_CELL)
+    # assigns the rpn targets of the batches carrying padded gt boxes (--in_graph_rpn_targets)
+    self.target_assigner = RpnTargetAssigner(cfg, cal_anchors(cfg)) if params.get("in_graph_rpn_targets") else None
+    # the prediction state is only built by the runs which predict (see anchors and predict_step_function)
+    self._anchors = None
+    self._predict_step_function = None
 
   def add_loss_(self):
     self.loss_object = Loss(self.params)
@@ -243,6 +369,32 @@ class Model(tf.keras.Model):
       self.optimizer = Optimizer(self.params, n_epoch, optimizer="adam")
 
 
+  @property
+  def anchors(self):
+    # flat anchors of the box decoding of _predict_step, built on first use
+    if self._anchors is None:
+      with tf.init_scope():
+        self._anchors = tf.constant(cal_anchors(self.cfg).reshape(-1, 7), dtype=tf.float32)
+    return self._anchors
+
+  @property
+  def predict_step_function(self):
+    # prediction function compiled once for the batches of any voxel count, built on first use. Its input
+    # signature is the element spec of predict_dataset, its traces are counted by its
+    # experimental_get_tracing_count()
+    if self._predict_step_function is None:
+      spec = self.predict_dataset().element_spec
+      self._predict_step_function = tf.function(self.distributed_predict_step,
+                                                input_signature=[self.voxel_input(spec), spec["coordinate_buffer"]])
+    return self._predict_step_function
+
+  def voxel_input(self, batch):
+    # voxel input of the model in a batch (or in its element spec), the feature_buffer argument of the steps :
+    # the padded feature buffer, or the flat point lists of the voxels (--ragged_vfe, see RaggedVFE_Block)
+    if self.params.get("ragged_vfe"):
+      return (batch["point_features"], batch["point_voxel"])
+    return batch["feature_buffer"]
+
   def call(self, training, batch=None, *args, **kwargs):
     if not batch:
       assert "feature_buffer"  in kwargs and "coordinate_buffer" in kwargs, "you must provide a batch object or feature_buffer and coordiante_buffer tensors"
@@ -256,14 +408,24 @@ class Model(tf.keras.Model):
     return prob_map, reg_map
 
 
+  def rpn_targets(self, gt_boxes, num_gt_boxes):
+    # dense rpn target maps of a batch of padded gt boxes, assigned in the graph of the step
+    maps = self.target_assigner.assign_tf(gt_boxes, num_gt_boxes)
+    return [maps[key] for key in ["targets", "pos_equal_one", "pos_equal_one_reg", "pos_equal_one_sum", "neg_equal_one", "neg_equal_one_sum"]]
+
   def train_step(self, feature_buffer, 
                  coordinate_buffer,
-                 targets, 
-                 pos_equal_one, 
-                 pos_equal_one_reg,
-                 pos_equal_one_sum,
-                 neg_equal_one, 
-                 neg_equal_one_sum):
+                 targets=None, 
+                 pos_equal_one=None, 
+                 pos_equal_one_reg=None,
+                 pos_equal_one_sum=None,
+                 neg_equal_one=None, 
+                 neg_equal_one_sum=None,
+                 gt_boxes=None,
+                 num_gt_boxes=None):
+    # either the dense rpn target maps or the padded gt boxes of the batch (see rpn_target_args)
+    if gt_boxes is not None:
+      targets, pos_equal_one, pos_equal_one_reg, pos_equal_one_sum, neg_equal_one, neg_equal_one_sum = self.rpn_targets(gt_boxes, num_gt_boxes)
     print('begin train step:')
     with tf.GradientTape() as tape:
       p_map, r_map = self.call(training=True, 
@@ -305,12 +467,16 @@ class Model(tf.keras.Model):
 
   def validate_step(self, feature_buffer,
                              coordinate_buffer,
-                             targets,
-                             pos_equal_one,
-                             pos_equal_one_reg,
-                             pos_equal_one_sum,
-                             neg_equal_one,
-                             neg_equal_one_sum):
+                             targets=None,
+                             pos_equal_one=None,
+                             pos_equal_one_reg=None,
+                             pos_equal_one_sum=None,
+                             neg_equal_one=None,
+                             neg_equal_one_sum=None,
+                             gt_boxes=None,
+                             num_gt_boxes=None):
+    if gt_boxes is not None:
+      targets, pos_equal_one, pos_equal_one_reg, pos_equal_one_sum, neg_equal_one, neg_equal_one_sum = self.rpn_targets(gt_boxes, num_gt_boxes)
     p_map, r_map = self.call(training=False, 
                               feature_buffer=feature_buffer, 
                               coordinate_buffer=coordinate_buffer)
@@ -325,26 +491,102 @@ class Model(tf.keras.Model):
 
   def dist_validate_step(self, feature_buffer,
                             coordinate_buffer,
-                            targets,
-                            pos_equal_one,
-                            pos_equal_one_reg,
-                            pos_equal_one_sum,
-                            neg_equal_one,
-                            neg_equal_one_sum):
-    per_replica_losses = self.strategy.run(self.train_step,
-                                                    args=(feature_buffer, 
-                                                          coordinate_buffer,
-                                                          targets, 
-                                                          pos_equal_one, 
-                                                          pos_equal_one_reg,
-                                                          pos_equal_one_sum,
-                                                          neg_equal_one, 
-                                                          neg_equal_one_sum))
-    return self.strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_losses,
-                          axis=None)
-      
+                            **rpn_targets):
+    # forward pass and losses only (validate_step), rpn_targets as the kwargs of validate_step
+    per_replica_losses = self.strategy.run(self.validate_step,
+                                           args=(feature_buffer, coordinate_buffer),
+                                           kwargs=rpn_targets)
+    return [self.strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_loss,
+                                 axis=None) for per_replica_loss in per_replica_losses]
+
+  def decode_boxes3d(self, deltas, anchors):
+    # delta_to_boxes3d with tensorflow ops : [..., 7] deltas of their [..., 7] anchors -> [..., 7] boxes
+    anchors_d = tf.sqrt(anchors[..., 4:5]**2 + anchors[..., 5:6]**2)
+    return tf.concat([deltas[..., 0:2] * anchors_d + anchors[..., 0:2],
+                      deltas[..., 2:3] * self.cfg.ANCHOR_H + anchors[..., 2:3],
+                      tf.exp(deltas[..., 3:6]) * anchors[..., 3:6],
+                      deltas[..., 6:7] + anchors[..., 6:7]], axis=-1)
+
+  def detect(self, p_map, r_map):
+    """
+      Decodes the best boxes over the score threshold of every frame and runs the nms of cfg (rotated or
+      standup) on all the frames at once
+      Args:
+        p_map : [batch_size, h, w, 2] probability map
+        r_map : [batch_size, h, w, 14] regression map
+      Returns:
+        boxes3d : [batch_size, RPN_NMS_POST_TOPK, 7] kept boxes by decreasing score, zero padded
+        scores : [batch_size, RPN_NMS_POST_TOPK] their scores
+        num_boxes : [batch_size] number of kept boxes
+    """
+    cfg = self.cfg
+    batch_size = tf.shape(p_map)[0]
+    probs = tf.reshape(p_map, [batch_size, -1])
+    deltas = tf.reshape(r_map, [batch_size, -1, 7])
+    # score threshold, then only the RPN_NMS_PRE_TOPK best anchors over it are decoded
+    probs = tf.where(probs >= cfg.RPN_SCORE_THRESH, probs, -np.inf)
+    k = min(cfg.RPN_NMS_PRE_TOPK, self.anchors.shape[0]) if cfg.RPN_NMS_PRE_TOPK else self.anchors.shape[0]
+    scores, ind = tf.math.top_k(probs, k=k)
+    num_valid = tf.reduce_sum(tf.cast(scores > -np.inf, tf.int32), axis=1)
+    boxes3d = self.decode_boxes3d(tf.gather(deltas, ind, batch_dims=1), tf.gather(self.anchors, ind))
+
+    if cfg.RPN_NMS_ROTATED and cfg.RPN_NMS_HOST:
+      keep, num_boxes = tf.numpy_function(lambda boxes2d, num_valid: rotated_nms_frames(boxes2d, num_valid, cfg.RPN_NMS_THRESH, cfg.RPN_NMS_POST_TOPK),
+                                          [tf.gather(boxes3d, [0, 1, 4, 5, 6], axis=-1), num_valid], [tf.int32, tf.int32])
+      keep.set_shape([None, cfg.RPN_NMS_POST_TOPK])
+      num_boxes.set_shape([None])
+    elif cfg.RPN_NMS_ROTATED:
+      keep, num_boxes = rotated_nms_sorted_tf(tf.gather(boxes3d, [0, 1, 4, 5, 6], axis=-1), num_valid, cfg.RPN_NMS_THRESH, cfg.RPN_NMS_POST_TOPK)
+    else:
+      # standup boxes of center_to_corner_box2d, which lays the box on its w side
+      half = boxes3d[..., 4] / 2
+      dx, dy = tf.abs(tf.sin(boxes3d[..., 6])) * half, tf.abs(tf.cos(boxes3d[..., 6])) * half
+      standup = tf.stack([boxes3d[..., 0] - dx, boxes3d[..., 1] - dy, boxes3d[..., 0] + dx, boxes3d[..., 1] + dy], axis=-1)
+      # batched nms (tf.image.combined_non_max_suppression does not return the indices of the boxes)
+      keep, num_boxes = tf.image.non_max_suppression_padded(standup, scores, cfg.RPN_NMS_POST_TOPK, iou_threshold=cfg.RPN_NMS_THRESH,
+                                                            score_threshold=cfg.RPN_SCORE_THRESH, pad_to_max_output_size=True,
+                                                            sorted_input=True)
+
+    kept = tf.range(cfg.RPN_NMS_POST_TOPK)[tf.newaxis] < num_boxes[:, tf.newaxis]
+    keep = tf.where(kept, keep, 0)
+    return (tf.where(kept[..., tf.newaxis], tf.gather(boxes3d, keep, batch_dims=1), 0.),
+            tf.where(kept, tf.gather(scores, keep, batch_dims=1), 0.), num_boxes)
+
+  def predict_dataset(self):
+    """
+      Distributed dataset of a dummy batch (one empty voxel per frame, at the origin of the first frame of
+      the replica) with the element spec of the batches of Data_helper : any batch size and voxel count (and
+      row count of the flat point lists, --ragged_vfe). Its spec is the input signature of
+      predict_step_function, its batch warms it up (see warmup_predict)
+    """
+    if self.params.get("ragged_vfe"):
+      example = {"point_features" : np.zeros((1, 7), dtype=np.float32),
+                 "point_voxel" : np.zeros((1,), dtype=np.int32)}
+      signature = {"point_features" : tf.TensorSpec([None, 7], tf.float32),
+                   "point_voxel" : tf.TensorSpec([None], tf.int32)}
+    else:
+      example = {"feature_buffer" : np.zeros((1, self.cfg.MAX_POINT_NUMBER, 7), dtype=np.float32)}
+      signature = {"feature_buffer" : tf.TensorSpec([None, self.cfg.MAX_POINT_NUMBER, 7], tf.float32)}
+    example["coordinate_buffer"] = np.zeros((1, 4), dtype=np.int32)
+    signature["coordinate_buffer"] = tf.TensorSpec([None, 4], tf.int32)
+    dataset = tf.data.Dataset.from_generator(lambda: [example]*self.params["batch_size"],
+                                             output_signature=signature)
+    return self.strategy.experimental_distribute_dataset(dataset.padded_batch(self.params["batch_size"]))
+
+  def distributed_predict_step(self, feature_buffer, coordinate_buffer):
+    return self.strategy.run(self._predict_step, args=(feature_buffer, coordinate_buffer))
+
+  def warmup_predict(self):
+    # traces predict_step_function on a dummy batch, before the first prediction
+    start = time.time()
+    batch = next(iter(self.predict_dataset()))
+    self.predict_step_function(self.voxel_input(batch), batch["coordinate_buffer"])
+    print("prediction function warmed up in {:.1f}s".format(time.time() - start))
+
   def _predict_step(self, feature_buffer, coordinate_buffer):
+    # the probability map is only fetched by the host for the heatmaps
     p_map, r_map = self.call(training=False, 
                               feature_buffer=feature_buffer, 
                               coordinate_buffer=coordinate_buffer)
-    return p_map, r_map
+    boxes3d, scores, num_boxes = self.detect(p_map, r_map)
+    return p_map, boxes3d, scores, num_boxes
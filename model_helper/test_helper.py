@@ -1,54 +1,35 @@
 import tensorflow as tf
+import numpy as np
 import os
+import cv2
 from config import cfg
-from utils.utils import *
+from utils.utils import label_to_gt_box3d, draw_lidar_box3d_on_image, lidar_to_bird_view_img, draw_lidar_box3d_on_birdview, box3d_to_label
 from utils.colorize import colorize
 
   
 
-def predict_step(model, batch, anchors, cfg, params, summary=False, vis=False):
+def predict_step(model, batch, cfg, params, summary=False, vis=False, batcher=None):
+  # batcher: Data_helper of the batch, needed for summary and vis : the image, the point cloud and the
+  # calibration of the visualized frames are fetched by tag
   print('\033[1;31mbegin predict step:\033[', end = '')
 
-  @tf.function
-  def distributed_predict_step():
-    return model.strategy.run(model._predict_step, args=(batch["feature_buffer"], batch["coordinate_buffer"]))
-
   tag = batch["tag"].numpy().astype(str)
 
   if summary or vis:
     batch_gt_boxes3d = label_to_gt_box3d(batch["labels"], cls=cfg.DETECT_OBJECT)
   print('predict', tag, end = '')
 
-  res = distributed_predict_step()
+  # compiled once for all the batches (Model.predict_step_function)
+  res = model.predict_step_function(model.voxel_input(batch), batch["coordinate_buffer"])
   #print('1. finish distributed predict step.')
+  # the boxes are decoded and suppressed on device (Model.detect) : only the kept boxes are copied to the host
   if model.strategy.num_replicas_in_sync > 1:
-    probs, deltas = tf.concat(res[0].values, axis=0).numpy(), tf.concat(res[1].values, axis=0).numpy()
-  else:
-    probs, deltas = res[0].numpy(), res[1].numpy()
-  batch_boxes3d = delta_to_boxes3d(deltas, anchors, coordinate='lidar')
-  batch_boxes2d = batch_boxes3d[:, :, [0, 1, 4, 5, 6]]
-  batch_probs = probs.reshape((params["batch_size"], -1))
-  #print('2. finish delta to boxes3d.')
-
-  # NMS
-  ret_box3d = []
-  ret_score = []
-  for batch_id in range(params["batch_size"]):
-    # remove box with low score
-    ind = np.where(batch_probs[batch_id, :] >= cfg.RPN_SCORE_THRESH)[0]
-    tmp_boxes3d = batch_boxes3d[batch_id, ind, ...]
-    tmp_boxes2d = batch_boxes2d[batch_id, ind, ...]
-    tmp_scores = batch_probs[batch_id, ind].astype(np.float32)
-    # TODO: if possible, use rotate NMS
-    boxes2d = corner_to_standup_box2d(center_to_corner_box2d(tmp_boxes2d, coordinate='lidar')).astype(np.float32)
-    #print('3. finish corner to standup box2d.')
-    ind = tf.image.non_max_suppression(boxes2d, tmp_scores,max_output_size=cfg.RPN_NMS_POST_TOPK, iou_threshold=cfg.RPN_NMS_THRESH )
-    ind = ind.numpy()
-    tmp_boxes3d = tmp_boxes3d[ind, ...]
-    tmp_scores = tmp_scores[ind]
-    ret_box3d.append(tmp_boxes3d)
-    ret_score.append(tmp_scores)
-    #print('4. finish non max suppression.')
+    res = [tf.concat(r.values, axis=0) for r in res]
+  boxes3d, scores, num_boxes = res[1].numpy(), res[2].numpy(), res[3].numpy()
+  ret_box3d = [boxes3d[i, :num_boxes[i]] for i in range(len(num_boxes))]
+  ret_score = [scores[i, :num_boxes[i]] for i in range(len(num_boxes))]
+  if summary or vis:
+    probs = res[0].numpy()
 
   ret_box3d_score = []
   #print(f'ret_box3d:{len(ret_box3d)}, ret_score:{len(ret_score)}')
@@ -67,18 +48,23 @@ def predict_step(model, batch, anchors, cfg, params, summary=False, vis=False):
   #   print(scores[:, np.newaxis])
   # print(f'finish NMS.summary:{summary},vis:{vis}')
 
-  img = 255. * batch["img"].numpy() #tensorflow scales the image between 0 and 1 when reading it, we need to rescale it between 0 and 255
+  def frame_img(cur_tag):
+    #tensorflow scales the image between 0 and 1 when reading it, we need to rescale it between 0 and 255
+    return 255. * batcher.load_image(cur_tag, cfg, batcher.mode).numpy()
+
+  if (summary or vis) and batcher is None:
+    raise ValueError("predict_step needs the batcher of the batch to fetch the images and point clouds of the visualizations")
+
   if summary:
     # only summary 1 in a batch
     cur_tag = tag[0]
-    _, Tr, P = load_calib(os.path.join(cfg.CALIB_DIR, cur_tag + '.json'))
+    _, Tr, P = batcher.load_calib(cur_tag)
 
-    front_image = draw_lidar_box3d_on_image(img[0], ret_box3d[0], ret_score[0],
+    front_image = draw_lidar_box3d_on_image(frame_img(cur_tag), ret_box3d[0], ret_score[0],
                                                   batch_gt_boxes3d[0], P2=P, T_VELO_2_CAM=Tr)
     #print('finish drawing prediction on image.')
 
-    n_points = batch["num_points"][0].numpy()
-    lidar = batch["lidar"][0][0:n_points,].numpy()
+    lidar = batcher.load_lidar(cur_tag)
     bird_view = lidar_to_bird_view_img(lidar, factor=cfg.BV_LOG_FACTOR)
               
     bird_view = draw_lidar_box3d_on_birdview(bird_view, ret_box3d[0], ret_score[0],
@@ -91,13 +77,12 @@ def predict_step(model, batch, anchors, cfg, params, summary=False, vis=False):
 
   if vis:
     front_images, bird_views, heatmaps = [], [], []
-    for i in range(len(img)):
+    for i in range(len(tag)):
       cur_tag = tag[i]
-      n_points = batch["num_points"][i].numpy()
-      lidar = batch["lidar"][i][0:n_points,].numpy()
-      _, Tr, P = load_calib( os.path.join( cfg.CALIB_DIR, cur_tag + '.json' ) )
+      lidar = batcher.load_lidar(cur_tag)
+      _, Tr, P = batcher.load_calib(cur_tag)
               
-      front_image = draw_lidar_box3d_on_image(img[i], ret_box3d[i], ret_score[i],
+      front_image = draw_lidar_box3d_on_image(frame_img(cur_tag), ret_box3d[i], ret_score[i],
                                         batch_gt_boxes3d[i], P2=P, T_VELO_2_CAM=Tr)
                                         
       bird_view = lidar_to_bird_view_img(lidar, factor=cfg.BV_LOG_FACTOR)
@@ -128,11 +113,11 @@ def predict(strategy, model, test_batcher, params, cfg):
   for batch in test_batcher:
     if params["dump_vis"]:
       #res = model.predict_step(batch, test_batcher.anchors, summary=False, vis=True)
-      res = predict_step(model, batch,  test_batcher.anchors, cfg, params, summary=False, vis=True)
+      res = predict_step(model, batch, cfg, params, summary=False, vis=True, batcher=test_batcher)
       tags, results, front_images, bird_views, heatmaps = res["tag"], res["scores"], res["front_image"], res["bird_view"], res["heatmap"]
     else:
       #res = model.predict_step(batch, test_batcher.anchors, summary=False, vis=False)
-      res =predict_step(model, batch,  test_batcher.anchors, cfg, params,  summary=False, vis=False)
+      res =predict_step(model, batch, cfg, params,  summary=False, vis=False, batcher=test_batcher)
       tags, results = res["tag"], res["scores"]
     # ret: A, B
     # A: (N) tag
@@ -140,7 +125,7 @@ def predict(strategy, model, test_batcher, params, cfg):
     for tag, result in zip(tags, results):
       of_path = os.path.join(predictions_path, 'data', tag + '.txt')
       with open(of_path, 'w+') as f:
-        labels = box3d_to_label([result[:, 1:8]], [result[:, 0]], [result[:, -1]], coordinate='lidar')[0]
+        labels = box3d_to_label(tag, [result[:, 1:8]], [result[:, 0]], [result[:, -1]], coordinate='lidar', calib=test_batcher.load_calib(tag))[0]
         for line in labels:
           f.write(line)
         print('write out {} objects to {}'.format(len(labels), tag))
@@ -152,4 +137,7 @@ def predict(strategy, model, test_batcher, params, cfg):
           heatmap_path = os.path.join( predictions_path, 'vis', tag + '_heatmap.jpg'  )
         cv2.imwrite( front_img_path, front_image )
         cv2.imwrite( bird_view_path, bird_view )
-        cv2.imwrite( heatmap_path, heatmap )
\ No newline at end of file
+        cv2.imwrite( heatmap_path, heatmap )
+
+  # traced twice by its first call, which creates the model variables, then never retraced by the batches
+  print("prediction function traced {} time(s)".format(model.predict_step_function.experimental_get_tracing_count()))
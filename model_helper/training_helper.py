@@ -18,13 +18,13 @@ def train_summary(writer, metrics):
     tf.summary.scalar('train/cls_neg_loss', metrics[4])
     [tf.summary.histogram(each.name, each) for each in metrics[5]]
 
-def val_summary(writer, metrics):
+def val_summary(writer, metrics, prefix="validate"):
   with writer.as_default():
-    tf.summary.scalar('validate/loss', metrics[0])
-    tf.summary.scalar('validate/reg_loss', metrics[1])
-    tf.summary.scalar('validate/cls_loss', metrics[2])
-    tf.summary.scalar('validate/cls_pos_loss', metrics[3])
-    tf.summary.scalar('validate/cls_neg_loss', metrics[4])
+    tf.summary.scalar(prefix+'/loss', metrics[0])
+    tf.summary.scalar(prefix+'/reg_loss', metrics[1])
+    tf.summary.scalar(prefix+'/cls_loss', metrics[2])
+    tf.summary.scalar(prefix+'/cls_pos_loss', metrics[3])
+    tf.summary.scalar(prefix+'/cls_neg_loss', metrics[4])
 
 def pred_summary(writer, metrics):
   with writer.as_default():
@@ -35,6 +35,15 @@ def pred_summary(writer, metrics):
 def epoch_counter(current_step, num_batches):
   return int(current_step//num_batches) +1
 
+def rpn_target_args(batch):
+  # rpn target arguments of the train step : the dense target maps of the batch, or its padded gt boxes
+  # when the targets are assigned in the step (--in_graph_rpn_targets)
+  if "gt_boxes" in batch:
+    keys = ["gt_boxes", "num_gt_boxes"]
+  else:
+    keys = ["targets", "pos_equal_one", "pos_equal_one_reg", "pos_equal_one_sum", "neg_equal_one", "neg_equal_one_sum"]
+  return {key: batch[key] for key in keys}
+
 def train_epochs( model, train_batcher, rand_test_batcher, val_batcher,  params, cfg,
                  ckpt, ckpt_manager, strategy):
   
@@ -51,34 +60,42 @@ def train_epochs( model, train_batcher, rand_test_batcher, val_batcher,  params,
     # print(batch["neg_equal_one"].shape)
     # print(batch["neg_equal_one_sum"].shape)
     per_replica_losses = strategy.run(model.train_step,
-                                                      args=(batch["feature_buffer"], 
-                                                            batch["coordinate_buffer"],
-                                                            batch["targets"], 
-                                                            batch["pos_equal_one"], 
-                                                            batch["pos_equal_one_reg"],
-                                                            batch["pos_equal_one_sum"],
-                                                            batch["neg_equal_one"], 
-                                                            batch["neg_equal_one_sum"]))
+                                      args=(model.voxel_input(batch), batch["coordinate_buffer"]),
+                                      kwargs=rpn_target_args(batch))
     #print('finish experimental_run_v2.')
     return [strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_loss,
                           axis=None) for per_replica_loss in per_replica_losses]
 
+  # mean losses of the steps run since the last log
+  loss_metrics = [tf.keras.metrics.Mean(name) for name in ["loss", "reg_loss", "cls_loss", "cls_pos_loss", "cls_neg_loss"]]
+
+  @tf.function
+  def distributed_train_steps(num_steps):
+    # num_steps train steps in one call (a tf.while_loop), their losses accumulated in loss_metrics. The
+    # metrics are updated in every replica (the variables of the metrics created in the scope of a
+    # MirroredStrategy sum their replicas), with the reduced losses
+    for _ in tf.range(num_steps):
+      losses = distributed_train_step()
+      for metric, loss in zip(loss_metrics, losses):
+        strategy.run(metric.update_state, args=(loss,))
+
   @tf.function
   def distributed_validate_step():
     #print('start dis vali step.')
     batch = next(rand_test_batcher)
     #print(f'dis vali step. batch:{batch}')
-    per_replica_losses = strategy.run(model.train_step,
-                                                    args=(batch["feature_buffer"], 
-                                                          batch["coordinate_buffer"],
-                                                          batch["targets"], 
-                                                          batch["pos_equal_one"], 
-                                                          batch["pos_equal_one_reg"],
-                                                          batch["pos_equal_one_sum"],
-                                                          batch["neg_equal_one"], 
-                                                          batch["neg_equal_one_sum"]))
-    return [strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_loss,
-                          axis=None) for per_replica_loss in per_replica_losses], batch
+    return model.dist_validate_step(model.voxel_input(batch), batch["coordinate_buffer"], **rpn_target_args(batch)), batch
+
+  @tf.function
+  def distributed_validate_epoch():
+    # mean losses over the whole validation set, accumulated in the graph. Only the full batches are
+    # run, the outputs of the model having its static batch size
+    sums, num_batches = [tf.constant(0.)]*5, tf.constant(0.)
+    for batch in val_batcher.full_batches():
+      losses = model.dist_validate_step(model.voxel_input(batch), batch["coordinate_buffer"], **rpn_target_args(batch))
+      sums = [total + loss for total, loss in zip(sums, losses)]
+      num_batches += 1.
+    return [total / tf.maximum(num_batches, 1.) for total in sums], num_batches
 
   dump_vis = params["dump_vis"] # bool
   kitti_eval_script = cfg.KITTY_EVAL_SCRIPT
@@ -101,54 +118,82 @@ def train_epochs( model, train_batcher, rand_test_batcher, val_batcher,  params,
 
   epoch = ckpt.epoch
   epoch.assign(epoch_counter(ckpt.step.numpy(), train_batcher.num_examples))
+
+  # the train steps run by chunks of steps_per_execution steps in one call of distributed_train_steps : the
+  # losses are read, logged and summarized once per chunk (their means over the chunk), the summaries and
+  # checkpoints of the steps of a chunk are done at its end
+  steps_per_execution = max(1, params.get("steps_per_execution", 1))
+  train_log = open('{}/train.txt'.format(logdir), 'a')
   
   try:
     while epoch.numpy() <= params["n_epochs"]:
       num_batches = train_batcher.num_examples//params["batch_size"]+(1 if train_batcher.num_examples%params["batch_size"]==1 else 0)
-      for step in range(num_batches):
+      chunk_start = 0
+      while chunk_start < num_batches:
 
         epoch.assign(epoch_counter(ckpt.step.numpy(), num_batches))
         if epoch.numpy() > params["n_epochs"]:
           break
-        
-        global_step = ckpt.step.numpy()
+        # a chunk ends with the epoch of epoch_counter at the latest
+        num_steps = min(steps_per_execution, num_batches - chunk_start, num_batches - ckpt.step.numpy() % num_batches)
+        chunk_steps = range(chunk_start, chunk_start + num_steps)
+        chunk_start += num_steps
+        # the last step of the chunk
+        step = chunk_steps[-1]
+        global_step = ckpt.step.numpy() + num_steps - 1
         tf.summary.experimental.set_step(global_step)
 
         #print('begin distributed train step:')
         t0 = time.time()
-        losses = distributed_train_step()
-        t1 = time.time() - t0
+        distributed_train_steps(tf.constant(num_steps))
+        losses = [metric.result().numpy() for metric in loss_metrics]
+        for metric in loss_metrics:
+          metric.reset_state()
+        t1 = (time.time() - t0) / num_steps
         #print('finish distributed train step, result:')
 
-        print('train: {} @ epoch:{}/{} global_step:{} loss: {} reg_loss: {} cls_loss: {} cls_pos_loss: {} cls_neg_loss: {} batch time: {:.4f}'.format(step+1, epoch.numpy(), params["n_epochs"], ckpt.step.numpy(), colored('{:.4f}'.format(losses[0]), "red"), colored('{:.4f}'.format(losses[1]), "magenta"), colored('{:.4f}'.format(losses[2]), "yellow"), colored('{:.4f}'.format(losses[3]), "blue"), colored('{:.4f}'.format(losses[4]), "cyan"),  t1))
-        with open('{}/train.txt'.format(logdir), 'a') as f:
-          f.write( 'train: {} @ epoch:{}/{} global_step:{} loss: {:.4f} reg_loss: {:.4f} cls_loss: {:.4f} cls_pos_loss: {:.4f} cls_neg_loss: {:.4f} batch time: {:.4f} \n'.format(step+1, epoch.numpy(), params["n_epochs"], ckpt.step.numpy(), losses[0], losses[1], losses[2], losses[3], losses[4], t1) )
-                        
-        if (step+1) % summary_interval == 0:
+        print('train: {} @ epoch:{}/{} global_step:{} loss: {} reg_loss: {} cls_loss: {} cls_pos_loss: {} cls_neg_loss: {} batch time: {:.4f}'.format(step+1, epoch.numpy(), params["n_epochs"], global_step, colored('{:.4f}'.format(losses[0]), "red"), colored('{:.4f}'.format(losses[1]), "magenta"), colored('{:.4f}'.format(losses[2]), "yellow"), colored('{:.4f}'.format(losses[3]), "blue"), colored('{:.4f}'.format(losses[4]), "cyan"),  t1))
+        train_log.write( 'train: {} @ epoch:{}/{} global_step:{} loss: {:.4f} reg_loss: {:.4f} cls_loss: {:.4f} cls_pos_loss: {:.4f} cls_neg_loss: {:.4f} batch time: {:.4f} \n'.format(step+1, epoch.numpy(), params["n_epochs"], global_step, losses[0], losses[1], losses[2], losses[3], losses[4], t1) )
+        ckpt.step.assign(global_step)
+
+        if any((s+1) % summary_interval == 0 for s in chunk_steps):
           train_summary(summary_writer, list(losses)+[model.trainable_variables])
 
-        if (step+1) % summary_val_interval == 0:
+        if any((s+1) % summary_val_interval == 0 for s in chunk_steps):
           print("summary_val_interval now")
 
           ret, batch = distributed_validate_step()
           val_summary(summary_writer, ret)
           try:
-            ret = predict_step( model, batch, train_batcher.anchors, cfg, params, summary=True)
+            ret = predict_step( model, batch, cfg, params, summary=True, batcher=rand_test_batcher)
             pred_summary(summary_writer, ret)
           except Exception as ex:
             print("".join(traceback.TracebackException.from_exception(ex).format()))
             print(f"prediction skipped due to error: {str(ex)}")
 
-        if (step+1) % summary_flush_interval==0:
+        if any((s+1) % summary_flush_interval == 0 for s in chunk_steps):
           summary_writer.flush()
+          train_log.flush()
         
-        if global_step%train_batcher.num_examples==0:
+        if any(g % train_batcher.num_examples == 0 for g in range(global_step - num_steps + 1, global_step + 1)):
           ckpt_manager.save(checkpoint_number=ckpt.step.numpy())
           print("Saved checkpoint for step {}".format(ckpt.step.numpy()))
           summary_writer.flush()
 
         ckpt.step.assign_add(1)
 
+      # validation losses over the whole validation set every val_interval epochs (not after the last one,
+      # where the loop stops)
+      if params.get("val_interval", 0) > 0 and epoch.numpy() % params["val_interval"] == 0 and epoch.numpy() <= params["n_epochs"]:
+        t0 = time.time()
+        losses, num_batches = distributed_validate_epoch()
+        t1 = time.time() - t0
+        print('validate: epoch:{}/{} global_step:{} batches: {} loss: {:.4f} reg_loss: {:.4f} cls_loss: {:.4f} cls_pos_loss: {:.4f} cls_neg_loss: {:.4f} time: {:.4f}'.format(epoch.numpy(), params["n_epochs"], ckpt.step.numpy(), int(num_batches), *[float(loss) for loss in losses], t1))
+        with open('{}/validate.txt'.format(logdir), 'a') as f:
+          f.write('validate: epoch:{}/{} global_step:{} batches: {} loss: {:.4f} reg_loss: {:.4f} cls_loss: {:.4f} cls_pos_loss: {:.4f} cls_neg_loss: {:.4f} time: {:.4f} \n'.format(epoch.numpy(), params["n_epochs"], ckpt.step.numpy(), int(num_batches), *[float(loss) for loss in losses], t1))
+        tf.summary.experimental.set_step(ckpt.step.numpy())
+        val_summary(summary_writer, losses, prefix="validate_epoch")
+
       # dump test data every 10 epochs
       
       if ( epoch.numpy()  ) % dump_interval == 0 :
@@ -161,15 +206,15 @@ def train_epochs( model, train_batcher, rand_test_batcher, val_batcher,  params,
                       
         for eval_step, batch in enumerate(val_batcher.batcher):
           if dump_vis:
-            res = predict_step(model, batch,  train_batcher.anchors, cfg, params, summary=False, vis=True)
+            res = predict_step(model, batch, cfg, params, summary=False, vis=True, batcher=val_batcher)
             tags, results, front_images, bird_views, heatmaps = res["tag"], res["scores"], res["front_image"], res["bird_view"], res["heatmap"]
           else:
-            res = predict_step( model, batch,  train_batcher.anchors, cfg, params, summary=False, vis=False)
+            res = predict_step( model, batch, cfg, params, summary=False, vis=False, batcher=val_batcher)
             tags, results = res["tag"], res["scores"]
           for tag, result in zip(tags, results):
             of_path = os.path.join(dump_test_logdir, str(epoch.numpy()), 'data', tag + '.txt')
             with open(of_path, 'w+') as f:
-              labels = box3d_to_label(tag, [result[:, 1:8]], [result[:, 0]], [result[:, -1]], coordinate='lidar')[0]
+              labels = box3d_to_label(tag, [result[:, 1:8]], [result[:, 0]], [result[:, -1]], coordinate='lidar', calib=val_batcher.load_calib(tag))[0]
               for line in labels:
                 f.write(line)
               print('write out {} objects to {}'.format(len(labels), tag))
@@ -183,6 +228,7 @@ def train_epochs( model, train_batcher, rand_test_batcher, val_batcher,  params,
               cv2.imwrite( bird_view_path, bird_view )
               cv2.imwrite( heatmap_path, heatmap )
               print('write out 3 (front image, bird view and heatmap) jpegs to {}'.format(tag))
+        print("prediction function traced {} time(s)".format(model.predict_step_function.experimental_get_tracing_count()))
           
         
         # execute evaluation code
@@ -198,3 +244,5 @@ def train_epochs( model, train_batcher, rand_test_batcher, val_batcher,  params,
     summary_writer.flush()
   except Exception as e:
     print(f"Unexpected exception happened: {str(e)}")
+  finally:
+    train_log.close()
@@ -29,6 +29,18 @@ def main():
   parser.add_argument("--model_dir", default="", help="Directory to save the models, the viz and the logs", type=str)
   parser.add_argument("--model_name", default="", help="Model Name", type=str)
   parser.add_argument("--ckpt_name", default="", help="Checkpoint to evaluate name, if empty uses the latest checkpoint", type=str) 
+  parser.add_argument("--manifest_dir", default="", help="Directory of the cached split manifests (file listings), the split directories are listed at startup if empty", type=str)
+  parser.add_argument("--input_backend", default="generator", help="Input pipeline backend (options : generator for a python generator, tfdata for tf.data reads with a parallel map)", type=str)
+  parser.add_argument("--voxel_cache_dir", default="", help="Directory of the on-disk voxel cache of the non augmented datasets, disabled if empty", type=str)
+  parser.add_argument("--radar_pack_dir", default="", help="Directory of the packed radar shards (see utils/radar_pack.py), one file per frame is read if empty (the tfdata backend always reads the frame files)", type=str)
+  parser.add_argument("--label_index_dir", default="", help="Directory of the columnar label and calibration indexes, labels and calibrations are read from the json files if empty", type=str)
+  parser.add_argument("--num_workers", default=0, help="Number of sample producer processes per dataset, 0 to produce the samples in the tf.data generator thread (the producers ship sparse rpn targets, see --sparse_rpn_targets)", type=int)
+  parser.add_argument("--worker_queue_size", default=0, help="Max number of produced samples waiting in the queue of each worker, 4 if 0", type=int)
+  parser.add_argument("--max_voxels", default=0, help="Max number of voxels per frame, the others are dropped (0 for no cap)", type=int)
+  parser.add_argument("--voxel_drop_policy", default="dense", help="Voxels kept under --max_voxels (options : dense keeps the voxels with the most points, random a random subset)", type=str)
+  parser.add_argument("--bucket_boundaries", default=[], nargs="*", help="Voxel count boundaries of the batching buckets (ex : 2000 4000 8000), no bucketing if empty", type=int)
+  parser.add_argument("--warmup_predict", default="no", help="Boolean to compile the prediction function at startup, before the first batch (yes or no)", type=str2bool)
+  parser.add_argument("--ragged_vfe", default="no", help="Boolean to ship the voxels as flat point lists and run the VFE layers on their rows only, instead of the padded feature buffer (yes or no)", type=str2bool)
 
   args = parser.parse_args()
   params = vars(args)
@@ -90,7 +102,11 @@ def main():
     ckpt.restore(p)
     print("Restored from {}".format(p))
 
-  predict(strategy, model, test_batcher,  params, cfg)
+  # the prediction function is traced in the scope of the strategy, as the warm up
+  with strategy.scope():
+    if params["warmup_predict"]:
+      model.warmup_predict()
+    predict(strategy, model, test_batcher,  params, cfg)
 
 if __name__ =="__main__":
   main()
\ No newline at end of file
@@ -1,9 +1,16 @@
+import sys
 from distutils.core import setup
+from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# the box overlap kernels run their loops on OpenMP threads (see utils/box_overlaps.pyx)
+openmp_flags = ['/openmp'] if sys.platform == 'win32' else ['-fopenmp']
+
 setup(
     name='box overlaps',
-    ext_modules=cythonize('./utils/box_overlaps.pyx'),
+    ext_modules=cythonize([Extension('utils.box_overlaps', ['./utils/box_overlaps.pyx'],
+                                     extra_compile_args=openmp_flags,
+                                     extra_link_args=openmp_flags if sys.platform != 'win32' else [])]),
     include_dirs=[numpy.get_include()]
-)
\ No newline at end of file
+)
@@ -53,8 +53,28 @@ def main():
   parser.add_argument("--dump_test_interval", default=-1, help="Launch a dump test every n epochs", type=int)
   parser.add_argument("--summary_interval",default=-1, help="Save the training summary every n steps", type=int)
   parser.add_argument("--summary_val_interval", default=-1, help="Run an evaluation of the model and save the summary  every n steps and", type=int)
+  parser.add_argument("--val_interval", default=0, help="Compute the losses over the whole validation set every n epochs (0 to disable)", type=int)
+  parser.add_argument("--steps_per_execution", default=1, help="Number of train steps run in one call of the compiled train loop, the losses are logged once per call (their means)", type=int)
   parser.add_argument("--summary_flush_interval", default=-1, help="Flush the summaries every n steps", type=int)
   parser.add_argument("--ckpt_max_keep", default=11, help="Max checkpoints to keep", type=int) 
+  parser.add_argument("--manifest_dir", default="", help="Directory of the cached split manifests (file listings), the split directories are listed at startup if empty", type=str)
+  parser.add_argument("--input_backend", default="generator", help="Input pipeline backend (options : generator for a python generator, tfdata for tf.data reads with a parallel map)", type=str)
+  parser.add_argument("--voxel_cache_dir", default="", help="Directory of the on-disk voxel cache of the raw frames (non augmented datasets, and frames left unchanged by the augmentation with --aug_memo_size), disabled if empty", type=str)
+  parser.add_argument("--radar_pack_dir", default="", help="Directory of the packed radar shards (see utils/radar_pack.py), one file per frame is read if empty (the tfdata backend always reads the frame files)", type=str)
+  parser.add_argument("--label_index_dir", default="", help="Directory of the columnar label and calibration indexes, labels and calibrations are read from the json files if empty", type=str)
+  parser.add_argument("--num_workers", default=0, help="Number of sample producer processes per dataset, 0 to produce the samples in the tf.data generator thread (the producers ship sparse rpn targets, see --sparse_rpn_targets)", type=int)
+  parser.add_argument("--worker_queue_size", default=0, help="Max number of produced samples waiting in the queue of each worker, 4 if 0", type=int)
+  parser.add_argument("--sparse_rpn_targets", default="no", help="Boolean to ship the rpn targets as sparse indices and rebuild the dense maps at batch time (yes or no)", type=str2bool)
+  parser.add_argument("--in_graph_rpn_targets", default="no", help="Boolean to ship only the padded gt boxes in the batches and assign the rpn targets in the train step (yes or no, overrides --sparse_rpn_targets)", type=str2bool)
+  parser.add_argument("--rpn_target_cache_dir", default="", help="Directory of the on-disk sparse rpn target store, in memory only if empty", type=str)
+  parser.add_argument("--max_voxels", default=0, help="Max number of voxels per frame, the others are dropped (0 for no cap)", type=int)
+  parser.add_argument("--voxel_drop_policy", default="dense", help="Voxels kept under --max_voxels (options : dense keeps the voxels with the most points, random a random subset)", type=str)
+  parser.add_argument("--aug_memo_size", default=0, help="Number of training frames whose voxels are kept in memory for the draws of aug_data that leave the frame unchanged (read from --voxel_cache_dir instead if set), 0 to voxelize every draw", type=int)
+  parser.add_argument("--warmup_predict", default="no", help="Boolean to compile the prediction function of the dump tests and summaries at startup (yes or no)", type=str2bool)
+  parser.add_argument("--ragged_vfe", default="no", help="Boolean to ship the voxels as flat point lists and run the VFE layers on their rows only, instead of the padded feature buffer (yes or no)", type=str2bool)
+  parser.add_argument("--gt_database_dir", default="", help="Directory of the ground truth object database pasted into the augmented frames (see utils/gt_database.py), no object sampling if empty", type=str)
+  parser.add_argument("--gt_sample_groups", default=["Car:10"], nargs="*", help="Number of objects per frame of each sampled class (ex : Car:10 Cyclist:5)", type=str)
+  parser.add_argument("--bucket_boundaries", default=[], nargs="*", help="Voxel count boundaries of the batching buckets (ex : 2000 4000 8000), no bucketing if empty", type=int)
 
 
   args = parser.parse_args()
@@ -104,12 +124,15 @@ def main():
   with strategy.scope():
     checkpoint_dir = os.path.join(params["model_dir"], params["model_name"], "checkpoints")
     os.makedirs(checkpoint_dir, exist_ok=True)
-    ckpt = tf.train.Checkpoint(step=tf.Variable(0, trainable=False), voxelnet=model, epoch=tf.Variable(0, trainable=False))
+    ckpt = tf.train.Checkpoint(step=tf.Variable(0, trainable=False), voxelnet=model, epoch=tf.Variable(0, trainable=False),
+                               train_data=train_batcher.iterator_state)
     ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir , max_to_keep=params["ckpt_max_keep"])
 
     ckpt.restore(ckpt_manager.latest_checkpoint)
     if ckpt_manager.latest_checkpoint:
       print("Restored from {}".format(ckpt_manager.latest_checkpoint))
+      # the training examples resume where the checkpointed run stopped
+      train_batcher.reset()
     else:
       print("Initialized from scratch.")
 
@@ -118,6 +141,8 @@ def main():
   with strategy.scope():
     model.add_optimizer_(ckpt.epoch)
     print(f'strategy.num_replicas_in_sync:{model.strategy.num_replicas_in_sync}')
+    if params["warmup_predict"]:
+      model.warmup_predict()
     train_epochs( model, train_batcher, rand_test_batcher, val_batcher,  params, cfg, ckpt, ckpt_manager, strategy)
 
 if __name__ =="__main__":
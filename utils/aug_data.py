@@ -3,25 +3,44 @@ import cv2
 import os
 import glob
 from utils.utils import *
+from utils.augment import global_transform, transform_points, transform_labels
 
 
-def aug_data(tag, object_dir): 
+def aug_data(tag, object_dir, label=None, lidar=None, rng=None, gt_sampler=None, memo=None): 
     # to be called for the training batcher
-    np.random.seed()
+    # label: (N', 11), optional, already loaded labels of the frame (not modified)
+    # lidar: (N, 4), optional, already loaded point cloud of the frame (not modified, the transforms
+    #        of utils/augment.py return new arrays)
+    # rng: np.random.RandomState drawing the augmentation, seeded from fresh entropy if None
+    # gt_sampler: utils.gt_database.GTSampler, optional, pastes database objects into the frame before
+    #             the other augmentations
+    # memo: utils.example_memo.ExampleMemo, optional, serves the voxels of the frames left unchanged
+    # the returned dict has an "augmented" field, False when the frame is the raw frame of tag
+    if rng is None:
+        rng = np.random.RandomState()
     #rgb = cv2.resize(cv2.imread(os.path.join(object_dir,
                                              #'image_2', tag + '.png')), (cfg.IMAGE_WIDTH, cfg.IMAGE_HEIGHT))
     #rgb = cv2.imread( os.path.join(object_dir,'image_2', tag + '.png')  )
-    lidar = np.fromfile(os.path.join(object_dir,
-                                     'radar_6455', tag + '.bin'), dtype=np.float32).reshape(-1, 4)
+    if lidar is None:
+        lidar = np.fromfile(os.path.join(object_dir,
+                                         'radar_6455', tag + '.bin'), dtype=np.float32).reshape(-1, 4)
     # label = np.array([line for line in open(os.path.join(
     #     object_dir, 'groundtruth_obj3d', tag + '.json'), 'r').readlines()])  # (N')
-    label = load_label( os.path.join(object_dir, 'groundtruth_obj3d', tag + '.json') )
+    if label is None:
+        label = load_label( os.path.join(object_dir, 'groundtruth_obj3d', tag + '.json') )
+    augmented = False
+    if gt_sampler is not None:
+        n_objects = len(label)
+        label, lidar = gt_sampler.sample(label, lidar, rng)
+        augmented = len(label) > n_objects
     #cls = np.array([line[10] for line in label])  # (N')
     cls = label[:,10]
-    gt_box3d = label_to_gt_box3d(label[np.newaxis, :], cls='')[0]  # (N', 7) x, y, z, h, w, l, r
 
-    choice = np.random.randint(0, 10)
+    choice = rng.randint(0, 10)
     if choice <= -1: #disabled
+        augmented = True
+        lidar = lidar.copy()
+        gt_box3d = label_to_gt_box3d(label[np.newaxis, :], cls='')[0]  # (N', 7) x, y, z, h, w, l, r
         # disable this augmention here. current implementation will decrease the performances
         lidar_center_gt_box3d = camera_to_lidar_box(gt_box3d)
         lidar_corner_gt_box3d = center_to_corner_box3d(lidar_center_gt_box3d, coordinate='lidar')
@@ -30,10 +49,10 @@ def aug_data(tag, object_dir):
             is_collision = True
             _count = 0
             while is_collision and _count < 100:
-                t_rz = np.random.uniform(-np.pi / 10, np.pi / 10)
-                t_x = np.random.normal()
-                t_y = np.random.normal()
-                t_z = np.random.normal()
+                t_rz = rng.uniform(-np.pi / 10, np.pi / 10)
+                t_x = rng.normal()
+                t_y = rng.normal()
+                t_z = rng.normal()
                 # check collision
                 tmp = box_transform(
                     lidar_center_gt_box3d[[idx]], t_x, t_y, t_z, t_rz, 'lidar')
@@ -71,38 +90,45 @@ def aug_data(tag, object_dir):
 
         gt_box3d = lidar_to_camera_box(lidar_center_gt_box3d)
         newtag = 'aug_{}_1_{}'.format(
-            tag, np.random.randint(1, 1024))
+            tag, rng.randint(1, 1024))
     elif choice <4:
         pass
     elif choice < 7 and choice >= 4:
         # global rotation
-        angle = np.random.uniform(-np.pi / 4, np.pi / 4)
-        lidar[:, 0:3] = point_transform(lidar[:, 0:3], 0, 0, 0, rz=angle)
+        augmented = True
+        angle = rng.uniform(-np.pi / 4, np.pi / 4)
+        mat = global_transform(rz=angle)
+        lidar = transform_points(lidar, mat)
         #lidar_center_gt_box3d = camera_to_lidar_box(gt_box3d)
         #gt_box3d = box_transform(gt_box3d, 0, 0, 0, r=angle )
         #gt_box3d = lidar_to_camera_box(lidar_center_gt_box3d)
-        label = rotate_label(label, rz=angle)
+        label = transform_labels(label, mat)
         newtag = 'aug_{}_2_{:.4f}'.format(tag, angle).replace('.', '_')
     else:
         # global scaling
-        factor = np.random.uniform(0.95, 1.05)
-        lidar[:, 0:3] = lidar[:, 0:3] * factor
+        augmented = True
+        factor = rng.uniform(0.95, 1.05)
+        mat = global_transform(scale=factor)
+        lidar = transform_points(lidar, mat)
         #lidar_center_gt_box3d = camera_to_lidar_box(gt_box3d)
         #gt_box3d[:, 0:6] = gt_box3d[:, 0:6] * factor
         #gt_box3d = lidar_to_camera_box(lidar_center_gt_box3d)
-        label[0:6] = label[0:6] * factor
+        # centers and dimensions (columns 0:6) of every box
+        label = transform_labels(label, mat)
         newtag = 'aug_{}_3_{:.4f}'.format(tag, factor).replace('.', '_')
 
     #label = box3d_to_label(tag, gt_box3d[np.newaxis, ...], cls[np.newaxis, ...], coordinate='camera')[0]  # (N')
-    voxel_dict = process_pointcloud(lidar, cfg)
+    if memo is not None and not augmented:
+        voxel_dict = memo.voxels(tag, lidar)
+    else:
+        voxel_dict = process_pointcloud(lidar, cfg)
     dic = {}
-    dic["img"] = 0
     dic["labels"] = label
+    dic["augmented"] = augmented
     try:
       dic["tag"] = newtag
     except:
       dic["tag"] = tag
     dic["num_points"] = len(lidar)
-    dic["lidar"] = 0
     dic.update(voxel_dict)
     return dic
\ No newline at end of file
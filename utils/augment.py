@@ -0,0 +1,115 @@
+import numpy as np
+
+# Global augmentation transforms, applied to a whole point cloud and a whole label array at once.
+# A transform is a (4, 4) affine matrix in the row vector convention of point_transform :
+#   points' = points @ mat[0:3, 0:3] + mat[3, 0:3]
+# so that compose_transforms(a, b) applies a first, then b.
+
+
+def global_transform(rz=0., scale=1., translation=(0., 0., 0.)):
+    # Input:
+    #   rz: rotation around z in radians, same direction as point_transform(points, 0, 0, 0, rz=rz)
+    #   scale: uniform scaling factor
+    #   translation: (3,) translation
+    # Output:
+    #   (4, 4) matrix, rotation then scaling then translation
+    c, s = np.cos(rz), np.sin(rz)
+    mat = np.eye(4)
+    mat[0:3, 0:3] = scale * np.array([[c, -s, 0.], [s, c, 0.], [0., 0., 1.]])
+    mat[3, 0:3] = translation
+    return mat
+
+
+def compose_transforms(*mats):
+    # Input:
+    #   mats: (4, 4) matrices, in the order they are applied
+    # Output:
+    #   (4, 4) matrix
+    out = np.eye(4)
+    for mat in mats:
+        out = out @ mat
+    return out
+
+
+def transform_points(points, mat):
+    # Input:
+    #   points: (N, 4) x y z intensity
+    #   mat: (4, 4)
+    # Output:
+    #   (N, 4) float32, new array
+    # one column at a time in float32 : cheaper than a (N, 3) @ (3, 3) matmul on a strided slice
+    m = mat.astype(np.float32)
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    out = np.empty((len(points), 4), dtype=np.float32)
+    for i in range(3):
+        np.multiply(x, m[0, i], out=out[:, i])
+        out[:, i] += y * m[1, i]
+        out[:, i] += z * m[2, i]
+        out[:, i] += m[3, i]
+    out[:, 3] = points[:, 3]
+    return out
+
+
+def quat_to_euler(quat):
+    # vectorized qaut_to_angle
+    # Input:
+    #   quat: (N, 4) w x y z
+    # Output:
+    #   roll, pitch, yaw: (N,)
+    w, x, y, z = quat[:, 0], quat[:, 1], quat[:, 2], quat[:, 3]
+    roll = np.arctan2(2*(w*x + y*z), 1 - 2*(x*x + y*y))
+    pitch = np.arcsin(np.clip(2*(w*y - x*z), -1., 1.))
+    yaw = np.arctan2(2*(w*z + x*y), 1 - 2*(z*z + y*y))
+    return roll, pitch, yaw
+
+
+def euler_to_quat(roll, pitch, yaw):
+    # vectorized angle_to_quat
+    # Input:
+    #   roll, pitch, yaw: (N,)
+    # Output:
+    #   quat: (N, 4) w x y z
+    cy, sy = np.cos(yaw * 0.5), np.sin(yaw * 0.5)
+    cp, sp = np.cos(pitch * 0.5), np.sin(pitch * 0.5)
+    cr, sr = np.cos(roll * 0.5), np.sin(roll * 0.5)
+    return np.stack([cr * cp * cy + sr * sp * sy,
+                     sr * cp * cy - cr * sp * sy,
+                     cr * sp * cy + sr * cp * sy,
+                     cr * cp * sy - sr * sp * cy], axis=1)
+
+
+def transform_labels(label, mat):
+    # Input:
+    #   label: (N', 11) x y z l w h q0-3 cls
+    #   mat: (4, 4) composition of global_transform matrices (z rotations, uniform scalings, translations)
+    # Output:
+    #   (N', 11) new array : moved centers, scaled dimensions, orientations turned by the z rotation of mat
+    out = np.array(label, dtype=np.float64)
+    if len(out) == 0:
+        return out
+    scale = np.cbrt(np.linalg.det(mat[0:3, 0:3]))
+    rz = np.arctan2(-mat[0, 1], mat[0, 0])
+    out[:, 0:3] = out[:, 0:3] @ mat[0:3, 0:3] + mat[3, 0:3]
+    out[:, 3:6] *= scale
+    if rz != 0:
+        roll, pitch, yaw = quat_to_euler(out[:, 6:10])
+        out[:, 6:10] = euler_to_quat(roll, pitch, yaw - rz)
+    return out
+
+
+def quat_to_rotations(quat):
+    # vectorized quat_to_rotation
+    # Input:
+    #   quat: (N, 4) w x y z
+    # Output:
+    #   (N, 3, 3) rotation matrices, box corners = rot @ local corners + center (see center_to_corner_box3d)
+    q = np.asarray(quat, dtype=np.float64)
+    n = np.sum(q * q, axis=1)
+    valid = n >= np.finfo(np.float64).eps
+    q = q * np.sqrt(2.0 / np.where(valid, n, 1.))[:, np.newaxis]
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    rot = np.stack([1.0 - y*y - z*z, x*y - z*w, x*z + y*w,
+                    x*y + z*w, 1.0 - x*x - z*z, y*z - x*w,
+                    x*z - y*w, y*z + x*w, 1.0 - x*x - y*y], axis=1).reshape(-1, 3, 3)
+    rot[~valid] = np.eye(3)
+    return rot
@@ -1,3 +1,4 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
 import numpy as np
 cimport numpy as np
 from cython.parallel import prange, parallel
@@ -6,52 +7,138 @@ from cython.parallel import prange, parallel
 DTYPE = np.float32
 ctypedef float DTYPE_t
 
+# The kernels release the gil and split their outer loop over OpenMP threads (built with the flags of
+# setup.py, sequential otherwise). num_threads <= 0 uses the OpenMP default (OMP_NUM_THREADS or all the
+# cores). The rounding of the original loops is kept : the +1 widths and heights are computed in double
+# and stored as float, the union is summed in double, the ratios are float divisions.
+
+
+cdef inline DTYPE_t _fmin(DTYPE_t a, DTYPE_t b) noexcept nogil:
+    return a if a < b else b
+
+
+cdef inline DTYPE_t _fmax(DTYPE_t a, DTYPE_t b) noexcept nogil:
+    return a if a > b else b
+
+
+cdef inline void _overlap_row(const DTYPE_t[:, :] boxes, const DTYPE_t[:, :] query_boxes,
+                              const DTYPE_t[::1] query_areas, Py_ssize_t k0, Py_ssize_t k1, DTYPE_t* out,
+                              Py_ssize_t n, bint intersections) noexcept nogil:
+    # ratios of the box n with the query boxes k0 to k1 (excluded), written to out[0:k1 - k0]
+    cdef Py_ssize_t k
+    cdef DTYPE_t x1 = boxes[n, 0], y1 = boxes[n, 1], x2 = boxes[n, 2], y2 = boxes[n, 3]
+    cdef double area = (<double>(x2 - x1) + 1.0) * (<double>(y2 - y1) + 1.0)
+    cdef DTYPE_t iw, ih, ua
+    for k in range(k0, k1):
+        iw = <DTYPE_t>(<double>(_fmin(x2, query_boxes[k, 2]) - _fmax(x1, query_boxes[k, 0])) + 1.0)
+        if iw > 0:
+            ih = <DTYPE_t>(<double>(_fmin(y2, query_boxes[k, 3]) - _fmax(y1, query_boxes[k, 1])) + 1.0)
+            if ih > 0:
+                if intersections:
+                    out[k - k0] = iw * ih / query_areas[k]
+                else:
+                    ua = <DTYPE_t>(area + query_areas[k] - <double>(iw * ih))
+                    out[k - k0] = iw * ih / ua
+
+
+cdef np.ndarray _query_areas(const DTYPE_t[:, :] query_boxes):
+    # (K,) float +1 areas of the query boxes
+    cdef Py_ssize_t k
+    cdef np.ndarray[DTYPE_t, ndim=1] areas = np.zeros((query_boxes.shape[0]), dtype=DTYPE)
+    for k in range(query_boxes.shape[0]):
+        areas[k] = <DTYPE_t>((<double>(query_boxes[k, 2] - query_boxes[k, 0]) + 1.0) *
+                             (<double>(query_boxes[k, 3] - query_boxes[k, 1]) + 1.0))
+    return areas
+
+
+cdef np.ndarray _overlaps(const DTYPE_t[:, :] boxes, const DTYPE_t[:, :] query_boxes, bint intersections,
+                          int num_threads):
+    cdef Py_ssize_t n
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    cdef np.ndarray overlaps = np.zeros((N, K), dtype=DTYPE)
+    cdef DTYPE_t[:, ::1] out = overlaps
+    cdef const DTYPE_t[::1] query_areas = _query_areas(query_boxes)
+    if N == 0 or K == 0:
+        return overlaps
+    if num_threads > 0:
+        for n in prange(N, nogil=True, schedule='static', num_threads=num_threads):
+            _overlap_row(boxes, query_boxes, query_areas, 0, K, &out[n, 0], n, intersections)
+    else:
+        for n in prange(N, nogil=True, schedule='static'):
+            _overlap_row(boxes, query_boxes, query_areas, 0, K, &out[n, 0], n, intersections)
+    return overlaps
+
 
 def bbox_overlaps(
-        np.ndarray[DTYPE_t, ndim=2] boxes,
-        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+        const DTYPE_t[:, :] boxes,
+        const DTYPE_t[:, :] query_boxes,
+        int num_threads=0):
     """
     Parameters
     ----------
     boxes: (N, 4) ndarray of float
     query_boxes: (K, 4) ndarray of float
+    num_threads: number of OpenMP threads, the OpenMP default if <= 0
     Returns
     -------
     overlaps: (N, K) ndarray of overlap between boxes and query_boxes
     """
-    cdef unsigned int N = boxes.shape[0]
-    cdef unsigned int K = query_boxes.shape[0]
-    cdef np.ndarray[DTYPE_t, ndim=2] overlaps = np.zeros((N, K), dtype=DTYPE)
-    cdef DTYPE_t iw, ih, box_area
-    cdef DTYPE_t ua
-    cdef unsigned int k, n
-    for k in range(K):
-        box_area = (
-            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
-            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
-        )
-        for n in range(N):
-            iw = (
-                min(boxes[n, 2], query_boxes[k, 2]) -
-                max(boxes[n, 0], query_boxes[k, 0]) + 1
-            )
-            if iw > 0:
-                ih = (
-                    min(boxes[n, 3], query_boxes[k, 3]) -
-                    max(boxes[n, 1], query_boxes[k, 1]) + 1
-                )
-                if ih > 0:
-                    ua = float(
-                        (boxes[n, 2] - boxes[n, 0] + 1) *
-                        (boxes[n, 3] - boxes[n, 1] + 1) +
-                        box_area - iw * ih
-                    )
-                    overlaps[n, k] = iw * ih / ua
-    return overlaps
+    return _overlaps(boxes, query_boxes, False, num_threads)
+
+
+def bbox_overlaps_frames(
+        const DTYPE_t[:, :] boxes,
+        list query_boxes_list,
+        int num_threads=0):
+    """
+    bbox_overlaps of boxes with the query boxes of several frames, in one parallel loop over the
+    (frame, box) rows : the rows of a thread are consecutive, so each thread fills one contiguous block
+    ----------
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float, shared by the frames (ex : the anchors)
+    query_boxes_list: list of (K_i, 4) ndarray of float, one per frame
+    num_threads: number of OpenMP threads, the OpenMP default if <= 0
+    Returns
+    -------
+    overlaps: list of (N, K_i) ndarray of overlap between boxes and the query boxes of the frame
+    """
+    cdef Py_ssize_t r, f, n
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t F = len(query_boxes_list)
+    all_query_boxes_arr = np.ascontiguousarray(
+        np.concatenate([np.zeros((0, 4), dtype=DTYPE)] + list(query_boxes_list), axis=0), dtype=DTYPE)
+    cdef const DTYPE_t[:, :] all_query_boxes = all_query_boxes_arr
+    cdef const DTYPE_t[::1] all_areas = _query_areas(all_query_boxes)
+    # frame f has the query boxes starts[f] to starts[f + 1] and the (N, K_f) block at N * starts[f] of
+    # the flat output
+    starts_arr = np.zeros((F + 1), dtype=np.intp)
+    np.cumsum([len(query_boxes) for query_boxes in query_boxes_list], out=starts_arr[1:])
+    cdef const Py_ssize_t[::1] starts = starts_arr
+    flat_arr = np.zeros((N * starts_arr[F]), dtype=DTYPE)
+    cdef DTYPE_t[::1] flat = flat_arr
+    if N > 0 and starts_arr[F] > 0:
+        if num_threads > 0:
+            for r in prange(F * N, nogil=True, schedule='static', num_threads=num_threads):
+                f = r // N
+                n = r - f * N
+                _overlap_row(boxes, all_query_boxes, all_areas, starts[f], starts[f + 1],
+                             &flat[0] + N * starts[f] + n * (starts[f + 1] - starts[f]), n, False)
+        else:
+            for r in prange(F * N, nogil=True, schedule='static'):
+                f = r // N
+                n = r - f * N
+                _overlap_row(boxes, all_query_boxes, all_areas, starts[f], starts[f + 1],
+                             &flat[0] + N * starts[f] + n * (starts[f + 1] - starts[f]), n, False)
+    return [flat_arr[N * starts_arr[f]:N * starts_arr[f + 1]].reshape(N, starts_arr[f + 1] - starts_arr[f])
+            for f in range(F)]
+
 
 def bbox_intersections(
-        np.ndarray[DTYPE_t, ndim=2] boxes,
-        np.ndarray[DTYPE_t, ndim=2] query_boxes):
+        const DTYPE_t[:, :] boxes,
+        const DTYPE_t[:, :] query_boxes,
+        int num_threads=0):
     """
     For each query box compute the intersection ratio covered by boxes
     ----------
@@ -59,82 +146,179 @@ def bbox_intersections(
     ----------
     boxes: (N, 4) ndarray of float
     query_boxes: (K, 4) ndarray of float
+    num_threads: number of OpenMP threads, the OpenMP default if <= 0
     Returns
     -------
     overlaps: (N, K) ndarray of intersec between boxes and query_boxes
     """
-    cdef unsigned int N = boxes.shape[0]
-    cdef unsigned int K = query_boxes.shape[0]
-    cdef np.ndarray[DTYPE_t, ndim=2] intersec = np.zeros((N, K), dtype=DTYPE)
-    cdef DTYPE_t iw, ih, box_area
-    cdef DTYPE_t ua
-    cdef unsigned int k, n
-    for k in range(K):
-        box_area = (
-            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
-            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
-        )
-        for n in range(N):
-            iw = (
-                min(boxes[n, 2], query_boxes[k, 2]) -
-                max(boxes[n, 0], query_boxes[k, 0]) + 1
-            )
-            if iw > 0:
-                ih = (
-                    min(boxes[n, 3], query_boxes[k, 3]) -
-                    max(boxes[n, 1], query_boxes[k, 1]) + 1
-                )
-                if ih > 0:
-                    intersec[n, k] = iw * ih / box_area
-    return intersec
+    return _overlaps(boxes, query_boxes, True, num_threads)
 
-# Compute bounding box voting
-def box_vote(
-        np.ndarray[float, ndim=2] dets_NMS,
-        np.ndarray[float, ndim=2] dets_all):
-    cdef np.ndarray[float, ndim=2] dets_voted = np.zeros((dets_NMS.shape[0], dets_NMS.shape[1]), dtype=np.float32)
-    cdef unsigned int N = dets_NMS.shape[0]
-    cdef unsigned int M = dets_all.shape[0]
 
-    cdef np.ndarray[float, ndim=1] det
-    cdef np.ndarray[float, ndim=1] acc_box
-    cdef float acc_score
+cdef void _vote_row(const float[:, :] dets_NMS, const float[:, :] dets_all, float[:, ::1] dets_voted,
+                    Py_ssize_t i, float thresh) noexcept nogil:
+    cdef Py_ssize_t m
+    cdef float acc_box0 = 0, acc_box1 = 0, acc_box2 = 0, acc_box3 = 0
+    cdef float acc_score = 0
+    cdef float bi0, bi1, bi2, bi3
+    cdef float iw, ih, ua, ov
+    for m in range(dets_all.shape[0]):
+        bi0 = _fmax(dets_NMS[i, 0], dets_all[m, 0])
+        bi1 = _fmax(dets_NMS[i, 1], dets_all[m, 1])
+        bi2 = _fmin(dets_NMS[i, 2], dets_all[m, 2])
+        bi3 = _fmin(dets_NMS[i, 3], dets_all[m, 3])
+
+        iw = <float>(<double>bi2 - <double>bi0 + 1.0)
+        ih = <float>(<double>(bi3 - bi1) + 1.0)
+
+        if not (iw > 0 and ih > 0):
+            continue
 
-    cdef np.ndarray[float, ndim=1] det2
-    cdef float bi0, bi1, bit2, bi3
-    cdef float iw, ih, ua
+        ua = <float>((<double>(dets_NMS[i, 2] - dets_NMS[i, 0]) + 1.0) * (<double>(dets_NMS[i, 3] - dets_NMS[i, 1]) + 1.0) +
+                     (<double>(dets_all[m, 2] - dets_all[m, 0]) + 1.0) * (<double>(dets_all[m, 3] - dets_all[m, 1]) + 1.0) -
+                     <double>(iw * ih))
+        ov = iw * ih / ua
 
-    cdef float thresh=0.5
+        if (ov < thresh):
+            continue
 
-    for i in range(N):
-        det = dets_NMS[i, :]
-        acc_box = np.zeros((4), dtype=np.float32)
-        acc_score = 0.0
+        acc_box0 = acc_box0 + dets_all[m, 4] * dets_all[m, 0]
+        acc_box1 = acc_box1 + dets_all[m, 4] * dets_all[m, 1]
+        acc_box2 = acc_box2 + dets_all[m, 4] * dets_all[m, 2]
+        acc_box3 = acc_box3 + dets_all[m, 4] * dets_all[m, 3]
+        acc_score = acc_score + dets_all[m, 4]
 
-        for m in range(M):
-            det2 = dets_all[m, :]
+    dets_voted[i, 0] = acc_box0 / acc_score
+    dets_voted[i, 1] = acc_box1 / acc_score
+    dets_voted[i, 2] = acc_box2 / acc_score
+    dets_voted[i, 3] = acc_box3 / acc_score
+    dets_voted[i, 4] = dets_NMS[i, 4]       # Keep the original score
 
-            bi0 = max(det[0], det2[0])
-            bi1 = max(det[1], det2[1])
-            bi2 = min(det[2], det2[2])
-            bi3 = min(det[3], det2[3])
 
-            iw = bi2 - bi0 + 1
-            ih = bi3 - bi1 + 1
+# Compute bounding box voting
+def box_vote(
+        const float[:, :] dets_NMS,
+        const float[:, :] dets_all,
+        int num_threads=0):
+    cdef Py_ssize_t i
+    cdef Py_ssize_t N = dets_NMS.shape[0]
+    voted = np.zeros((N, dets_NMS.shape[1]), dtype=np.float32)
+    cdef float[:, ::1] dets_voted = voted
+    cdef float thresh = 0.5
+    if N == 0:
+        return voted
+    if num_threads > 0:
+        for i in prange(N, nogil=True, schedule='dynamic', num_threads=num_threads):
+            _vote_row(dets_NMS, dets_all, dets_voted, i, thresh)
+    else:
+        for i in prange(N, nogil=True, schedule='dynamic'):
+            _vote_row(dets_NMS, dets_all, dets_voted, i, thresh)
+    return voted
 
-            if not (iw > 0 and ih > 0):
-                continue
 
-            ua = (det[2] - det[0] + 1) * (det[3] - det[1] + 1) + (det2[2] - det2[0] + 1) * (det2[3] - det2[1] + 1) - iw * ih
-            ov = iw * ih / ua
+cdef int _clip_polygon(const double* poly, int count, double sx, double sy, double ex, double ey,
+                       double* out) noexcept nogil:
+    # one Sutherland-Hodgman step of utils/rotated_iou.clip_polygons : keeps the part of poly on the left of
+    # the edge, every vertex emitting itself if inside then the crossing point of its outgoing side if any
+    cdef int k, nxt, n = 0
+    cdef double d, nxt_d, t
+    for k in range(count):
+        nxt = k + 1 if k + 1 < count else 0
+        d = (ex - sx) * (poly[2 * k + 1] - sy) - (ey - sy) * (poly[2 * k] - sx)
+        nxt_d = (ex - sx) * (poly[2 * nxt + 1] - sy) - (ey - sy) * (poly[2 * nxt] - sx)
+        if d >= 0 and n < 8:
+            out[2 * n] = poly[2 * k]
+            out[2 * n + 1] = poly[2 * k + 1]
+            n = n + 1
+        if (d >= 0) != (nxt_d >= 0) and n < 8:
+            t = d / (d - nxt_d)
+            out[2 * n] = poly[2 * k] + t * (poly[2 * nxt] - poly[2 * k])
+            out[2 * n + 1] = poly[2 * k + 1] + t * (poly[2 * nxt + 1] - poly[2 * k + 1])
+            n = n + 1
+    return n
 
-            if (ov < thresh):
-                continue
 
-            acc_box += det2[4] * det2[0:4]
-            acc_score += det2[4]
+cdef double _bev_intersection(const double[:, :, ::1] corners, Py_ssize_t i, Py_ssize_t j) noexcept nogil:
+    # intersection area of the counterclockwise rectangles i and j
+    cdef double buf0[16]
+    cdef double buf1[16]
+    cdef double* poly = buf0
+    cdef double* out = buf1
+    cdef double* tmp
+    cdef double area = 0
+    cdef int k, nxt, count = 4
+    for k in range(4):
+        poly[2 * k] = corners[i, k, 0]
+        poly[2 * k + 1] = corners[i, k, 1]
+    for k in range(4):
+        nxt = (k + 1) % 4
+        count = _clip_polygon(poly, count, corners[j, k, 0], corners[j, k, 1], corners[j, nxt, 0], corners[j, nxt, 1], out)
+        tmp = poly
+        poly = out
+        out = tmp
+    for k in range(count):
+        nxt = k + 1 if k + 1 < count else 0
+        area = area + poly[2 * k] * poly[2 * nxt + 1] - poly[2 * k + 1] * poly[2 * nxt]
+    return (area if area > 0 else -area) / 2
 
-        dets_voted[i][0:4] = acc_box / acc_score
-        dets_voted[i][4] = det[4]       # Keep the original score
 
-    return dets_voted
\ No newline at end of file
+cdef void _suppress_row(const double[:, :, ::1] corners, const double[::1] areas, const double[:, ::1] standup,
+                        np.uint8_t[::1] suppressed, Py_ssize_t i, Py_ssize_t j, double iou_threshold) noexcept nogil:
+    cdef double inter
+    if suppressed[j] or areas[j] <= 0:
+        return
+    if not (standup[i, 0] < standup[j, 2] and standup[j, 0] < standup[i, 2] and
+            standup[i, 1] < standup[j, 3] and standup[j, 1] < standup[i, 3]):
+        return
+    inter = _bev_intersection(corners, i, j)
+    if inter / (areas[i] + areas[j] - inter) > iou_threshold:
+        suppressed[j] = 1
+
+
+def rotated_nms_sorted(
+        const double[:, :, ::1] corners,
+        double iou_threshold,
+        int max_output_size,
+        int num_threads=0):
+    """
+    Greedy nms of rotated boxes already sorted by decreasing score : the iou is only computed between the
+    kept boxes and the remaining candidates, in parallel over the candidates
+    ----------
+    Parameters
+    ----------
+    corners: (K, 4, 2) ndarray of double, counterclockwise corners (utils/rotated_iou.box2d_corners)
+    iou_threshold: boxes with an iou > iou_threshold with a kept box are suppressed
+    max_output_size: max number of kept boxes
+    num_threads: number of OpenMP threads, the OpenMP default if <= 0
+    Returns
+    -------
+    keep: (M,) ndarray of int64, positions of the kept boxes
+    """
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t K = corners.shape[0]
+    cdef Py_ssize_t n_keep = 0
+    corners_arr = np.asarray(corners)
+    # shoelace areas (0 for the flat boxes, which intersect nothing) and standup boxes
+    x, y = corners_arr[..., 0], corners_arr[..., 1]
+    cdef const double[::1] areas = np.ascontiguousarray(
+        np.abs(np.sum(x * np.roll(y, -1, axis=1) - y * np.roll(x, -1, axis=1), axis=1)) / 2)
+    cdef const double[:, ::1] standup = np.ascontiguousarray(
+        np.concatenate([corners_arr.min(axis=1), corners_arr.max(axis=1)], axis=1))
+    keep_arr = np.zeros((K), dtype=np.int64)
+    cdef np.int64_t[::1] keep = keep_arr
+    cdef np.uint8_t[::1] suppressed = np.zeros((K), dtype=np.uint8)
+    for i in range(K):
+        if n_keep >= max_output_size:
+            break
+        if suppressed[i]:
+            continue
+        keep[n_keep] = i
+        n_keep += 1
+        if areas[i] <= 0:
+            continue
+        if num_threads > 0:
+            for j in prange(i + 1, K, nogil=True, schedule='static', num_threads=num_threads):
+                _suppress_row(corners, areas, standup, suppressed, i, j, iou_threshold)
+        else:
+            for j in prange(i + 1, K, nogil=True, schedule='static'):
+                _suppress_row(corners, areas, standup, suppressed, i, j, iou_threshold)
+    return keep_arr[:n_keep]
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+from utils.utils import process_pointcloud
+
+
+class ExampleMemo:
+    """
+      Voxels of the training frames that aug_data leaves unchanged (the identity draws), memoized by tag.
+
+      Those frames voxelize exactly like the raw frame, so their process_pointcloud output is computed
+      once and served to the next identity draws of the tag. The buffers are either kept in memory, in an
+      LRU of at most max_entries frames, or read from an on-disk VoxelCache of the split when one is given
+      (the cache then bounds nothing, every frame of the split is reused). With the multi-process producers,
+      every worker holds its own memo.
+
+      Args:
+        cfg : config edict
+        max_entries : int, max number of frames kept in memory
+        voxel_cache : VoxelCache, optional, on-disk voxels of the split used instead of the in-memory LRU
+    """
+    def __init__(self, cfg, max_entries, voxel_cache=None):
+        self.cfg = cfg
+        self.max_entries = max_entries
+        self.voxel_cache = voxel_cache
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def voxels(self, tag, point_cloud):
+        # Input:
+        #   tag: frame tag
+        #   point_cloud: (N, 4) raw point cloud of the frame, voxelized on a miss
+        # Output:
+        #   voxel_dict, shared between the calls (not to be modified)
+        if self.voxel_cache is not None:
+            return self.voxel_cache.get(tag, point_cloud)
+        tag = "%06d" % int(tag)
+        voxel_dict = self.entries.get(tag)
+        if voxel_dict is not None:
+            self.entries.move_to_end(tag)
+            self.hits += 1
+            return voxel_dict
+        self.misses += 1
+        voxel_dict = process_pointcloud(point_cloud, self.cfg)
+        if self.max_entries > 0:
+            self.entries[tag] = voxel_dict
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return voxel_dict
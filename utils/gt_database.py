@@ -0,0 +1,215 @@
+import argparse
+import os
+import numpy as np
+
+from utils.utils import load_label, get_class_id
+from utils.augment import quat_to_rotations
+
+POINT_DIM = 4
+
+
+def label_corners_bev(label):
+    # Input:
+    #   label: (N', 11) x y z l w h q0-3 cls
+    # Output:
+    #   (N', 4, 2) bird view corners of the boxes, in the order of the top face of center_to_corner_box3d
+    label = np.asarray(label, dtype=np.float64).reshape(-1, 11)
+    rot = quat_to_rotations(label[:, 6:10])
+    half = label[:, 3:5] / 2
+    # (N', 4, 2) local x y of the corners
+    local = np.array([[1, 1], [-1, 1], [-1, -1], [1, -1]], dtype=np.float64)[np.newaxis] * half[:, np.newaxis]
+    return np.einsum('nij,nkj->nki', rot[:, 0:2, 0:2], local) + label[:, np.newaxis, 0:2]
+
+
+def bev_overlaps(corners_a, corners_b):
+    # separating axis test between convex quadrilaterals
+    # Input:
+    #   corners_a: (M, 4, 2)
+    #   corners_b: (K, 4, 2)
+    # Output:
+    #   (M, K) bool, True if the bird view boxes intersect (touching boxes do not)
+    def axes(corners):
+        # (n, 2, 2) normals of two consecutive edges, enough for rectangles
+        edges = corners[:, 1:3] - corners[:, 0:2]
+        return np.stack([-edges[..., 1], edges[..., 0]], axis=-1)
+
+    M, K = len(corners_a), len(corners_b)
+    if M == 0 or K == 0:
+        return np.zeros((M, K), dtype=bool)
+    # (M, K, 4, 2) the 4 axes of every pair
+    all_axes = np.concatenate([np.broadcast_to(axes(corners_a)[:, np.newaxis], (M, K, 2, 2)),
+                               np.broadcast_to(axes(corners_b)[np.newaxis], (M, K, 2, 2))], axis=2)
+    # (M, K, 4 axes, 4 corners) projections
+    proj_a = np.einsum('mkad,mcd->mkac', all_axes, corners_a)
+    proj_b = np.einsum('mkad,kcd->mkac', all_axes, corners_b)
+    separated = (proj_a.max(-1) <= proj_b.min(-1)) | (proj_b.max(-1) <= proj_a.min(-1))
+    return ~separated.any(-1)
+
+
+def points_in_labels(points, label):
+    # Input:
+    #   points: (N, 4)
+    #   label: (N', 11)
+    # Output:
+    #   (N, N') bool, True if the point is inside the 3d box
+    label = np.asarray(label, dtype=np.float64).reshape(-1, 11)
+    rot = quat_to_rotations(label[:, 6:10])
+    # local = rot^T (p - center)
+    local = np.einsum('mji,nmj->nmi', rot, points[:, np.newaxis, 0:3] - label[np.newaxis, :, 0:3])
+    return np.all(np.abs(local) <= label[np.newaxis, :, 3:6] / 2, axis=-1)
+
+
+def parse_sample_groups(groups):
+    # ["Car:15", "Cyclist:5"] -> {class id: number of objects of the class per frame}
+    sample_groups = {}
+    for group in groups:
+        classname, num = group.rsplit(":", 1)
+        sample_groups[get_class_id(classname)] = int(num)
+    return sample_groups
+
+
+class GTDatabase:
+    """
+      Database of the ground truth objects of a split : the label row of every object and the radar points
+      inside its box, extracted once from the labels and the radar frames.
+
+      build() writes db_dir/<split>/objects.npz (labels (M, 11), tags (M), offsets (M + 1) into the points)
+      and db_dir/<split>/points.npy, the concatenated (sum n, 4) points of the objects, in the sensor
+      coordinates of their frame. The points are read through a memory map, objects() returns views.
+      The database is not refreshed on read : rerun build() (or the CLI) after the labels or the radar
+      files change.
+
+      Args:
+        db_dir : str, root directory of the databases
+        split_dir : str, split directory of the dataset (ex : DATA_DIR/training)
+    """
+    def __init__(self, db_dir, split_dir):
+        self.split_dir = split_dir
+        self.db_dir = os.path.join(db_dir, os.path.basename(os.path.normpath(split_dir)))
+        self.objects_path = os.path.join(self.db_dir, "objects.npz")
+        self.points_path = os.path.join(self.db_dir, "points.npy")
+        self.labels = np.zeros((0, 11))
+        self.tags = np.zeros((0), dtype=str)
+        self.offsets = np.zeros((1), dtype=np.int64)
+        self.points = np.zeros((0, POINT_DIM), dtype=np.float32)
+        if os.path.exists(self.objects_path):
+            self._load()
+
+    def _load(self):
+        with np.load(self.objects_path) as f:
+            self.labels, self.tags, self.offsets = f["labels"], f["tags"], f["offsets"]
+        self.points = np.load(self.points_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def num_points(self):
+        # (M,) number of points of every object
+        return np.diff(self.offsets)
+
+    def build(self, tags, verbose=False):
+        # rewrites the whole database with the objects of the frames of tags
+        os.makedirs(self.db_dir, exist_ok=True)
+        labels, object_tags, points = [], [], []
+        for tag in sorted(tags):
+            label = load_label(os.path.join(self.split_dir, "groundtruth_obj3d", tag + ".json"))
+            lidar = np.fromfile(os.path.join(self.split_dir, "radar_6455", tag + ".bin"), dtype=np.float32).reshape(-1, POINT_DIM)
+            inside = points_in_labels(lidar, label)
+            for i in range(len(label)):
+                points.append(lidar[inside[:, i]])
+            labels.append(label)
+            object_tags += [tag] * len(label)
+        offsets = np.zeros((len(points) + 1), dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in points])
+        tmp_path = self.points_path + ".tmp.npy"
+        np.save(tmp_path, np.concatenate(points, axis=0) if points else np.zeros((0, POINT_DIM), dtype=np.float32))
+        os.replace(tmp_path, self.points_path)
+        tmp_path = self.objects_path + ".tmp.npz"
+        np.savez(tmp_path, labels=np.concatenate(labels, axis=0) if labels else np.zeros((0, 11)),
+                 tags=np.array(object_tags, dtype=str), offsets=offsets)
+        os.replace(tmp_path, self.objects_path)
+        self._load()
+        if verbose:
+            print("gt database: wrote {} objects, {} points".format(len(self), len(self.points)))
+
+    def object_points(self, idx):
+        # Input:
+        #   idx: (K,) object indices
+        # Output:
+        #   (sum n, 4) float32 points of the objects
+        if len(idx) == 0:
+            return np.zeros((0, POINT_DIM), dtype=np.float32)
+        return np.concatenate([self.points[self.offsets[i]:self.offsets[i + 1]] for i in idx], axis=0)
+
+
+class GTSampler:
+    """
+      Pastes objects of a GTDatabase into a frame, up to a number of objects per class.
+
+      For every class of sample_groups, the missing objects of the frame are drawn from the database
+      (objects with at least min_points points). The candidates overlapping (in bird view) a box of the
+      frame or a previously accepted candidate are rejected, all the tests being done at once with
+      bev_overlaps. The points of the frame inside the accepted boxes are removed and replaced by the
+      points of the objects, at the position they had in their own frame.
+
+      Args:
+        database : GTDatabase
+        sample_groups : dict, class id -> number of objects of the class per frame (see parse_sample_groups)
+        min_points : int, min number of points of a sampled object
+    """
+    def __init__(self, database, sample_groups, min_points=1):
+        self.database = database
+        self.sample_groups = sample_groups
+        enough_points = database.num_points() >= min_points
+        self.candidates = {cls_id: np.flatnonzero(enough_points & (database.labels[:, 10] == cls_id))
+                           for cls_id in sample_groups}
+
+    def sample(self, label, lidar, rng):
+        # Input:
+        #   label: (N', 11)
+        #   lidar: (N, 4)
+        #   rng: np.random.RandomState
+        # Output:
+        #   label: (N' + K, 11) new array, the K pasted objects after the boxes of the frame
+        #   lidar: (N'', 4) new array
+        chosen = []
+        for cls_id, num in self.sample_groups.items():
+            n_missing = min(num - int(np.sum(label[:, 10] == cls_id)), len(self.candidates[cls_id]))
+            if n_missing > 0:
+                chosen.append(rng.choice(self.candidates[cls_id], n_missing, replace=False))
+        if not chosen:
+            return label, lidar
+        idx = np.concatenate(chosen)
+        sampled = self.database.labels[idx]
+
+        sampled_corners = label_corners_bev(sampled)
+        keep = ~bev_overlaps(sampled_corners, label_corners_bev(label)).any(axis=1)
+        overlaps = bev_overlaps(sampled_corners, sampled_corners)
+        for i in range(len(idx)):
+            if keep[i]:
+                keep[i + 1:] &= ~overlaps[i, i + 1:]
+        if not keep.any():
+            return label, lidar
+        idx, sampled = idx[keep], sampled[keep]
+
+        inside = points_in_labels(lidar, sampled).any(axis=1)
+        lidar = np.concatenate([lidar[~inside], self.database.object_points(idx)], axis=0)
+        return np.concatenate([label, sampled], axis=0), lidar
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the ground truth object database of a split")
+    parser.add_argument("--data_root_dir", required=True, help="Data root directory", type=str)
+    parser.add_argument("--split", default="training", help="Split of the objects", type=str)
+    parser.add_argument("--gt_database_dir", required=True, help="Root directory of the object databases", type=str)
+    args = parser.parse_args()
+
+    split_dir = os.path.join(args.data_root_dir, args.split)
+    tags = sorted(a.split(".")[0] for a in os.listdir(os.path.join(split_dir, "groundtruth_obj3d")) if a.endswith(".json"))
+    database = GTDatabase(args.gt_database_dir, split_dir)
+    database.build(tags, verbose=True)
+    print("gt database {}: {} objects from {} frames".format(database.db_dir, len(database), len(tags)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import glob
+import os
+import numpy as np
+
+from utils.utils import load_label, load_calib
+
+
+def _split_tags(split_dir):
+    return sorted(os.path.basename(a).split(".")[0] for a in glob.glob(os.path.join(split_dir, "radar_6455", "*.bin")))
+
+
+def _mtimes(paths):
+    return np.array([os.stat(path).st_mtime_ns if os.path.exists(path) else -1 for path in paths], dtype=np.int64)
+
+
+class LabelIndex:
+    """
+      Columnar index of the labels and calibration matrices of a split, compiled once from the json files.
+
+      The labels of all the frames are concatenated into a single (sum N', 11) array, the rows of the
+      frame i being labels[offsets[i]:offsets[i+1]]. The calibration matrices are stacked into
+      T_toLidar (T, 3, 4), T_toCamera (T, 3, 4) and K (T, 3, 3). label() and calib() return views of
+      these arrays, nothing is parsed after the index is built. The index is written to
+      index_dir/<split>/label_index.npz and rebuilt when a json file is added, removed or modified.
+      A split without groundtruth_obj3d (testing) only gets its calibration indexed.
+
+      Args:
+        index_dir : str, root directory of the indexes
+        split_dir : str, split directory of the dataset (ex : DATA_DIR/validation)
+    """
+    def __init__(self, index_dir, split_dir):
+        self.split_dir = split_dir
+        self.index_path = os.path.join(index_dir, os.path.basename(os.path.normpath(split_dir)), "label_index.npz")
+        tags = _split_tags(split_dir)
+        self.has_labels = os.path.isdir(os.path.join(split_dir, "groundtruth_obj3d"))
+        label_mtimes, calib_mtimes = self._stamps(tags)
+
+        arrays = None
+        if os.path.exists(self.index_path):
+            with np.load(self.index_path) as f:
+                arrays = {key: f[key] for key in f.files}
+            if (list(arrays["tags"]) != tags or not np.array_equal(arrays["label_mtimes"], label_mtimes)
+                    or not np.array_equal(arrays["calib_mtimes"], calib_mtimes)):
+                arrays = None
+        self.built = arrays is None
+        if arrays is None:
+            arrays = self._build(tags)
+            arrays.update(label_mtimes=label_mtimes, calib_mtimes=calib_mtimes)
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = self.index_path + ".tmp.npz"
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.index_path)
+
+        self.tags = [str(tag) for tag in arrays["tags"]]
+        self.rows = {tag: i for i, tag in enumerate(self.tags)}
+        self.offsets = arrays["offsets"]
+        self.labels = arrays["labels"]
+        self.T_toLidar = arrays["T_toLidar"]
+        self.T_toCamera = arrays["T_toCamera"]
+        self.K = arrays["K"]
+
+    def _label_path(self, tag):
+        return os.path.join(self.split_dir, "groundtruth_obj3d", tag + ".json")
+
+    def _calib_path(self, tag):
+        return os.path.join(self.split_dir, "calibration", tag + ".json")
+
+    def _stamps(self, tags):
+        label_mtimes = _mtimes([self._label_path(tag) for tag in tags]) if self.has_labels else np.zeros((0), dtype=np.int64)
+        return label_mtimes, _mtimes([self._calib_path(tag) for tag in tags])
+
+    def _build(self, tags):
+        labels = [load_label(self._label_path(tag)) if self.has_labels else np.zeros((0, 11)) for tag in tags]
+        calibs = [load_calib(self._calib_path(tag)) for tag in tags]
+        offsets = np.zeros((len(tags) + 1), dtype=np.int64)
+        offsets[1:] = np.cumsum([len(label) for label in labels])
+        return {"tags": np.array(tags),
+                "offsets": offsets,
+                "labels": np.concatenate(labels, axis=0) if labels else np.zeros((0, 11)),
+                "T_toLidar": np.stack([calib[0] for calib in calibs]),
+                "T_toCamera": np.stack([calib[1] for calib in calibs]),
+                "K": np.stack([calib[2] for calib in calibs])}
+
+    def __contains__(self, tag):
+        return "%06d" % int(tag) in self.rows
+
+    def label(self, tag):
+        # Input:
+        #   tag: frame tag
+        # Output:
+        #   (N', 11) read-only view, same rows as load_label
+        i = self.rows["%06d" % int(tag)]
+        label = self.labels[self.offsets[i]:self.offsets[i + 1]]
+        label.flags.writeable = False
+        return label
+
+    def calib(self, tag):
+        # Input:
+        #   tag: frame tag
+        # Output:
+        #   T_toLidar, T_toCamera, K, same matrices as load_calib
+        i = self.rows["%06d" % int(tag)]
+        return self.T_toLidar[i], self.T_toCamera[i], self.K[i]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the label and calibration index of a split")
+    parser.add_argument("--data_root_dir", required=True, help="Data root directory", type=str)
+    parser.add_argument("--split", default="validation", help="Split to index (training, validation or testing)", type=str)
+    parser.add_argument("--index_dir", required=True, help="Root directory of the label indexes", type=str)
+    args = parser.parse_args()
+
+    index = LabelIndex(args.index_dir, os.path.join(args.data_root_dir, args.split))
+    print("label index {}: {} frames, {} objects ({})".format(
+        index.index_path, len(index.tags), len(index.labels), "built" if index.built else "up to date"))
+
+
+if __name__ == "__main__":
+    main()
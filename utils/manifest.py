@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+
+# sub directory of a split -> extension of its files
+SPLIT_DIRS = {"groundtruth_obj3d": ".json", "camera_front": ".jpg", "radar_6455": ".bin"}
+POINT_BYTES = 4 * 4 # (x, y, z, intensity) float32
+
+
+class SplitManifest:
+    """
+      Cached listing of the files of a split : tag, size and mtime of every label, camera and radar file.
+
+      The manifest is kept in manifest_dir/<split>/manifest.json. On load, only the sub directories whose
+      mtime changed since the last scan (a file was added, removed or renamed) are listed again, the
+      others are reused as is. The number of radar points of a frame is derived from the size of its .bin
+      file, without reading it.
+
+      Args:
+        manifest_dir : str, root directory of the manifests
+        split_dir : str, split directory of the dataset (ex : DATA_DIR/validation)
+    """
+    def __init__(self, manifest_dir, split_dir):
+        self.split_dir = split_dir
+        self.manifest_path = os.path.join(manifest_dir, os.path.basename(os.path.normpath(split_dir)), "manifest.json")
+        self.dirs = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, mode='r') as f:
+                self.dirs = json.load(f)["dirs"]
+
+        self.rescanned = []
+        for sub_dir, ext in SPLIT_DIRS.items():
+            path = os.path.join(split_dir, sub_dir)
+            if not os.path.isdir(path):
+                self.dirs.pop(sub_dir, None)
+                continue
+            dir_mtime = os.stat(path).st_mtime_ns
+            if sub_dir in self.dirs and self.dirs[sub_dir]["mtime"] == dir_mtime:
+                continue
+            self.dirs[sub_dir] = {"mtime": dir_mtime, "files": self._scan(path, ext)}
+            self.rescanned.append(sub_dir)
+        if self.rescanned:
+            self._write()
+
+    @staticmethod
+    def _scan(path, ext):
+        files = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.endswith(ext):
+                    st = entry.stat()
+                    files[entry.name[:-len(ext)]] = [st.st_size, st.st_mtime_ns]
+        return files
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, mode='w') as f:
+            json.dump({"dirs": self.dirs}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def tags(self, sub_dir):
+        # tags of the files of a sub directory (empty if the directory does not exist)
+        return list(self.dirs.get(sub_dir, {"files": {}})["files"])
+
+    def num_points(self):
+        # tag -> number of radar points of the frame
+        return {tag: size // POINT_BYTES for tag, (size, _) in self.dirs.get("radar_6455", {"files": {}})["files"].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the manifest of a split")
+    parser.add_argument("--data_root_dir", required=True, help="Data root directory", type=str)
+    parser.add_argument("--split", default="validation", help="Split (training, validation or testing)", type=str)
+    parser.add_argument("--manifest_dir", required=True, help="Root directory of the manifests", type=str)
+    args = parser.parse_args()
+
+    manifest = SplitManifest(args.manifest_dir, os.path.join(args.data_root_dir, args.split))
+    print("manifest {}: {} radar frames, rescanned {}".format(
+        manifest.manifest_path, len(manifest.tags("radar_6455")), manifest.rescanned or "nothing"))
+
+
+if __name__ == "__main__":
+    main()
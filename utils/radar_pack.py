@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import numpy as np
+
+POINT_DIM = 4
+
+
+class RadarPack:
+    """
+      Radar frames of a split packed into a few large shard files, read through memory maps.
+
+      pack() concatenates the float32 (N, 4) clouds of radar_6455 into pack_dir/<split>/shard_%05d.bin
+      files of about shard_bytes each, and writes an index.json with the shard, point offset and number
+      of points of every frame (plus the mtime and size of its source file, checked by stale_tags).
+      get() returns a read-only (N, 4) view of the mapped shard, equal to the np.fromfile of the frame.
+      The pack is not refreshed on read : rerun pack() (or the CLI) after the radar files change.
+
+      Args:
+        pack_dir : str, root directory of the packs
+        split_dir : str, split directory of the dataset (ex : DATA_DIR/validation)
+    """
+    def __init__(self, pack_dir, split_dir):
+        self.pc_dir = os.path.join(split_dir, "radar_6455")
+        self.pack_dir = os.path.join(pack_dir, os.path.basename(os.path.normpath(split_dir)))
+        self.index_path = os.path.join(self.pack_dir, "index.json")
+        self.entries = {}
+        self._shards = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, mode='r') as f:
+                self.entries = json.load(f)["entries"]
+
+    def _pc_path(self, tag):
+        return "%s/%06d.bin" % (self.pc_dir, int(tag))
+
+    def _source_stamp(self, tag):
+        st = os.stat(self._pc_path(tag))
+        return [st.st_mtime_ns, st.st_size]
+
+    def _shard_path(self, shard):
+        return os.path.join(self.pack_dir, "shard_%05d.bin" % shard)
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(self._shard_path(shard), dtype=np.float32, mode='r').reshape(-1, POINT_DIM)
+        return self._shards[shard]
+
+    def __contains__(self, tag):
+        return "%06d" % int(tag) in self.entries
+
+    def stale_tags(self, tags):
+        # tags missing from the pack or whose radar file changed since it was packed
+        return [tag for tag in tags if tag not in self or self.entries["%06d" % int(tag)][3:] != self._source_stamp(tag)]
+
+    def pack(self, tags, shard_bytes=1 << 30, verbose=False):
+        # rewrites the whole pack with the frames of tags
+        os.makedirs(self.pack_dir, exist_ok=True)
+        for name in os.listdir(self.pack_dir):
+            if name.startswith("shard_"):
+                os.remove(os.path.join(self.pack_dir, name))
+        self.entries, self._shards = {}, {}
+        shard, offset, f = 0, 0, None
+        for tag in sorted(tags):
+            stamp = self._source_stamp(tag)
+            with open(self._pc_path(tag), mode='rb') as src:
+                data = src.read()
+            if f is None or (offset > 0 and (offset * POINT_DIM * 4 + len(data)) > shard_bytes):
+                if f is not None:
+                    f.close()
+                    if verbose:
+                        print("radar pack: wrote {}".format(self._shard_path(shard)))
+                    shard, offset = shard + 1, 0
+                f = open(self._shard_path(shard), mode='wb')
+            f.write(data)
+            n_points = len(data) // (POINT_DIM * 4)
+            self.entries["%06d" % int(tag)] = [shard, offset, n_points] + stamp
+            offset += n_points
+        if f is not None:
+            f.close()
+            if verbose:
+                print("radar pack: wrote {}".format(self._shard_path(shard)))
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, mode='w') as f:
+            json.dump({"entries": self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, tag):
+        # Input:
+        #   tag: frame tag
+        # Output:
+        #   (N, 4) float32 read-only view
+        shard, offset, n_points = self.entries["%06d" % int(tag)][:3]
+        return self._shard(shard)[offset:offset + n_points]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the radar frames of a split into shard files")
+    parser.add_argument("--data_root_dir", required=True, help="Data root directory", type=str)
+    parser.add_argument("--split", default="training", help="Split to pack (training, validation or testing)", type=str)
+    parser.add_argument("--pack_dir", required=True, help="Root directory of the radar packs", type=str)
+    parser.add_argument("--shard_mb", default=1024, help="Approximate size of a shard in MB", type=int)
+    args = parser.parse_args()
+
+    split_dir = os.path.join(args.data_root_dir, args.split)
+    tags = sorted(a.split(".")[0] for a in os.listdir(os.path.join(split_dir, "radar_6455")) if a.endswith(".bin"))
+    radar_pack = RadarPack(args.pack_dir, split_dir)
+    if not radar_pack.stale_tags(tags) and len(radar_pack.entries) == len(tags):
+        print("radar pack {} is up to date ({} frames)".format(radar_pack.pack_dir, len(tags)))
+        return
+    radar_pack.pack(tags, shard_bytes=args.shard_mb << 20, verbose=True)
+    print("radar pack {}: {} frames packed".format(radar_pack.pack_dir, len(tags)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import numpy as np
+import tensorflow as tf
+
+from utils.box_overlaps import rotated_nms_sorted
+
+# max number of vertices of the intersection of two rectangles
+MAX_VERTICES = 8
+
+
+def box2d_corners(boxes2d):
+    # Input:
+    #   boxes2d: (N, 5) x, y, w, l, r
+    # Output:
+    #   (N, 4, 2) float64 counterclockwise corners, in the order of center_to_corner_box2d (w along the x
+    #   axis and l along the y axis of the box)
+    boxes2d = np.asarray(boxes2d, dtype=np.float64).reshape(-1, 5)
+    half = boxes2d[:, 2:4] / 2
+    local = np.array([[1, 1], [-1, 1], [-1, -1], [1, -1]], dtype=np.float64)[np.newaxis] * half[:, np.newaxis]
+    cos, sin = np.cos(boxes2d[:, 4])[:, np.newaxis], np.sin(boxes2d[:, 4])[:, np.newaxis]
+    x = cos * local[..., 0] - sin * local[..., 1] + boxes2d[:, 0:1]
+    y = sin * local[..., 0] + cos * local[..., 1] + boxes2d[:, 1:2]
+    return np.stack([x, y], axis=-1)
+
+
+def polygon_area(poly, count):
+    # Input:
+    #   poly: (P, M, 2) vertices, the first count of every polygon being valid
+    #   count: (P,)
+    # Output:
+    #   (P,) shoelace area
+    M = poly.shape[1]
+    index = np.arange(M)[np.newaxis]
+    nxt = np.where(index + 1 < count[:, np.newaxis], index + 1, 0)
+    nxt_poly = np.take_along_axis(poly, nxt[..., np.newaxis], axis=1)
+    cross = poly[..., 0] * nxt_poly[..., 1] - poly[..., 1] * nxt_poly[..., 0]
+    return np.abs(np.sum(np.where(index < count[:, np.newaxis], cross, 0), axis=1)) / 2
+
+
+def clip_polygons(poly, count, edge_start, edge_end):
+    # one Sutherland-Hodgman step : keeps the part of every polygon on the left of its edge
+    # Input:
+    #   poly: (P, M, 2), count: (P,) number of valid vertices
+    #   edge_start, edge_end: (P, 2) clipping edge of every polygon
+    # Output:
+    #   poly: (P, min(2M, MAX_VERTICES), 2), count: (P,)
+    P, M = poly.shape[0:2]
+    index = np.arange(M)[np.newaxis]
+    valid = index < count[:, np.newaxis]
+    nxt = np.where(index + 1 < count[:, np.newaxis], index + 1, 0)
+    nxt_poly = np.take_along_axis(poly, nxt[..., np.newaxis], axis=1)
+
+    edge = (edge_end - edge_start)[:, np.newaxis]
+    # signed distances (times the edge length), >= 0 on the left of the edge
+    dist = edge[..., 0] * (poly[..., 1] - edge_start[:, np.newaxis, 1]) - edge[..., 1] * (poly[..., 0] - edge_start[:, np.newaxis, 0])
+    nxt_dist = np.take_along_axis(dist, nxt, axis=1)
+    inside, nxt_inside = dist >= 0, nxt_dist >= 0
+
+    # every input vertex emits itself if inside, then the crossing point of its outgoing side if any
+    crossing = valid & (inside != nxt_inside)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(crossing, dist / (dist - nxt_dist), 0)
+    out = np.stack([poly, poly + t[..., np.newaxis] * (nxt_poly - poly)], axis=2).reshape(P, 2 * M, 2)
+    keep = np.stack([valid & inside, crossing], axis=2).reshape(P, 2 * M)
+
+    # compact the kept vertices at the front, in order
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :min(2 * M, MAX_VERTICES)]
+    return np.take_along_axis(out, order[..., np.newaxis], axis=1), np.minimum(keep.sum(axis=1), MAX_VERTICES)
+
+
+def bev_intersection(corners1, corners2):
+    # Input:
+    #   corners1, corners2: (P, 4, 2) counterclockwise corners of P pairs of rectangles
+    # Output:
+    #   (P,) intersection areas
+    poly, count = corners1, np.full((len(corners1)), 4)
+    for i in range(4):
+        poly, count = clip_polygons(poly, count, corners2[:, i], corners2[:, (i + 1) % 4])
+    return polygon_area(poly, count)
+
+
+def bev_intersections(boxes2d, gt_boxes2d, chunk_pairs=65536):
+    # Input:
+    #   boxes2d: (N1, 5) x, y, w, l, r
+    #   gt_boxes2d: (N2, 5) x, y, w, l, r
+    # Output:
+    #   (N1, N2) float64 exact bird view intersection areas, the polygons are only clipped for the pairs
+    #   whose standup boxes intersect, by blocks of chunk_pairs pairs
+    corners1, corners2 = box2d_corners(boxes2d), box2d_corners(gt_boxes2d)
+    inter = np.zeros((len(corners1), len(corners2)))
+    if inter.size == 0:
+        return inter
+    low1, high1 = corners1.min(axis=1), corners1.max(axis=1)
+    low2, high2 = corners2.min(axis=1), corners2.max(axis=1)
+    candidates = np.all((low1[:, np.newaxis] < high2[np.newaxis]) & (low2[np.newaxis] < high1[:, np.newaxis]), axis=-1)
+    # flat boxes have no inside to clip with
+    candidates &= (polygon_area(corners1, np.full((len(corners1)), 4)) > 0)[:, np.newaxis]
+    candidates &= (polygon_area(corners2, np.full((len(corners2)), 4)) > 0)[np.newaxis]
+    idx1, idx2 = np.nonzero(candidates)
+    for start in range(0, len(idx1), chunk_pairs):
+        i, j = idx1[start:start + chunk_pairs], idx2[start:start + chunk_pairs]
+        inter[i, j] = bev_intersection(corners1[i], corners2[j])
+    return inter
+
+
+def iou_bev(boxes2d, gt_boxes2d):
+    # Input:
+    #   boxes2d: (N1, 5) x, y, w, l, r
+    #   gt_boxes2d: (N2, 5) x, y, w, l, r
+    # Output:
+    #   (N1, N2) float64 bird view iou of the rotated boxes (0 for empty unions)
+    boxes2d = np.asarray(boxes2d, dtype=np.float64).reshape(-1, 5)
+    gt_boxes2d = np.asarray(gt_boxes2d, dtype=np.float64).reshape(-1, 5)
+    inter = bev_intersections(boxes2d, gt_boxes2d)
+    area1 = boxes2d[:, 2] * boxes2d[:, 3]
+    area2 = gt_boxes2d[:, 2] * gt_boxes2d[:, 3]
+    union = area1[:, np.newaxis] + area2[np.newaxis] - inter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, inter / union, 0.)
+
+
+def iou_3d(boxes3d, gt_boxes3d):
+    # Input:
+    #   boxes3d: (N1, 7) x, y, z, h, w, l, r (z at the center of the box)
+    #   gt_boxes3d: (N2, 7) x, y, z, h, w, l, r
+    # Output:
+    #   (N1, N2) float64 3d iou of the boxes rotated around z (0 for empty unions)
+    boxes3d = np.asarray(boxes3d, dtype=np.float64).reshape(-1, 7)
+    gt_boxes3d = np.asarray(gt_boxes3d, dtype=np.float64).reshape(-1, 7)
+    inter = bev_intersections(boxes3d[:, [0, 1, 4, 5, 6]], gt_boxes3d[:, [0, 1, 4, 5, 6]])
+    top = np.minimum((boxes3d[:, 2] + boxes3d[:, 3] / 2)[:, np.newaxis], (gt_boxes3d[:, 2] + gt_boxes3d[:, 3] / 2)[np.newaxis])
+    bottom = np.maximum((boxes3d[:, 2] - boxes3d[:, 3] / 2)[:, np.newaxis], (gt_boxes3d[:, 2] - gt_boxes3d[:, 3] / 2)[np.newaxis])
+    inter = inter * np.maximum(top - bottom, 0)
+    volume1 = boxes3d[:, 3] * boxes3d[:, 4] * boxes3d[:, 5]
+    volume2 = gt_boxes3d[:, 3] * gt_boxes3d[:, 4] * gt_boxes3d[:, 5]
+    union = volume1[:, np.newaxis] + volume2[np.newaxis] - inter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, inter / union, 0.)
+
+
+def rotated_nms(boxes2d, scores, iou_threshold, max_output_size, score_threshold=-np.inf, pre_topk=0, num_threads=0):
+    # greedy nms with the rotated bird view iou (rotated_nms_sorted of utils/box_overlaps.pyx)
+    # Input:
+    #   boxes2d: (N, 5) x, y, w, l, r
+    #   scores: (N,)
+    #   iou_threshold: boxes with an iou > iou_threshold with a kept box are suppressed
+    #   max_output_size: max number of kept boxes
+    #   score_threshold: boxes with a score < score_threshold are dropped first
+    #   pre_topk: only the pre_topk best boxes are candidates (all if 0)
+    # Output:
+    #   (K,) indices of the kept boxes, by decreasing score
+    scores = np.asarray(scores).reshape(-1)
+    candidates = np.flatnonzero(scores >= score_threshold)
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    if pre_topk:
+        order = order[:pre_topk]
+    corners = box2d_corners(np.asarray(boxes2d).reshape(-1, 5)[order])
+    return order[rotated_nms_sorted(corners, iou_threshold, max_output_size, num_threads)]
+
+
+def rotated_nms_frames(boxes2d, num_valid, iou_threshold, max_output_size, num_threads=0):
+    # rotated_nms_sorted on a batch of frames whose candidates are already sorted by decreasing score
+    # Input:
+    #   boxes2d: (B, K, 5) x, y, w, l, r
+    #   num_valid: (B,) the first num_valid candidates of every frame are valid
+    # Output:
+    #   keep: (B, max_output_size) int32 indices of the kept boxes, by decreasing score, -1 padded
+    #   num_kept: (B,) int32
+    keep = np.full((len(boxes2d), max_output_size), -1, dtype=np.int32)
+    num_kept = np.zeros((len(boxes2d)), dtype=np.int32)
+    for b in range(len(boxes2d)):
+        ind = rotated_nms_sorted(box2d_corners(boxes2d[b, :num_valid[b]]), iou_threshold, max_output_size, num_threads)
+        keep[b, :len(ind)], num_kept[b] = ind, len(ind)
+    return keep, num_kept
+
+
+def box2d_corners_tf(boxes2d):
+    # box2d_corners with tensorflow ops : [N, 5] -> [N, 4, 2]
+    half = boxes2d[:, 2:4] / 2
+    local = tf.constant([[1, 1], [-1, 1], [-1, -1], [1, -1]], dtype=boxes2d.dtype)[tf.newaxis] * half[:, tf.newaxis]
+    cos, sin = tf.cos(boxes2d[:, 4:5]), tf.sin(boxes2d[:, 4:5])
+    x = cos * local[..., 0] - sin * local[..., 1] + boxes2d[:, 0:1]
+    y = sin * local[..., 0] + cos * local[..., 1] + boxes2d[:, 1:2]
+    return tf.stack([x, y], axis=-1)
+
+
+def polygon_area_tf(poly, count):
+    # polygon_area with tensorflow ops
+    M = poly.shape[1]
+    index = tf.range(M)[tf.newaxis]
+    nxt = tf.where(index + 1 < count[:, tf.newaxis], index + 1, 0)
+    nxt_poly = tf.gather(poly, nxt, batch_dims=1)
+    cross = poly[..., 0] * nxt_poly[..., 1] - poly[..., 1] * nxt_poly[..., 0]
+    return tf.abs(tf.reduce_sum(tf.where(index < count[:, tf.newaxis], cross, 0), axis=1)) / 2
+
+
+def clip_polygons_tf(poly, count, edge_start, edge_end):
+    # clip_polygons with tensorflow ops
+    M = poly.shape[1]
+    index = tf.range(M)[tf.newaxis]
+    valid = index < count[:, tf.newaxis]
+    nxt = tf.where(index + 1 < count[:, tf.newaxis], index + 1, 0)
+    nxt_poly = tf.gather(poly, nxt, batch_dims=1)
+
+    edge = (edge_end - edge_start)[:, tf.newaxis]
+    dist = edge[..., 0] * (poly[..., 1] - edge_start[:, tf.newaxis, 1]) - edge[..., 1] * (poly[..., 0] - edge_start[:, tf.newaxis, 0])
+    nxt_dist = tf.gather(dist, nxt, batch_dims=1)
+    inside, nxt_inside = dist >= 0, nxt_dist >= 0
+
+    crossing = valid & (inside != nxt_inside)
+    t = tf.math.divide_no_nan(dist, tf.where(crossing, dist - nxt_dist, 1))
+    out = tf.reshape(tf.stack([poly, poly + t[..., tf.newaxis] * (nxt_poly - poly)], axis=2), [-1, 2 * M, 2])
+    keep = tf.reshape(tf.stack([valid & inside, crossing], axis=2), [-1, 2 * M])
+
+    order = tf.argsort(tf.cast(~keep, tf.int32), axis=1, stable=True)[:, :min(2 * M, MAX_VERTICES)]
+    return tf.gather(out, order, batch_dims=1), tf.minimum(tf.reduce_sum(tf.cast(keep, tf.int32), axis=1), MAX_VERTICES)
+
+
+def iou_bev_tf(boxes2d, gt_boxes2d):
+    # iou_bev with tensorflow ops
+    # Input:
+    #   boxes2d: [N1, 5] x, y, w, l, r
+    #   gt_boxes2d: [N2, 5]
+    # Output:
+    #   [N1, N2] iou, in the dtype of the boxes, the polygons are only clipped for the pairs whose standup
+    #   boxes intersect
+    corners1, corners2 = box2d_corners_tf(boxes2d), box2d_corners_tf(gt_boxes2d)
+    low1, high1 = tf.reduce_min(corners1, axis=1), tf.reduce_max(corners1, axis=1)
+    low2, high2 = tf.reduce_min(corners2, axis=1), tf.reduce_max(corners2, axis=1)
+    area1 = boxes2d[:, 2] * boxes2d[:, 3]
+    area2 = gt_boxes2d[:, 2] * gt_boxes2d[:, 3]
+    candidates = tf.reduce_all((low1[:, tf.newaxis] < high2[tf.newaxis]) & (low2[tf.newaxis] < high1[:, tf.newaxis]), axis=-1)
+    # flat boxes intersect nothing
+    candidates &= (area1[:, tf.newaxis] > 0) & (area2[tf.newaxis] > 0)
+    pairs = tf.where(candidates)
+    poly, count = tf.gather(corners1, pairs[:, 0]), tf.fill(tf.shape(pairs[:, 0]), 4)
+    clip = tf.gather(corners2, pairs[:, 1])
+    for i in range(4):
+        poly, count = clip_polygons_tf(poly, count, clip[:, i], clip[:, (i + 1) % 4])
+    inter = tf.scatter_nd(pairs, polygon_area_tf(poly, count), tf.shape(candidates, out_type=tf.int64))
+    return tf.math.divide_no_nan(inter, area1[:, tf.newaxis] + area2[tf.newaxis] - inter)
+
+
+def rotated_nms_sorted_tf(boxes2d, num_valid, iou_threshold, max_output_size):
+    # rotated_nms_frames with tensorflow ops. Like rotated_nms_sorted, only the iou rows of the kept boxes
+    # are computed (one per iteration of a while loop, for all the frames at once), the polygons being
+    # clipped for the candidates left whose standup boxes intersect the kept box
+    # Input:
+    #   boxes2d: [B, K, 5] x, y, w, l, r
+    #   num_valid: [B] int32, the first num_valid candidates of every frame are valid
+    # Output:
+    #   keep: [B, max_output_size] int32 indices of the kept boxes, by decreasing score, -1 padded
+    #   num_kept: [B] int32
+    B, K = tf.shape(boxes2d)[0], tf.shape(boxes2d)[1]
+    corners = tf.reshape(box2d_corners_tf(tf.reshape(boxes2d, [-1, 5])), [B, K, 4, 2])
+    low, high = tf.reduce_min(corners, axis=2), tf.reduce_max(corners, axis=2)
+    area = boxes2d[..., 2] * boxes2d[..., 3]
+    index = tf.range(K)[tf.newaxis]
+
+    def body(i, active, keep, num_kept):
+        found = tf.reduce_any(active, axis=1)
+        best = tf.argmax(tf.cast(active, tf.int32), axis=1, output_type=tf.int32)
+        keep = tf.where(tf.range(max_output_size)[tf.newaxis] == i, tf.where(found, best, -1)[:, tf.newaxis], keep)
+        num_kept += tf.cast(found, tf.int32)
+        active &= index != best[:, tf.newaxis]
+
+        best_low, best_high = tf.gather(low, best, batch_dims=1), tf.gather(high, best, batch_dims=1)
+        best_area = tf.gather(area, best, batch_dims=1)
+        # flat boxes intersect nothing
+        candidates = active & tf.reduce_all((low < best_high[:, tf.newaxis]) & (best_low[:, tf.newaxis] < high), axis=-1)
+        candidates &= (area > 0) & (best_area > 0)[:, tf.newaxis]
+        pairs = tf.where(candidates)
+        poly, count = tf.gather_nd(corners, pairs), tf.fill(tf.shape(pairs[:, 0]), 4)
+        clip = tf.gather(tf.gather(corners, best, batch_dims=1), pairs[:, 0])
+        for j in range(4):
+            poly, count = clip_polygons_tf(poly, count, clip[:, j], clip[:, (j + 1) % 4])
+        inter = polygon_area_tf(poly, count)
+        iou = tf.math.divide_no_nan(inter, tf.gather_nd(area, pairs) + tf.gather(best_area, pairs[:, 0]) - inter)
+        suppressed = tf.scatter_nd(pairs, tf.cast(iou > iou_threshold, tf.int32), tf.shape(candidates, out_type=tf.int64))
+        return i + 1, active & (suppressed == 0), keep, num_kept
+
+    _, _, keep, num_kept = tf.while_loop(lambda i, active, keep, num_kept: (i < max_output_size) & tf.reduce_any(active), body,
+                                         [tf.constant(0), index < num_valid[:, tf.newaxis],
+                                          tf.fill([B, max_output_size], -1), tf.zeros([B], dtype=tf.int32)])
+    return keep, num_kept
+
+
+def rotated_nms_tf(boxes2d, scores, iou_threshold, max_output_size, score_threshold=-np.inf, pre_topk=0):
+    # rotated_nms with tensorflow ops (rotated_nms_sorted_tf)
+    # Input:
+    #   boxes2d: [N, 5] x, y, w, l, r
+    #   scores: [N]
+    # Output:
+    #   [K] indices of the kept boxes, by decreasing score
+    n = tf.shape(scores)[0]
+    scores = tf.where(scores >= score_threshold, scores, -np.inf)
+    k = tf.minimum(n, pre_topk) if pre_topk else n
+    top_scores, order = tf.math.top_k(scores, k=k)
+    # the dropped boxes are sorted last
+    n_valid = tf.reduce_sum(tf.cast(top_scores > -np.inf, tf.int32))
+    keep, num_kept = rotated_nms_sorted_tf(tf.gather(boxes2d, order)[tf.newaxis], n_valid[tf.newaxis], iou_threshold, max_output_size)
+    return tf.gather(order, keep[0, :num_kept[0]])
@@ -0,0 +1,290 @@
+import numpy as np
+import tensorflow as tf
+
+from utils.utils import anchor_to_standup_box2d, get_class_id
+from utils.box_overlaps import bbox_overlaps
+from utils.augment import quat_to_euler
+
+
+class RpnTargetAssigner:
+    """
+      Rpn target assignment of cal_rpn_target / assign_rpn_target for a list of frames at once.
+
+      The flat anchors, their diagonals and their standup boxes only depend on the anchors, they are
+      computed once here. assign() converts the boxes of all the frames to yaw boxes and standup boxes
+      in one go, gathers the non zero entries of their iou with the anchors and selects the positive and
+      negative anchors of every frame from these entries, with array operations over all the frames.
+      The results are the same as assign_rpn_target frame by frame (same anchors, same targets).
+
+      With the regular anchor grid of cal_anchors, the "grid" matcher only computes the iou of a box with
+      the anchors of the grid window under its standup box (widened by the +1 margin of bbox_overlaps),
+      its cost grows with the footprint of the boxes instead of the size of the map. The "dense" matcher
+      computes the iou with all the anchors, by blocks of chunk_boxes boxes, and works with any anchors.
+
+      assign_tf() is the same assignment written with tensorflow ops on padded batches of gt boxes, with
+      the dense iou of the boxes with all the anchors, so that it runs inside the compiled train step.
+
+      Args:
+        cfg : config edict (DETECT_OBJECT, RPN_POS_IOU, RPN_NEG_IOU, ANCHOR_H)
+        anchors : (w, l, 2, 7) anchors from cal_anchors
+        matcher : str, "grid" (falls back to "dense" if the anchors are not a regular grid) or "dense"
+        chunk_boxes : int, number of boxes per block of the dense iou matrix
+    """
+    def __init__(self, cfg, anchors, matcher="grid", chunk_boxes=16):
+        assert matcher in ["grid", "dense"], "Unknown anchor matcher {}".format(matcher)
+        self.cfg = cfg
+        self.chunk_boxes = chunk_boxes
+        self.feature_map_shape = anchors.shape[0:2]
+        self.anchors_reshaped = anchors.reshape(-1, 7)
+        self.anchors_d = np.sqrt(self.anchors_reshaped[:, 4]**2 + self.anchors_reshaped[:, 5]**2)
+        self.anchors_standup_2d = np.ascontiguousarray(
+            anchor_to_standup_box2d(self.anchors_reshaped[:, [0, 1, 4, 5]])).astype(np.float32)
+        # (A,) float64 +1 areas of the anchor standup boxes, as in bbox_overlaps
+        self.anchors_area_2d = ((self.anchors_standup_2d[:, 2] - self.anchors_standup_2d[:, 0]).astype(np.float64) + 1) * \
+                               ((self.anchors_standup_2d[:, 3] - self.anchors_standup_2d[:, 1]).astype(np.float64) + 1)
+        self.n_anchors = len(self.anchors_reshaped)
+        self.cls_id = get_class_id(cfg.DETECT_OBJECT) if cfg.DETECT_OBJECT in ['Car', 'Pedestrian', 'Cyclist'] else None
+
+        # anchor grid : x (resp. y) of the anchors only depends on the column (resp. row) of the map
+        self.grid_x = anchors[0, :, 0, 0]
+        self.grid_y = anchors[:, 0, 0, 1]
+        regular = (anchors.shape[2] == 2 and len(self.grid_x) > 1 and len(self.grid_y) > 1
+                   and np.array_equal(anchors[..., 0], np.broadcast_to(self.grid_x[np.newaxis, :, np.newaxis], anchors.shape[0:3]))
+                   and np.array_equal(anchors[..., 1], np.broadcast_to(self.grid_y[:, np.newaxis, np.newaxis], anchors.shape[0:3]))
+                   and np.allclose(np.diff(self.grid_x), self.grid_x[1] - self.grid_x[0])
+                   and np.allclose(np.diff(self.grid_y), self.grid_y[1] - self.grid_y[0]))
+        self.matcher = matcher if regular else "dense"
+        if self.matcher == "grid":
+            # largest half extents of the anchor standup boxes
+            self.anchor_half = np.max(self.anchors_standup_2d[:, 2:4] - self.anchors_standup_2d[:, 0:2], axis=0) / 2
+
+    def gt_boxes(self, label):
+        # Input:
+        #   label: (N', 11)
+        # Output:
+        #   (N'', 7) x y z h w l r boxes of the detected class, as gt_boxes3d_to_yaw(label_to_gt_box3d(...))
+        label = np.asarray(label, dtype=np.float64).reshape(-1, 11)
+        if self.cls_id is not None:
+            label = label[label[:, 10] == self.cls_id]
+        _, _, yaw = quat_to_euler(label[:, 6:10])
+        return np.concatenate([label[:, 0:6], yaw[:, np.newaxis]], axis=1)
+
+    @staticmethod
+    def gt_standup_2d(gt_boxes3d):
+        # standup boxes of center_to_corner_box2d(gt_boxes3d[:, [0, 1, 4, 5, 6]]) : as in assign_rpn_target,
+        # the 2d corners only span the w column, along the rotated y axis
+        half = gt_boxes3d[:, 4] / 2
+        dx = np.abs(-np.sin(gt_boxes3d[:, 6]) * half)
+        dy = np.abs(np.cos(gt_boxes3d[:, 6]) * half)
+        x = gt_boxes3d[:, 0]
+        y = gt_boxes3d[:, 1]
+        return np.stack([x - dx, y - dy, x + dx, y + dy], axis=1).astype(np.float32)
+
+    def dense_overlaps(self, gt_standup_2d):
+        # Input:
+        #   gt_standup_2d: (G, 4) float32
+        # Output:
+        #   id_anchor, id_gt, value: non zero entries of bbox_overlaps(anchors_standup_2d, gt_standup_2d),
+        #   by box then anchor, computed by blocks of chunk_boxes columns to stay in cache
+        id_anchor, id_gt, value = [np.zeros((0), dtype=np.int64)], [np.zeros((0), dtype=np.int64)], [np.zeros((0), dtype=np.float32)]
+        for start in range(0, len(gt_standup_2d), self.chunk_boxes):
+            iou = bbox_overlaps(self.anchors_standup_2d, gt_standup_2d[start:start + self.chunk_boxes]).ravel()
+            flat = np.flatnonzero(iou > 0)
+            chunk_anchor, chunk_gt = np.divmod(flat, min(self.chunk_boxes, len(gt_standup_2d) - start))
+            # by box then anchor
+            order = np.argsort(chunk_gt, kind='stable')
+            id_anchor.append(chunk_anchor[order])
+            id_gt.append(chunk_gt[order] + start)
+            value.append(iou[flat[order]])
+        return np.concatenate(id_anchor), np.concatenate(id_gt), np.concatenate(value)
+
+    def grid_windows(self, gt_standup_2d):
+        # Input:
+        #   gt_standup_2d: (G, 4) float32
+        # Output:
+        #   (G, 4) int64 first column, first row, last column, last row (included) of the anchors which can
+        #   overlap each box : bbox_overlaps counts an intersection when the boxes are less than 1 apart,
+        #   the window covers the anchor standup boxes up to 1 around the box, plus one cell of margin
+        step = np.array([self.grid_x[1] - self.grid_x[0], self.grid_y[1] - self.grid_y[0]])
+        origin = np.array([self.grid_x[0], self.grid_y[0]])
+        size = np.array([len(self.grid_x), len(self.grid_y)])
+        low = np.floor((gt_standup_2d[:, 0:2] - 1 - self.anchor_half - origin) / step).astype(np.int64) - 1
+        high = np.ceil((gt_standup_2d[:, 2:4] + 1 + self.anchor_half - origin) / step).astype(np.int64) + 1
+        return np.concatenate([np.clip(low, 0, size - 1), np.clip(high, 0, size - 1)], axis=1)
+
+    def grid_overlaps(self, gt_standup_2d):
+        # Input:
+        #   gt_standup_2d: (G, 4) float32
+        # Output:
+        #   id_anchor, id_gt, value: the same entries as dense_overlaps (by box then anchor), from the anchors
+        #   of the grid window of every box only
+        n_cols = len(self.grid_x)
+        id_anchor, id_gt, value = [np.zeros((0), dtype=np.int64)], [np.zeros((0), dtype=np.int64)], [np.zeros((0), dtype=np.float32)]
+        for k, (x0, y0, x1, y1) in enumerate(self.grid_windows(gt_standup_2d)):
+            if x1 < x0 or y1 < y0:
+                continue
+            cells = np.arange(y0, y1 + 1)[:, np.newaxis] * n_cols + np.arange(x0, x1 + 1)[np.newaxis, :]
+            candidates = (cells[..., np.newaxis] * 2 + np.arange(2)).ravel()
+            iou = bbox_overlaps(self.anchors_standup_2d[candidates], gt_standup_2d[k:k + 1])[:, 0]
+            nonzero = np.flatnonzero(iou > 0)
+            id_anchor.append(candidates[nonzero])
+            id_gt.append(np.full((len(nonzero)), k, dtype=np.int64))
+            value.append(iou[nonzero])
+        return np.concatenate(id_anchor), np.concatenate(id_gt), np.concatenate(value)
+
+    def assign(self, labels):
+        # Input:
+        #   labels: list of (N', 11) labels, one per frame
+        # Output:
+        #   list of (id_pos (P), targets_pos (P, 7), id_neg (Q)) per frame, see assign_rpn_target
+        gt_boxes = [self.gt_boxes(label) for label in labels]
+        n_frames = len(gt_boxes)
+        counts = np.array([len(boxes) for boxes in gt_boxes], dtype=np.int64)
+        gt = np.concatenate(gt_boxes, axis=0) if n_frames else np.zeros((0, 7))
+        gt_frame = np.repeat(np.arange(n_frames), counts)
+        A = self.n_anchors
+
+        # non zero entries of the (A, sum N') iou with the boxes of all the frames, by box then anchor (the
+        # boxes of an anchor stay in the order of the per frame np.where)
+        if self.matcher == "grid":
+            id_anchor, id_gt, value = self.grid_overlaps(self.gt_standup_2d(gt))
+        else:
+            id_anchor, id_gt, value = self.dense_overlaps(self.gt_standup_2d(gt))
+
+        # anchor with the highest iou of every box (if > 0), the first one on ties like np.argmax
+        starts = np.flatnonzero(np.diff(np.concatenate([[-1], id_gt])))
+        id_highest, id_highest_gt = np.zeros((0), dtype=np.int64), np.zeros((0), dtype=np.int64)
+        if len(starts):
+            box_max = np.maximum.reduceat(value, starts)
+            is_max = np.flatnonzero(value == np.repeat(box_max, np.diff(np.append(starts, len(value)))))
+            first = is_max[np.flatnonzero(np.diff(np.concatenate([[-1], id_gt[is_max]])))]
+            id_highest, id_highest_gt = id_anchor[first], id_gt[first]
+
+        # anchors with iou > RPN_POS_IOU
+        is_pos = value > self.cfg.RPN_POS_IOU
+        id_pos, id_pos_gt = id_anchor[is_pos], id_gt[is_pos]
+
+        # anchors with iou < RPN_NEG_IOU with all the boxes of the frame
+        is_neg = np.ones((n_frames, A), dtype=bool)
+        not_neg = value >= self.cfg.RPN_NEG_IOU
+        is_neg[gt_frame[id_gt[not_neg]], id_anchor[not_neg]] = False
+        # to avoid a box be pos/neg in the same time
+        is_neg[gt_frame[id_highest_gt], id_highest] = False
+
+        # first occurrence of each (frame, anchor) among the positive then the highest anchors
+        keys = np.concatenate([gt_frame[id_pos_gt] * A + id_pos, gt_frame[id_highest_gt] * A + id_highest])
+        all_gt = np.concatenate([id_pos_gt, id_highest_gt])
+        keys, index = np.unique(keys, return_index=True)
+        pos_frame, id_pos, id_pos_gt = keys // A, keys % A, all_gt[index]
+
+        # regression targets
+        gt_pos = gt[id_pos_gt]
+        anchors_pos = self.anchors_reshaped[id_pos]
+        targets_pos = np.zeros((len(id_pos), 7), dtype=np.float32)
+        targets_pos[:, [0, 1]] = (gt_pos[:, [0, 1]] - anchors_pos[:, [0, 1]]) / self.anchors_d[id_pos, np.newaxis]
+        targets_pos[:, 2] = (gt_pos[:, 2] - anchors_pos[:, 2]) / self.cfg.ANCHOR_H
+        targets_pos[:, [3, 4, 5]] = np.log(gt_pos[:, [3, 4, 5]] / anchors_pos[:, [3, 4, 5]])
+        targets_pos[:, 6] = gt_pos[:, 6] - anchors_pos[:, 6]
+
+        bounds = np.searchsorted(pos_frame, np.arange(n_frames + 1))
+        return [(id_pos[bounds[i]:bounds[i + 1]], targets_pos[bounds[i]:bounds[i + 1]], np.flatnonzero(is_neg[i]))
+                for i in range(n_frames)]
+
+    def dense(self, labels):
+        # Input:
+        #   labels: list of (N', 11) labels, one per frame
+        # Output:
+        #   pos_equal_one (N, w, l, 2), neg_equal_one (N, w, l, 2), targets (N, w, l, 14), as cal_rpn_target
+        n_frames = len(labels)
+        pos_equal_one = np.zeros((n_frames, self.n_anchors), dtype=np.float32)
+        neg_equal_one = np.zeros((n_frames, self.n_anchors), dtype=np.float32)
+        targets = np.zeros((n_frames, self.n_anchors, 7), dtype=np.float32)
+        for i, (id_pos, targets_pos, id_neg) in enumerate(self.assign(labels)):
+            pos_equal_one[i, id_pos] = 1
+            neg_equal_one[i, id_neg] = 1
+            targets[i, id_pos] = targets_pos
+        shape = (n_frames, *self.feature_map_shape)
+        return pos_equal_one.reshape(*shape, 2), neg_equal_one.reshape(*shape, 2), targets.reshape(*shape, 14)
+
+    def assign_tf(self, gt_boxes, num_gt_boxes):
+        # Input:
+        #   gt_boxes: [B, G, 7] float64 x y z h w l r boxes of gt_boxes(), padded
+        #   num_gt_boxes: [B] int32 number of boxes of every frame
+        # Output:
+        #   dict of the dense pos_equal_one, neg_equal_one, targets, pos_equal_one_reg, pos_equal_one_sum and
+        #   neg_equal_one_sum maps of the batch, the same as dense() (padded boxes are masked out)
+        gt_boxes = tf.cast(gt_boxes, tf.float64)
+        n_gt = tf.shape(gt_boxes)[1]
+        # [B, G]
+        valid = tf.range(n_gt)[tf.newaxis, :] < tf.cast(num_gt_boxes, tf.int32)[:, tf.newaxis]
+
+        # standup boxes of the degenerate 2d corners, see gt_standup_2d
+        half = gt_boxes[..., 4] / 2
+        dx = tf.abs(-tf.sin(gt_boxes[..., 6]) * half)
+        dy = tf.abs(tf.cos(gt_boxes[..., 6]) * half)
+        gt_standup = tf.cast(tf.stack([gt_boxes[..., 0] - dx, gt_boxes[..., 1] - dy,
+                                       gt_boxes[..., 0] + dx, gt_boxes[..., 1] + dy], axis=-1), tf.float32)
+
+        # [B, A, G] iou of bbox_overlaps(anchors_standup_2d, gt_standup), with its float32 / float64 mix : the
+        # widths and heights get their +1 in float64, the union is summed in float64 and rounded to float32
+        anchors = tf.constant(self.anchors_standup_2d)[tf.newaxis, :, tf.newaxis, :]
+        gt = gt_standup[:, tf.newaxis, :, :]
+        # (the casts also keep grappler from moving the +1 constants into the float32 differences)
+        def plus_one(x):
+            return tf.cast(x, tf.float64) + 1
+        iw = tf.cast(plus_one(tf.minimum(anchors[..., 2], gt[..., 2]) - tf.maximum(anchors[..., 0], gt[..., 0])), tf.float32)
+        ih = tf.cast(plus_one(tf.minimum(anchors[..., 3], gt[..., 3]) - tf.maximum(anchors[..., 1], gt[..., 1])), tf.float32)
+        anchor_area = tf.constant(self.anchors_area_2d)[tf.newaxis, :, tf.newaxis]
+        gt_area = tf.cast(plus_one(gt[..., 2] - gt[..., 0]) * plus_one(gt[..., 3] - gt[..., 1]), tf.float32)
+        inter = iw * ih
+        union = tf.cast(anchor_area + tf.cast(gt_area, tf.float64) - tf.cast(inter, tf.float64), tf.float32)
+        iou = tf.where((iw > 0) & (ih > 0) & valid[:, tf.newaxis, :], inter / union, 0.)
+
+        # anchor with the highest iou of every box (if > 0), the first one on ties
+        box_max = tf.reduce_max(iou, axis=1, keepdims=True)
+        anchor_index = tf.range(self.n_anchors)[tf.newaxis, :, tf.newaxis]
+        highest = tf.reduce_min(tf.where(iou == box_max, anchor_index, self.n_anchors), axis=1, keepdims=True)
+        is_highest = (anchor_index == highest) & (box_max > 0)
+
+        # positive anchors, regressed to their first box with iou > RPN_POS_IOU, else to the first box they
+        # are the highest anchor of (the first occurrence kept by assign())
+        is_pos_iou = iou > self.cfg.RPN_POS_IOU
+        gt_index = tf.range(n_gt)[tf.newaxis, tf.newaxis, :]
+        first_pos = tf.reduce_min(tf.where(is_pos_iou, gt_index, n_gt), axis=-1)
+        first_highest = tf.reduce_min(tf.where(is_highest, gt_index, n_gt), axis=-1)
+        # [B, A]
+        match = tf.where(first_pos < n_gt, first_pos, first_highest)
+        pos = match < n_gt
+        # negative anchors, iou < RPN_NEG_IOU with all the boxes and not the highest anchor of a box
+        neg = tf.reduce_all(iou < self.cfg.RPN_NEG_IOU, axis=-1) & ~tf.reduce_any(is_highest, axis=-1)
+
+        # regression targets, in float64 like assign()
+        gt_pos = tf.gather(gt_boxes, tf.minimum(match, n_gt - 1), batch_dims=1)
+        anchors_3d = tf.constant(self.anchors_reshaped)[tf.newaxis]
+        anchors_d = tf.constant(self.anchors_d)[tf.newaxis, :, tf.newaxis]
+        targets = tf.concat([(gt_pos[..., 0:2] - anchors_3d[..., 0:2]) / anchors_d,
+                             (gt_pos[..., 2:3] - anchors_3d[..., 2:3]) / self.cfg.ANCHOR_H,
+                             tf.math.log(gt_pos[..., 3:6] / anchors_3d[..., 3:6]),
+                             gt_pos[..., 6:7] - anchors_3d[..., 6:7]], axis=-1)
+        targets = tf.where(pos[..., tf.newaxis], tf.cast(targets, tf.float32), 0.)
+
+        batch_size = tf.shape(gt_boxes)[0]
+        return rpn_target_maps_tf(tf.reshape(tf.cast(pos, tf.float32), [batch_size, *self.feature_map_shape, 2]),
+                                  tf.reshape(tf.cast(neg, tf.float32), [batch_size, *self.feature_map_shape, 2]),
+                                  tf.reshape(targets, [batch_size, *self.feature_map_shape, 14]))
+
+
+def rpn_target_maps_tf(pos_equal_one, neg_equal_one, targets):
+    # Input:
+    #   pos_equal_one: [B, w, l, 2]
+    #   neg_equal_one: [B, w, l, 2]
+    #   targets: [B, w, l, 14]
+    # Output:
+    #   dict of the maps with pos_equal_one_reg [B, w, l, 14], pos_equal_one_sum and neg_equal_one_sum [B, 1, 1, 1]
+    return {"pos_equal_one": pos_equal_one,
+            "neg_equal_one": neg_equal_one,
+            "targets": targets,
+            "pos_equal_one_reg": tf.concat([tf.tile(pos_equal_one[..., 0:1], [1, 1, 1, 7]),
+                                            tf.tile(pos_equal_one[..., 1:2], [1, 1, 1, 7])], axis=-1),
+            "pos_equal_one_sum": tf.reshape(tf.maximum(tf.reduce_sum(pos_equal_one, axis=[1, 2, 3]), 1.), [-1, 1, 1, 1]),
+            "neg_equal_one_sum": tf.reshape(tf.maximum(tf.reduce_sum(neg_equal_one, axis=[1, 2, 3]), 1.), [-1, 1, 1, 1])}
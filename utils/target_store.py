@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+from utils.utils import load_label
+from utils.target_assigner import RpnTargetAssigner, rpn_target_maps_tf
+
+# cfg fields that change the output of the rpn target assignment
+ANCHOR_CFG_KEYS = ["X_MIN", "X_MAX", "Y_MIN", "Y_MAX", "FEATURE_WIDTH", "FEATURE_HEIGHT", "DETECT_OBJECT",
+                   "ANCHOR_L", "ANCHOR_W", "ANCHOR_H", "ANCHOR_Z", "RPN_POS_IOU", "RPN_NEG_IOU"]
+SPARSE_TARGET_KEYS = ["pos_index", "pos_targets", "non_neg_index"]
+
+
+def anchor_config_hash(cfg):
+    blob = json.dumps({key: cfg[key] for key in ANCHOR_CFG_KEYS}, sort_keys=True)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:16]
+
+
+class RpnTargetStore:
+    """
+      Sparse rpn targets of a split, computed once per label file and anchor config.
+
+      A frame is kept as the flat index of its positive anchors with their 7 regression targets,
+      and as the flat index of its non negative anchors (the negative mask is its complement,
+      which is much smaller than the mask itself). The dense maps are rebuilt at batch time by
+      sparse_to_dense_rpn_target_tf. Entries are memoized in memory and, if cache_dir is given,
+      written to cache_dir/<anchor cfg hash>/<tag>.npz for the next runs. An entry is recomputed
+      when its label file is modified.
+
+      Args:
+        cfg : config edict
+        anchors : (w, l, 2, 7) anchors from cal_anchors
+        labels_dir : str, groundtruth_obj3d directory of the split
+        cache_dir : str, optional, root directory of the on-disk store
+    """
+    def __init__(self, cfg, anchors, labels_dir, cache_dir=None):
+        self.cfg = cfg
+        self.labels_dir = labels_dir
+        self.assigner = RpnTargetAssigner(cfg, anchors)
+        self.n_anchors = self.assigner.n_anchors
+        self.store_dir = None
+        if cache_dir:
+            self.store_dir = os.path.join(cache_dir, anchor_config_hash(cfg))
+            os.makedirs(self.store_dir, exist_ok=True)
+        self.entries = {}
+
+    def compute(self, label):
+        # Input:
+        #   label: (N', 11)
+        # Output:
+        #   dict of pos_index (P), pos_targets (P, 7), non_neg_index (Q)
+        id_pos, targets_pos, id_neg = self.assigner.assign([label])[0]
+        is_neg = np.zeros((self.n_anchors), dtype=bool)
+        is_neg[id_neg] = True
+        return {"pos_index": id_pos.astype(np.int32),
+                "pos_targets": targets_pos,
+                "non_neg_index": np.where(~is_neg)[0].astype(np.int32)}
+
+    def get(self, tag, label=None):
+        # label: (N', 11), optional, used instead of the label file when the entry is (re)computed
+        tag = "%06d" % int(tag)
+        label_path = os.path.join(self.labels_dir, tag + ".json")
+        mtime = os.stat(label_path).st_mtime_ns
+        entry = self.entries.get(tag)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+
+        store_path = os.path.join(self.store_dir, tag + ".npz") if self.store_dir else None
+        sparse = None
+        if store_path and os.path.exists(store_path):
+            with np.load(store_path) as f:
+                if int(f["label_mtime"]) == mtime:
+                    sparse = {key: f[key] for key in SPARSE_TARGET_KEYS}
+        if sparse is None:
+            sparse = self.compute(load_label(label_path) if label is None else label)
+            if store_path:
+                np.savez(store_path, label_mtime=mtime, **sparse)
+        self.entries[tag] = (mtime, sparse)
+        return sparse
+
+
+def sparse_to_dense_rpn_target_tf(batch, feature_map_shape):
+    # Input:
+    #   batch: padded batch with pos_index [B, P], pos_targets [B, P, 7], non_neg_index [B, Q] (padded with -1)
+    #   feature_map_shape: (w, l)
+    # Output:
+    #   batch with the dense pos_equal_one, neg_equal_one, targets, pos_equal_one_reg,
+    #   pos_equal_one_sum and neg_equal_one_sum maps instead of the sparse fields
+    batch_size = tf.shape(batch["pos_index"])[0]
+    n_anchors = feature_map_shape[0] * feature_map_shape[1] * 2
+
+    def scatter(index, updates, tail_shape):
+        valid = tf.where(index >= 0)
+        indices = tf.stack([valid[:, 0], tf.cast(tf.gather_nd(index, valid), tf.int64)], axis=-1)
+        shape = tf.stack([tf.cast(batch_size, tf.int64), n_anchors] + tail_shape)
+        return tf.scatter_nd(indices, tf.gather_nd(updates, valid), shape)
+
+    pos_index = batch.pop("pos_index")
+    pos_targets = batch.pop("pos_targets")
+    non_neg_index = batch.pop("non_neg_index")
+
+    pos_equal_one = scatter(pos_index, tf.ones_like(pos_index, dtype=tf.float32), [])
+    neg_equal_one = 1. - scatter(non_neg_index, tf.ones_like(non_neg_index, dtype=tf.float32), [])
+    targets = scatter(pos_index, pos_targets, [7])
+
+    batch.update(rpn_target_maps_tf(tf.reshape(pos_equal_one, [batch_size, *feature_map_shape, 2]),
+                                    tf.reshape(neg_equal_one, [batch_size, *feature_map_shape, 2]),
+                                    tf.reshape(targets, [batch_size, *feature_map_shape, 14])))
+    return batch
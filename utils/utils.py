@@ -6,6 +6,7 @@ import os
 
 #from config import cfg
 from utils.box_overlaps import *
+from utils.rotated_iou import iou_bev, iou_3d
 from config import cfg
 
 def process_pointcloud(point_cloud, cfg):
@@ -13,64 +14,93 @@ def process_pointcloud(point_cloud, cfg):
     #   (N, 4)
     # Output:
     #   voxel_dict
-    scene_size = np.array(cfg.SCENE_SIZE, dtype=np.float32)
     voxel_size = np.array(cfg.VOXEL_SIZE, dtype=np.float32)
     grid_size = np.array(cfg.GRID_SIZE, dtype=np.int64)
     lidar_coord = np.array(cfg.LIDAR_COORD, dtype=np.float32)
     max_point_number = cfg.MAX_POINT_NUMBER
-    
+
     if cfg.DETECT_OBJECT != "Car":
-        np.random.shuffle(point_cloud)
+        # not in place, the input may be a read-only view
+        point_cloud = point_cloud[np.random.permutation(len(point_cloud))]
 
     shifted_coord = point_cloud[:, :3] + lidar_coord
     # reverse the point cloud coordinate (X, Y, Z) -> (Z, Y, X)
     voxel_index = np.floor(
-        shifted_coord[:, ::-1] / voxel_size).astype(np.int)
+        shifted_coord[:, ::-1] / voxel_size).astype(np.int64)
 
-    bound_x = np.logical_and(
-        voxel_index[:, 2] >= 0, voxel_index[:, 2] < grid_size[2])
-    bound_y = np.logical_and(
-        voxel_index[:, 1] >= 0, voxel_index[:, 1] < grid_size[1])
-    bound_z = np.logical_and(
-        voxel_index[:, 0] >= 0, voxel_index[:, 0] < grid_size[0])
-
-    bound_box = np.logical_and(np.logical_and(bound_x, bound_y), bound_z)
+    bound_box = np.all((voxel_index >= 0) & (voxel_index < grid_size), axis=1)
 
     point_cloud = point_cloud[bound_box]
     voxel_index = voxel_index[bound_box]
 
+    # flatten (Z, Y, X) into one key, its order is the lexicographic order of the voxel index
+    voxel_key = (voxel_index[:, 0] * grid_size[1] + voxel_index[:, 1]) * grid_size[2] + voxel_index[:, 2]
+    unique_key, first_index, inverse, counts = np.unique(
+        voxel_key, return_index=True, return_inverse=True, return_counts=True)
+
     # [K, 3] coordinate buffer as described in the paper
-    coordinate_buffer = np.unique(voxel_index, axis=0)
+    coordinate_buffer = voxel_index[first_index]
 
     K = len(coordinate_buffer)
     T = max_point_number
 
+    # rank of every point inside its voxel, following the original point order
+    order = np.argsort(inverse, kind='stable')
+    group_start = np.cumsum(counts) - counts
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order)) - np.repeat(group_start, counts)
+    keep = rank < T
+
     # [K, 1] store number of points in each voxel grid
-    number_buffer = np.zeros(shape=(K), dtype=np.int64)
+    number_buffer = np.minimum(counts, T).astype(np.int64)
 
     # [K, T, 7] feature buffer as described in the paper
     feature_buffer = np.zeros(shape=(K, T, 7), dtype=np.float32)
+    feature_buffer[inverse[keep], rank[keep], :4] = point_cloud[keep]
 
-    # build a reverse index for coordinate buffer
-    index_buffer = {}
-    for i in range(K):
-        index_buffer[tuple(coordinate_buffer[i])] = i
-
-    for voxel, point in zip(voxel_index, point_cloud):
-        index = index_buffer[tuple(voxel)]
-        number = number_buffer[index]
-        if number < T:
-            feature_buffer[index, number, :4] = point
-            number_buffer[index] += 1
-
-    feature_buffer[:, :, -3:] = feature_buffer[:, :, :3] - \
-        feature_buffer[:, :, :3].sum(axis=1, keepdims=True)/number_buffer.reshape(K, 1, 1)
+    centroid = feature_buffer[:, :, :3].sum(axis=1, keepdims=True)/number_buffer.reshape(K, 1, 1)
+    np.subtract(feature_buffer[:, :, :3], centroid, out=feature_buffer[:, :, -3:])
 
     voxel_dict = {'feature_buffer': feature_buffer,
                   'coordinate_buffer': coordinate_buffer,
                   'number_buffer': number_buffer}
     return voxel_dict
 
+def cap_voxels(voxel_dict, max_voxels, policy="dense", rng=None):
+    # Input:
+    #   voxel_dict: output of process_pointcloud
+    #   max_voxels: max number of voxels kept per frame
+    #   policy: "dense" keeps the voxels with the most points (ties broken by voxel order),
+    #           "random" keeps a uniform random subset drawn from rng (np.random if None)
+    # Output:
+    #   voxel_dict with at most max_voxels voxels, in their original order
+    K = len(voxel_dict['number_buffer'])
+    if K <= max_voxels:
+        return voxel_dict
+    if policy == "dense":
+        keep = np.argsort(-np.asarray(voxel_dict['number_buffer']), kind='stable')[:max_voxels]
+    elif policy == "random":
+        keep = (np.random if rng is None else rng).choice(K, max_voxels, replace=False)
+    else:
+        raise ValueError("Unknown voxel drop policy {}".format(policy))
+    keep = np.sort(keep)
+    return {key: np.asarray(value)[keep] for key, value in voxel_dict.items()}
+
+def flatten_voxels(voxel_dict):
+    # Input:
+    #   voxel_dict: output of process_pointcloud (or cap_voxels)
+    # Output:
+    #   voxel_dict with the (K, T, 7) feature buffer replaced by the flat rows of the voxels, in voxel order:
+    #   point_features (P, 7) the points of every voxel followed by one of its padding rows (all equal) if
+    #   it has less than T points, point_voxel (P,) the voxel of every row
+    feature_buffer = np.asarray(voxel_dict['feature_buffer'])
+    K, T = feature_buffer.shape[:2]
+    num_rows = np.minimum(np.asarray(voxel_dict['number_buffer']) + 1, T)
+    flat = {key: value for key, value in voxel_dict.items() if key != 'feature_buffer'}
+    flat['point_features'] = feature_buffer[np.arange(T) < num_rows[:, np.newaxis]]
+    flat['point_voxel'] = np.repeat(np.arange(K, dtype=np.int32), num_rows)
+    return flat
+
 # transformation matrix converts from sensorA->sensorB to sensorB->sensorA
 def inv_trans(T):
     rotation = np.linalg.inv(T[0:3, 0:3])  # rotation matrix
@@ -622,17 +652,20 @@ def label_to_gt_box3d(labels, cls='Car'):
     return boxes3d
 
 
-def box3d_to_label(tag, batch_box3d, batch_cls, batch_score=[], coordinate='camera', P2 = None, T_VELO_2_CAM=None, R_RECT_0=None):
+def box3d_to_label(tag, batch_box3d, batch_cls, batch_score=[], coordinate='camera', P2 = None, T_VELO_2_CAM=None, R_RECT_0=None, calib=None):
     # Input:
     #   (N, N', 7) x y z h w l r
     #   (N, N')
     #   cls: (N, N') 'Car' or 'Pedestrain' or 'Cyclist'
     #   coordinate(input): 'camera' or 'lidar'
+    #   calib: optional (T_toLidar, T_toCamera, K) of the frame, read from the validation calibration file if None
     # Output:
     #   label: (N, N') N batches and N lines
     batch_label = []
-    calib_dir = "{}/{}/calibration".format(cfg.DATA_DIR, 'validation')
-    _, Tr, P = load_calib(os.path.join(calib_dir, tag + '.json'))
+    if calib is None:
+        calib_dir = "{}/{}/calibration".format(cfg.DATA_DIR, 'validation')
+        calib = load_calib(os.path.join(calib_dir, tag + '.json'))
+    _, Tr, P = calib
     R_RECT_0 = cfg.MATRIX_R_RECT_0
 
     if batch_score:
@@ -811,6 +844,59 @@ def gt_boxes3d_to_yaw(batch_boxes):
     return batch_boxes_yaw
 
 
+def assign_rpn_target(gt_boxes3d, anchors_reshaped, anchors_d, anchors_standup_2d, coordinate='lidar'):
+    # Input:
+    #   gt_boxes3d: (N', 7) x y z h w l r
+    #   anchors_reshaped: (w*l*2, 7)
+    #   anchors_d: (w*l*2)
+    #   anchors_standup_2d: (w*l*2, 4)
+    # Output:
+    #   id_pos: (P) flat index of the positive anchors
+    #   targets_pos: (P, 7) regression targets of the positive anchors
+    #   id_neg: (Q) flat index of the negative anchors
+    # BOTTLENECK
+    gt_standup_2d = corner_to_standup_box2d(center_to_corner_box2d(
+        gt_boxes3d[:, [0, 1, 4, 5, 6]], coordinate=coordinate))
+
+    iou = bbox_overlaps(
+        np.ascontiguousarray(anchors_standup_2d).astype(np.float32),
+        np.ascontiguousarray(gt_standup_2d).astype(np.float32),
+    )
+
+    # find anchor with highest iou(iou should also > 0)
+    id_highest = np.argmax(iou.T, axis=1)
+    id_highest_gt = np.arange(iou.T.shape[0])
+    mask = iou.T[id_highest_gt, id_highest] > 0
+    id_highest, id_highest_gt = id_highest[mask], id_highest_gt[mask]
+
+    # find anchor iou > cfg.XXX_POS_IOU
+    id_pos, id_pos_gt = np.where(iou > cfg.RPN_POS_IOU)
+
+    # find anchor iou < cfg.XXX_NEG_IOU
+    id_neg = np.where(np.sum(iou < cfg.RPN_NEG_IOU,
+                             axis=1) == iou.shape[1])[0]
+
+    id_pos = np.concatenate([id_pos, id_highest])
+    id_pos_gt = np.concatenate([id_pos_gt, id_highest_gt])
+
+    # TODO: uniquify the array in a more scientific way
+    id_pos, index = np.unique(id_pos, return_index=True)
+    id_pos_gt = id_pos_gt[index]
+    # to avoid a box be pos/neg in the same time
+    id_neg = np.setdiff1d(id_neg, id_highest)
+
+    # cal the target
+    gt = gt_boxes3d[id_pos_gt]
+    anchors_pos = anchors_reshaped[id_pos]
+    targets_pos = np.zeros((len(id_pos), 7), dtype=np.float32)
+    targets_pos[:, [0, 1]] = (gt[:, [0, 1]] - anchors_pos[:, [0, 1]]) / anchors_d[id_pos, np.newaxis]
+    targets_pos[:, 2] = (gt[:, 2] - anchors_pos[:, 2]) / cfg.ANCHOR_H
+    targets_pos[:, [3, 4, 5]] = np.log(gt[:, [3, 4, 5]] / anchors_pos[:, [3, 4, 5]])
+    targets_pos[:, 6] = gt[:, 6] - anchors_pos[:, 6]
+
+    return id_pos, targets_pos, id_neg
+
+
 def cal_rpn_target(labels, feature_map_shape, anchors, cls='Car', coordinate='lidar'):
     # Input:
     #   labels: (N, N')
@@ -838,72 +924,33 @@ def cal_rpn_target(labels, feature_map_shape, anchors, cls='Car', coordinate='li
         # BOTTLENECK
         anchors_standup_2d = anchor_to_standup_box2d(
             anchors_reshaped[:, [0, 1, 4, 5]])
-        # BOTTLENECK
-        gt_standup_2d = corner_to_standup_box2d(center_to_corner_box2d(
-            batch_gt_boxes3d[batch_id][:, [0, 1, 4, 5, 6]], coordinate=coordinate))
-
-        iou = bbox_overlaps(
-            np.ascontiguousarray(anchors_standup_2d).astype(np.float32),
-            np.ascontiguousarray(gt_standup_2d).astype(np.float32),
-        )
-        # iou = cal_box3d_iou(
-        #     anchors_reshaped,
-        #     batch_gt_boxes3d[batch_id]
-        # )
-
-        # find anchor with highest iou(iou should also > 0)
-        id_highest = np.argmax(iou.T, axis=1)
-        id_highest_gt = np.arange(iou.T.shape[0])
-        mask = iou.T[id_highest_gt, id_highest] > 0
-        id_highest, id_highest_gt = id_highest[mask], id_highest_gt[mask]
-
-        # find anchor iou > cfg.XXX_POS_IOU
-        id_pos, id_pos_gt = np.where(iou > cfg.RPN_POS_IOU)
-
-        # find anchor iou < cfg.XXX_NEG_IOU
-        id_neg = np.where(np.sum(iou < cfg.RPN_NEG_IOU,
-                                 axis=1) == iou.shape[1])[0]
-
-        id_pos = np.concatenate([id_pos, id_highest])
-        id_pos_gt = np.concatenate([id_pos_gt, id_highest_gt])
-
-        # TODO: uniquify the array in a more scientific way
-        id_pos, index = np.unique(id_pos, return_index=True)
-        id_pos_gt = id_pos_gt[index]
-        id_neg.sort()
-
-        # cal the target and set the equal one
-        index_x, index_y, index_z = np.unravel_index(
-            id_pos, (*feature_map_shape, 2))
-        pos_equal_one[batch_id, index_x, index_y, index_z] = 1
-
-        # ATTENTION: index_z should be np.array
-        targets[batch_id, index_x, index_y, np.array(index_z) * 7] = (
-            batch_gt_boxes3d[batch_id][id_pos_gt, 0] - anchors_reshaped[id_pos, 0]) / anchors_d[id_pos]
-        targets[batch_id, index_x, index_y, np.array(index_z) * 7 + 1] = (
-            batch_gt_boxes3d[batch_id][id_pos_gt, 1] - anchors_reshaped[id_pos, 1]) / anchors_d[id_pos]
-        targets[batch_id, index_x, index_y, np.array(index_z) * 7 + 2] = (
-            batch_gt_boxes3d[batch_id][id_pos_gt, 2] - anchors_reshaped[id_pos, 2]) / cfg.ANCHOR_H
-        targets[batch_id, index_x, index_y, np.array(index_z) * 7 + 3] = np.log(
-            batch_gt_boxes3d[batch_id][id_pos_gt, 3] / anchors_reshaped[id_pos, 3])
-        targets[batch_id, index_x, index_y, np.array(index_z) * 7 + 4] = np.log(
-            batch_gt_boxes3d[batch_id][id_pos_gt, 4] / anchors_reshaped[id_pos, 4])
-        targets[batch_id, index_x, index_y, np.array(index_z) * 7 + 5] = np.log(
-            batch_gt_boxes3d[batch_id][id_pos_gt, 5] / anchors_reshaped[id_pos, 5])
-        targets[batch_id, index_x, index_y, np.array(index_z) * 7 + 6] = (
-            batch_gt_boxes3d[batch_id][id_pos_gt, 6] - anchors_reshaped[id_pos, 6])
-
-        index_x, index_y, index_z = np.unravel_index(
-            id_neg, (*feature_map_shape, 2))
-        neg_equal_one[batch_id, index_x, index_y, index_z] = 1
-        # to avoid a box be pos/neg in the same time
-        index_x, index_y, index_z = np.unravel_index(
-            id_highest, (*feature_map_shape, 2))
-        neg_equal_one[batch_id, index_x, index_y, index_z] = 0
+        id_pos, targets_pos, id_neg = assign_rpn_target(
+            batch_gt_boxes3d[batch_id], anchors_reshaped, anchors_d, anchors_standup_2d, coordinate=coordinate)
+        pos_equal_one[batch_id], neg_equal_one[batch_id], targets[batch_id] = sparse_to_dense_rpn_target(
+            id_pos, targets_pos, id_neg, feature_map_shape)
 
     return pos_equal_one, neg_equal_one, targets
 
 
+def sparse_to_dense_rpn_target(id_pos, targets_pos, id_neg, feature_map_shape):
+    # Input:
+    #   id_pos: (P), targets_pos: (P, 7), id_neg: (Q)
+    #   feature_map_shape: (w, l)
+    # Output:
+    #   pos_equal_one (w, l, 2)
+    #   neg_equal_one (w, l, 2)
+    #   targets (w, l, 14)
+    n_anchors = feature_map_shape[0] * feature_map_shape[1] * 2
+    pos_equal_one = np.zeros((n_anchors), dtype=np.float32)
+    neg_equal_one = np.zeros((n_anchors), dtype=np.float32)
+    targets = np.zeros((n_anchors, 7), dtype=np.float32)
+    pos_equal_one[id_pos] = 1
+    neg_equal_one[id_neg] = 1
+    targets[id_pos] = targets_pos
+    return pos_equal_one.reshape(*feature_map_shape, 2), neg_equal_one.reshape(*feature_map_shape, 2), \
+        targets.reshape(*feature_map_shape, 14)
+
+
 # BOTTLENECK
 def delta_to_boxes3d(deltas, anchors, coordinate='lidar'):
     # Input:
@@ -1030,57 +1077,16 @@ def cal_iou2d(box1, box2, T_VELO_2_CAM=None, R_RECT_0=None):
     # Input: 
     #   box1/2: x, y, w, l, r
     # Output :
-    #   iou
-    buf1 = np.zeros((cfg.INPUT_HEIGHT, cfg.INPUT_WIDTH, 3))
-    buf2 = np.zeros((cfg.INPUT_HEIGHT, cfg.INPUT_WIDTH, 3))
-    tmp = center_to_corner_box2d(np.array([box1, box2]), coordinate='lidar', T_VELO_2_CAM=T_VELO_2_CAM, R_RECT_0=R_RECT_0)
-    box1_corner = batch_lidar_to_bird_view(tmp[0]).astype(np.int32)
-    box2_corner = batch_lidar_to_bird_view(tmp[1]).astype(np.int32)
-    buf1 = cv2.fillConvexPoly(buf1, box1_corner, color=(1,1,1))[..., 0]
-    buf2 = cv2.fillConvexPoly(buf2, box2_corner, color=(1,1,1))[..., 0]
-    indiv = np.sum(np.absolute(buf1-buf2))
-    share = np.sum((buf1 + buf2) == 2)
-    if indiv == 0:
-        return 0.0 # when target is out of bound
-    return share / (indiv + share)
-
-def cal_z_intersect(cz1, h1, cz2, h2):
-    b1z1, b1z2 = cz1 - h1 / 2, cz1 + h1 / 2
-    b2z1, b2z2 = cz2 - h2 / 2, cz2 + h2 / 2
-    if b1z1 > b2z2 or b2z1 > b1z2:
-        return 0
-    elif b2z1 <= b1z1 <= b2z2:
-        if b1z2 <= b2z2:
-            return h1 / h2
-        else:
-            return (b2z2 - b1z1) / (b1z2 - b2z1)
-    elif b1z1 < b2z1 < b1z2:
-        if b2z2 <= b1z2:
-            return h2 / h1
-        else:
-            return (b1z2 - b2z1) / (b2z2 - b1z1)
+    #   iou, exact bird view iou of the rotated boxes (see utils/rotated_iou.py)
+    return float(iou_bev(box1, box2)[0, 0])
 
 
 def cal_iou3d(box1, box2, T_VELO_2_CAM=None, R_RECT_0=None):
     # Input:
     #   box1/2: x, y, z, h, w, l, r
     # Output:
-    #   iou
-    buf1 = np.zeros((cfg.INPUT_HEIGHT, cfg.INPUT_WIDTH, 3))
-    buf2 = np.zeros((cfg.INPUT_HEIGHT, cfg.INPUT_WIDTH, 3))
-    tmp = center_to_corner_box2d(np.array([box1[[0,1,4,5,6]], box2[[0,1,4,5,6]]]), coordinate='lidar', T_VELO_2_CAM=T_VELO_2_CAM, R_RECT_0=R_RECT_0)
-    box1_corner = batch_lidar_to_bird_view(tmp[0]).astype(np.int32)
-    box2_corner = batch_lidar_to_bird_view(tmp[1]).astype(np.int32)
-    buf1 = cv2.fillConvexPoly(buf1, box1_corner, color=(1,1,1))[..., 0]
-    buf2 = cv2.fillConvexPoly(buf2, box2_corner, color=(1,1,1))[..., 0]
-    share = np.sum((buf1 + buf2) == 2)
-    area1 = np.sum(buf1)
-    area2 = np.sum(buf2)
-    
-    z1, h1, z2, h2 = box1[2], box1[3], box2[2], box2[3]
-    z_intersect = cal_z_intersect(z1, h1, z2, h2)
-
-    return share * z_intersect / (area1 * h1 + area2 * h2 - share * z_intersect)
+    #   iou, exact 3d iou of the boxes rotated around z
+    return float(iou_3d(box1, box2)[0, 0])
 
 
 def cal_box3d_iou(boxes3d, gt_boxes3d, cal_3d=0, T_VELO_2_CAM=None, R_RECT_0=None):
@@ -1089,20 +1095,11 @@ def cal_box3d_iou(boxes3d, gt_boxes3d, cal_3d=0, T_VELO_2_CAM=None, R_RECT_0=Non
     #   gt_boxed3d: (N2, 7) x,y,z,h,w,l,r
     # Outputs:
     #   iou: (N1, N2)
-    N1 = len(boxes3d)
-    N2 = len(gt_boxes3d)
-    output = np.zeros((N1, N2), dtype=np.float32)
-
-    for idx in range(N1):
-        for idy in range(N2):
-            if cal_3d:
-                output[idx, idy] = float(
-                    cal_iou3d(boxes3d[idx], gt_boxes3d[idy]), T_VELO_2_CAM, R_RECT_0)
-            else:
-                output[idx, idy] = float(
-                    cal_iou2d(boxes3d[idx, [0, 1, 4, 5, 6]], gt_boxes3d[idy, [0, 1, 4, 5, 6]], T_VELO_2_CAM, R_RECT_0))
-
-    return output
+    boxes3d = np.asarray(boxes3d).reshape(-1, 7)
+    gt_boxes3d = np.asarray(gt_boxes3d).reshape(-1, 7)
+    if cal_3d:
+        return iou_3d(boxes3d, gt_boxes3d).astype(np.float32)
+    return iou_bev(boxes3d[:, [0, 1, 4, 5, 6]], gt_boxes3d[:, [0, 1, 4, 5, 6]]).astype(np.float32)
 
 
 def cal_box2d_iou(boxes2d, gt_boxes2d, T_VELO_2_CAM=None, R_RECT_0=None):
@@ -1111,11 +1108,4 @@ def cal_box2d_iou(boxes2d, gt_boxes2d, T_VELO_2_CAM=None, R_RECT_0=None):
     #   gt_boxes2d: (N2, 5) x,y,w,l,r
     # Outputs:
     #   iou: (N1, N2)
-    N1 = len(boxes2d)
-    N2 = len(gt_boxes2d)
-    output = np.zeros((N1, N2), dtype=np.float32)
-    for idx in range(N1):
-        for idy in range(N2):
-            output[idx, idy] = cal_iou2d(boxes2d[idx], gt_boxes2d[idy], T_VELO_2_CAM, R_RECT_0)
-
-    return output
+    return iou_bev(boxes2d, gt_boxes2d).astype(np.float32)
@@ -0,0 +1,146 @@
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+
+from utils.utils import process_pointcloud
+
+# cfg fields that change the output of process_pointcloud
+VOXEL_CFG_KEYS = ["SCENE_SIZE", "VOXEL_SIZE", "GRID_SIZE", "LIDAR_COORD", "MAX_POINT_NUMBER", "DETECT_OBJECT"]
+BUFFER_KEYS = ["feature_buffer", "coordinate_buffer", "number_buffer"]
+
+
+def voxel_config_hash(cfg):
+    # Input:
+    #   cfg: config edict
+    # Output:
+    #   short hex digest of the voxel related cfg fields
+    blob = json.dumps({key: cfg[key] for key in VOXEL_CFG_KEYS}, sort_keys=True)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:16]
+
+
+class VoxelCache:
+    """
+      Persistent on-disk cache of the process_pointcloud output of a split.
+
+      The voxel buffers of many frames are concatenated into shard files (one .npy per buffer),
+      which are memory-mapped on read. The cache lives in cache_root/<split>/<cfg hash>, so changing
+      any voxel related cfg field selects a fresh cache. Each entry also records the mtime and size
+      of its radar .bin file; an entry whose source changed is recomputed and rewritten by build().
+
+      Args:
+        cache_root : str, root directory of the caches
+        split_dir : str, split directory of the dataset (ex : DATA_DIR/validation)
+        cfg : config edict
+        shard_size : int, number of frames per shard file
+    """
+    def __init__(self, cache_root, split_dir, cfg, shard_size=256):
+        self.cfg = cfg
+        self.shard_size = shard_size
+        self.pc_dir = os.path.join(split_dir, "radar_6455")
+        self.cache_dir = os.path.join(cache_root, os.path.basename(os.path.normpath(split_dir)), voxel_config_hash(cfg))
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        self.entries = {}
+        self._shards = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, mode='r') as f:
+                self.entries = json.load(f)["entries"]
+
+    def _pc_path(self, tag):
+        return "%s/%06d.bin" % (self.pc_dir, int(tag))
+
+    def _source_stamp(self, tag):
+        st = os.stat(self._pc_path(tag))
+        return [st.st_mtime_ns, st.st_size]
+
+    def _shard_path(self, shard, key):
+        return os.path.join(self.cache_dir, "shard_%05d_%s.npy" % (shard, key))
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = {key: np.load(self._shard_path(shard, key), mmap_mode='r') for key in BUFFER_KEYS}
+        return self._shards[shard]
+
+    def is_valid(self, tag):
+        entry = self.entries.get("%06d" % int(tag))
+        return entry is not None and entry[3:] == self._source_stamp(tag)
+
+    def stale_tags(self, tags):
+        return [tag for tag in tags if not self.is_valid(tag)]
+
+    def build(self, tags, verbose=False):
+        # voxelize and write every tag that is missing or out of date, returns the number of written frames
+        stale = self.stale_tags(tags)
+        if not stale:
+            return 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        next_shard = 1 + max([entry[0] for entry in self.entries.values()], default=-1)
+        for start in range(0, len(stale), self.shard_size):
+            shard = next_shard + start // self.shard_size
+            chunk = stale[start:start + self.shard_size]
+            buffers = {key: [] for key in BUFFER_KEYS}
+            offset = 0
+            for tag in chunk:
+                stamp = self._source_stamp(tag)
+                pc = np.fromfile(self._pc_path(tag), dtype=np.float32).reshape(-1, 4)
+                voxel_dict = process_pointcloud(pc, self.cfg)
+                for key in BUFFER_KEYS:
+                    buffers[key].append(voxel_dict[key])
+                n_voxels = len(voxel_dict["number_buffer"])
+                self.entries["%06d" % int(tag)] = [shard, offset, n_voxels] + stamp
+                offset += n_voxels
+            for key in BUFFER_KEYS:
+                np.save(self._shard_path(shard, key), np.concatenate(buffers[key], axis=0))
+            if verbose:
+                print("voxel cache: wrote shard {} ({} frames) to {}".format(shard, len(chunk), self.cache_dir))
+        self._shards = {}
+        self._write_index()
+        self._remove_unused_shards()
+        return len(stale)
+
+    def _write_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, mode='w') as f:
+            json.dump({"cfg": {key: self.cfg[key] for key in VOXEL_CFG_KEYS}, "entries": self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _remove_unused_shards(self):
+        used = set(entry[0] for entry in self.entries.values())
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("shard_") and int(name.split("_")[1]) not in used:
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def get(self, tag, point_cloud=None):
+        # Input:
+        #   tag: frame tag
+        #   point_cloud: (N, 4), optional, used when the cached entry is missing or stale
+        # Output:
+        #   voxel_dict, read-only memory-mapped views when served from the cache
+        if not self.is_valid(tag):
+            if point_cloud is None:
+                point_cloud = np.fromfile(self._pc_path(tag), dtype=np.float32).reshape(-1, 4)
+            return process_pointcloud(point_cloud, self.cfg)
+        shard, offset, n_voxels = self.entries["%06d" % int(tag)][:3]
+        buffers = self._shard(shard)
+        return {key: buffers[key][offset:offset + n_voxels] for key in BUFFER_KEYS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prebuild the voxel cache of a split")
+    parser.add_argument("--data_root_dir", required=True, help="Data root directory", type=str)
+    parser.add_argument("--split", default="validation", help="Split to cache (training, validation or testing)", type=str)
+    parser.add_argument("--cache_dir", required=True, help="Root directory of the voxel caches", type=str)
+    parser.add_argument("--shard_size", default=256, help="Number of frames per shard", type=int)
+    args = parser.parse_args()
+
+    from config import cfg
+    split_dir = os.path.join(args.data_root_dir, args.split)
+    tags = sorted(os.path.basename(a).split(".")[0] for a in os.listdir(os.path.join(split_dir, "radar_6455")) if a.endswith(".bin"))
+    cache = VoxelCache(args.cache_dir, split_dir, cfg, shard_size=args.shard_size)
+    n = cache.build(tags, verbose=True)
+    print("voxel cache {}: {} frames written, {} up to date".format(cache.cache_dir, n, len(tags) - n))
+
+
+if __name__ == "__main__":
+    main()